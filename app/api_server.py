@@ -1,22 +1,36 @@
 import asyncio
+import atexit
+import json
 import logging
+import time
 import uuid
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Dict, Any, Optional
-import tempfile
+from typing import Dict, Any, List, Optional
 import shutil
-from concurrent.futures import ThreadPoolExecutor
 import os
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Form
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Header, Request
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel
 import uvicorn
 from dotenv import load_dotenv
 
 import babeldoc.format.pdf.high_level
-from babeldoc.format.pdf.translation_config import TranslationConfig, WatermarkOutputMode
-from babeldoc.translator.translator import OpenAITranslator, set_translate_rate_limiter
+
+import translate_pipeline
+import translate_worker
+import font_cache
+import task_memory
+import task_trace
+import log_pipeline
+import request_packer
+import single_flight
+import endpoint_pool
+import llm_usage
+import pdf_optimizer
+import webhook_outbox
+import pdf_analysis
 
 
 
@@ -24,29 +38,126 @@ load_dotenv()  # 自动加载同目录下的 .env 文件
 # 从环境变量加载配置
 def load_config():
     """从环境变量加载配置"""
+    openai_config = {
+        "api_key": os.getenv("OPENAI_API_KEY", ""),
+        "model": os.getenv("OPENAI_MODEL", "deepseek-ai/DeepSeek-V3"),
+        "base_url": os.getenv("OPENAI_BASE_URL", "https://api.siliconflow.cn/v1")
+    }
+    # 多个翻译接口（JSON数组），未单独设置qps的接口取QPS；配置后服务总QPS默认为各接口之和
+    endpoints = endpoint_pool.parse_endpoints(os.getenv("OPENAI_ENDPOINTS", ""), openai_config, float(os.getenv("QPS", "12")))
     return {
-        "openai": {
-            "api_key": os.getenv("OPENAI_API_KEY", ""),
-            "model": os.getenv("OPENAI_MODEL", "deepseek-ai/DeepSeek-V3"),
-            "base_url": os.getenv("OPENAI_BASE_URL", "https://api.siliconflow.cn/v1")
-        },
+        "openai": openai_config,
         "server": {
             "host": os.getenv("SERVER_HOST", "0.0.0.0"),
             "port": int(os.getenv("SERVER_PORT", "8000")),
-            "qps": int(os.getenv("QPS", "12"))
+            "qps": int(os.getenv("QPS") or sum(endpoint["qps"] for endpoint in endpoints) or 12)
         },
         "translation": {
             "default_lang_in": os.getenv("DEFAULT_LANG_IN", "en"),
             "default_lang_out": os.getenv("DEFAULT_LANG_OUT", "zh"),
             "watermark_output_mode": os.getenv("WATERMARK_OUTPUT_MODE", "no_watermark"),
             "no_dual": os.getenv("NO_DUAL", "false").lower() == "true",
-            "no_mono": os.getenv("NO_MONO", "false").lower() == "true"
+            "no_mono": os.getenv("NO_MONO", "false").lower() == "true",
+            # 同一进程内并发的相同翻译请求只调用一次LLM
+            "dedup": os.getenv("TRANSLATION_DEDUP", "true").lower() == "true",
+            # 单个任务的token预算，超出时终止任务；0表示不限制
+            "task_token_budget": int(os.getenv("TASK_TOKEN_BUDGET", "0"))
         },
         "storage": {
             "logs_dir": os.getenv("LOGS_DIR", "./data/logs"),
             "temp_dir": os.getenv("TEMP_DIR", "./data/temp"),
             "uploads_dir": os.getenv("UPLOADS_DIR", "./data/uploads"),
-            "downloads_dir": os.getenv("DOWNLOADS_DIR", "./data/downloads")
+            "downloads_dir": os.getenv("DOWNLOADS_DIR", "./data/downloads"),
+            "working_dir": os.getenv("WORKING_DIR", "./data/working"),
+            # 翻译中间状态保留时长（小时），0表示不保留、不支持重新渲染
+            "working_dir_retention_hours": float(os.getenv("WORKING_DIR_RETENTION_HOURS", "24")),
+            # 翻译检查点：解析结果与已译段落保存在任务的working_dir中，服务重启后未完成的任务从检查点继续
+            "checkpoint": os.getenv("TASK_CHECKPOINT", "true").lower() == "true",
+            # 已译段落日志刷写到磁盘（fsync）的间隔（秒）
+            "checkpoint_interval": float(os.getenv("TASK_CHECKPOINT_INTERVAL", "5")),
+            # 同一任务最多恢复的次数，反复中断的任务（如每次都导致服务被杀）不再恢复
+            "max_resumes": int(os.getenv("TASK_MAX_RESUMES", "3"))
+        },
+        "memory": {
+            # 节点内存预算（MB），0表示取容器cgroup上限或物理内存
+            "budget_mb": float(os.getenv("MEMORY_BUDGET_MB", "0")),
+            # 单任务内存上限（MB），超出时只终止该任务；0表示不限制
+            "task_limit_mb": float(os.getenv("TASK_MEMORY_LIMIT_MB", "0")),
+            # 为系统与突发预留的内存（MB）
+            "reserve_mb": float(os.getenv("MEMORY_RESERVE_MB", "512")),
+            # 任务内存估算：基础占用 + 每个文本页/扫描页的占用（MB）
+            "base_mb": float(os.getenv("TASK_MEMORY_BASE_MB", "300")),
+            "page_mb": float(os.getenv("TASK_MEMORY_PAGE_MB", "8")),
+            "scanned_page_mb": float(os.getenv("TASK_MEMORY_SCANNED_PAGE_MB", "24"))
+        },
+        "workers": {
+            # 翻译工作进程数，0表示在API服务进程内执行
+            "processes": int(os.getenv("TRANSLATE_WORKERS", "2")),
+            # 工作进程处理多少个任务或RSS增长多少MB后回收
+            "max_tasks": int(os.getenv("WORKER_MAX_TASKS", "50")),
+            "max_rss_growth_mb": float(os.getenv("WORKER_MAX_RSS_GROWTH_MB", "2048"))
+        },
+        "layout": {
+            # 版面分析批量推理：每批最多页数与收集页面的时间窗口（毫秒）
+            "batch_size": int(os.getenv("LAYOUT_BATCH_SIZE", "8")),
+            "batch_window_ms": float(os.getenv("LAYOUT_BATCH_WINDOW_MS", "20")),
+            # ONNX Runtime线程数，0表示使用onnxruntime默认值
+            "intra_op_threads": int(os.getenv("ONNX_INTRA_OP_THREADS", "0")),
+            "inter_op_threads": int(os.getenv("ONNX_INTER_OP_THREADS", "0"))
+        },
+        "tracing": {
+            # 任务span以OTLP/JSON逐行写入的文件，设为空则只保留在内存中供查询
+            "export_file": os.getenv("TRACE_EXPORT_FILE", str(Path(os.getenv("LOGS_DIR", "./data/logs")) / "traces.jsonl"))
+        },
+        "packing": {
+            # 合并短LLM请求：单个请求内容不超过segment_max_tokens时排队合并，
+            # 每次合并请求的提示词不超过max_tokens、请求数不超过max_segments
+            "enabled": os.getenv("LLM_PACKING", "false").lower() == "true",
+            "segment_max_tokens": int(os.getenv("LLM_PACK_SEGMENT_MAX_TOKENS", "200")),
+            "max_tokens": int(os.getenv("LLM_PACK_MAX_TOKENS", "8000")),
+            "max_segments": int(os.getenv("LLM_PACK_MAX_SEGMENTS", "8")),
+            "max_output_tokens": int(os.getenv("LLM_PACK_MAX_OUTPUT_TOKENS", "8192")),
+            # 取得QPS配额后等待更多请求加入的时间（毫秒）
+            "window_ms": float(os.getenv("LLM_PACK_WINDOW_MS", "50")),
+            "max_inflight": int(os.getenv("LLM_PACK_MAX_INFLIGHT", "64"))
+        },
+        "pdf_optimize": {
+            # 流水线完成后重写结果PDF：合并重复的字体与图片、压缩对象流，可选线性化（需要qpdf）
+            "enabled": os.getenv("PDF_OPTIMIZE", "false").lower() == "true",
+            "workers": int(os.getenv("PDF_OPTIMIZE_WORKERS", "2")),
+            "linearize": os.getenv("PDF_OPTIMIZE_LINEARIZE", "false").lower() == "true"
+        },
+        "webhooks": {
+            # 未送达的任务完成通知保存在SQLite发件箱中，重启后继续投递
+            "outbox_path": os.getenv("WEBHOOK_OUTBOX_PATH", "./data/webhooks.db"),
+            # 设置后对通知签名（HMAC-SHA256）
+            "secret": os.getenv("WEBHOOK_SECRET", ""),
+            # 通知中结果下载链接的地址前缀，不设置时使用提交任务时请求的地址
+            "public_url": os.getenv("WEBHOOK_PUBLIC_URL", "").rstrip("/"),
+            "timeout": float(os.getenv("WEBHOOK_TIMEOUT", "10")),
+            # 最多尝试次数，第n次失败后等待 backoff_base * 2^(n-1) 秒（不超过backoff_max）重试
+            "max_attempts": int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "8")),
+            "backoff_base": float(os.getenv("WEBHOOK_BACKOFF_SECONDS", "5")),
+            "backoff_max": float(os.getenv("WEBHOOK_BACKOFF_MAX_SECONDS", "3600"))
+        },
+        "endpoints": {
+            "endpoints": endpoints,
+            # least_outstanding或weighted_round_robin
+            "strategy": os.getenv("ENDPOINT_STRATEGY", "least_outstanding"),
+            # 连续出错多少次后摘除，被摘除的接口每隔probe_interval秒探测一次
+            "eject_errors": int(os.getenv("ENDPOINT_EJECT_ERRORS", "3")),
+            "probe_interval": float(os.getenv("ENDPOINT_PROBE_INTERVAL", "30")),
+            # 返回429后暂不分配新请求的时间（秒）
+            "throttle_seconds": float(os.getenv("ENDPOINT_THROTTLE_SECONDS", "2"))
+        },
+        "logging": {
+            "level": os.getenv("LOG_LEVEL", "INFO").upper(),
+            # 日志文件按大小或时间轮转，保留backup_count个旧文件
+            "max_bytes": int(os.getenv("LOG_MAX_MB", "100")) * 1024 * 1024,
+            "rotate_seconds": float(os.getenv("LOG_ROTATE_HOURS", "24")) * 3600,
+            "backup_count": int(os.getenv("LOG_BACKUP_COUNT", "7")),
+            # 同一任务同一阶段的进度日志的采样间隔（秒），0表示不采样
+            "progress_interval": float(os.getenv("LOG_PROGRESS_INTERVAL", "5"))
         }
     }
 
@@ -54,18 +165,15 @@ config = load_config()
 log_dir = Path(config["storage"]["logs_dir"])
 log_file = log_dir/ f"{__name__}.log"
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO) 
-
 
-file_handler = logging.FileHandler(log_file)
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+# 日志经队列由后台线程写入，不阻塞事件循环；退出时写完队列中剩余的记录
+log_listener = log_pipeline.setup(str(log_file), config["logging"])
+atexit.register(log_listener.stop)
 
 
 # 验证OpenAI配置
-if not config["openai"]["api_key"]:
-    logger.error("未找到OpenAI API密钥！请通过环境变量OPENAI_API_KEY提供")
+if not config["openai"]["api_key"] and not config["endpoints"]["endpoints"]:
+    logger.error("未找到OpenAI API密钥！请通过环境变量OPENAI_API_KEY或OPENAI_ENDPOINTS提供")
     raise ValueError("Missing OpenAI API key")
 
 
@@ -76,7 +184,8 @@ def init_directories():
         storage_config["logs_dir"],
         storage_config["temp_dir"],
         storage_config["uploads_dir"],
-        storage_config["downloads_dir"]
+        storage_config["downloads_dir"],
+        storage_config["working_dir"]
     ]:
         dir_obj = Path(dir_path)
         dir_obj.mkdir(exist_ok=True, parents=True)
@@ -86,7 +195,51 @@ def init_directories():
 # 应用启动时调用
 init_directories()
 
-app = FastAPI(title="BabelDOC Translation API", version="0.4.16")
+# 过期working_dir的清理间隔（秒）
+WORKING_DIR_CLEANUP_INTERVAL = 600
+# 任务内存采样间隔（秒）
+MEMORY_SAMPLE_INTERVAL = 1.0
+# 进度事件流的状态检查间隔与心跳间隔（秒）
+TASK_EVENTS_POLL_INTERVAL = 0.5
+TASK_EVENTS_KEEPALIVE_INTERVAL = 15
+# 未完成任务的描述文件，保存在任务的working_dir中，任务结束时删除
+TASK_MANIFEST_FILE = "task.json"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    cleanup_task = None
+    if config["storage"]["working_dir_retention_hours"] > 0:
+        cleanup_task = asyncio.create_task(cleanup_working_dirs_loop())
+    memory_task = asyncio.create_task(memory_monitor_loop())
+    webhook_task = asyncio.create_task(webhooks.run())
+    global worker_pool
+    if config["workers"]["processes"] == 0:
+        # 在本进程内执行任务时，所有任务共用进程级字体缓存
+        await asyncio.to_thread(font_cache.preload)
+    else:
+        worker_pool = translate_worker.WorkerPool(
+            size=config["workers"]["processes"],
+            max_tasks=config["workers"]["max_tasks"],
+            max_rss_growth_mb=config["workers"]["max_rss_growth_mb"],
+            settings=config
+        )
+        worker_pool.start()
+        memory_governor.worker_baselines = worker_pool.baselines
+    if output_optimizer:
+        output_optimizer.start()
+    if config["storage"]["checkpoint"]:
+        resume_interrupted_tasks()
+    yield
+    memory_task.cancel()
+    webhook_task.cancel()
+    if worker_pool:
+        await worker_pool.stop()
+    if output_optimizer:
+        output_optimizer.shutdown()
+    if cleanup_task:
+        cleanup_task.cancel()
+
+app = FastAPI(title="BabelDOC Translation API", version="0.4.16", lifespan=lifespan)
 
 class TranslationRequest(BaseModel):
     lang_in: Optional[str] = None
@@ -95,16 +248,221 @@ class TranslationRequest(BaseModel):
     no_dual: Optional[bool] = None
     no_mono: Optional[bool] = None
     watermark_output_mode: Optional[str] = None
+    ocr_workaround: Optional[bool] = None
+    base_task_id: Optional[str] = None
+    token_budget: Optional[int] = None
 
 class TranslationStatus(BaseModel):
     task_id: str
-    status: str  # pending, processing, completed, failed
+    status: str  # pending, processing, completed, failed, cancelled
     progress: float = 0.0
     message: str = ""
     result_files: Dict[str, str] = {}
+    analysis: Optional[Dict[str, Any]] = None
+    incremental: Optional[Dict[str, Any]] = None
+    languages: Optional[Dict[str, Dict[str, Any]]] = None  # 多目标语言任务各语言的状态与进度
+    memory: Optional[Dict[str, Any]] = None  # 估算、当前与峰值内存占用（MB）
+    usage: Optional[Dict[str, Any]] = None  # LLM调用次数、token用量、重试、缓存命中与限流等待
+    optimization: Optional[Dict[str, Dict[str, Any]]] = None  # 各结果文件优化前后的大小
+    resumes: int = 0  # 服务重启后从检查点继续的次数
+    render: Optional[Dict[str, Any]] = None  # 最近一次重新渲染的状态、进度与消息，不改变任务本身的状态
 
 translation_tasks: Dict[str, TranslationStatus] = {}
 task_files: Dict[str, Dict[str, Path]] = {}
+# 运行中的后台任务，用于取消
+running_tasks: Dict[str, asyncio.Task] = {}
+# 重新渲染所需的任务上下文：pdf_file, request, output_dir, working_dir
+task_contexts: Dict[str, Dict[str, Any]] = {}
+# 提交时指定了callback_url的任务：回调地址与结果下载链接的地址前缀，任务结束时通知一次
+task_callbacks: Dict[str, Dict[str, str]] = {}
+webhooks = webhook_outbox.WebhookOutbox(config["webhooks"])
+# 各任务每个流水线任务（按类型与目标语言）最近的LLM用量快照
+task_usage: Dict[str, Dict[str, Dict[str, Any]]] = {}
+# 每次执行任务（翻译、重新渲染）的trace
+task_traces: Dict[str, List[task_trace.TaskTrace]] = {}
+trace_exporter = task_trace.SpanExporter(config["tracing"]["export_file"])
+
+memory_config = config["memory"]
+memory_governor = task_memory.MemoryGovernor(
+    budget_mb=memory_config["budget_mb"] or (task_memory.read_cgroup_memory_limit() or task_memory.psutil.virtual_memory().total) / task_memory.MB,
+    task_limit_mb=memory_config["task_limit_mb"],
+    reserve_mb=memory_config["reserve_mb"],
+    base_mb=memory_config["base_mb"],
+    page_mb=memory_config["page_mb"],
+    scanned_page_mb=memory_config["scanned_page_mb"]
+)
+
+doc_layout_model = None
+# 翻译工作进程池，TRANSLATE_WORKERS为0时为None，任务在本进程内执行
+worker_pool: Optional[translate_worker.WorkerPool] = None
+# 结果PDF优化进程池，未开启PDF_OPTIMIZE时为None
+output_optimizer = pdf_optimizer.PdfOptimizer(config["pdf_optimize"]) if config["pdf_optimize"]["enabled"] else None
+
+def get_doc_layout_model():
+    """懒加载版面分析模型，仅在本进程内执行任务时使用"""
+    global doc_layout_model
+    if doc_layout_model is None:
+        import layout_batcher
+        doc_layout_model = layout_batcher.load_layout_model(config["layout"])
+    return doc_layout_model
+
+def analyze_pdf_file(file_path: Path, lang_in: Optional[str] = None, qps: Optional[int] = None) -> Dict[str, Any]:
+    """预检PDF文件（见pdf_analysis），未指定的源语言与QPS取服务配置"""
+    return pdf_analysis.analyze_pdf_file(
+        file_path, lang_in or config["translation"]["default_lang_in"], qps or config["server"]["qps"]
+    )
+
+async def run_pipeline_job(
+    task_id: str,
+    job_type: str,
+    pdf_file: Path,
+    request: TranslationRequest,
+    output_dir: Path,
+    working_dir: Optional[Path],
+    **kwargs
+):
+    """在工作进程池（或本进程）中执行流水线任务，产出进度事件，并按事件记录各阶段的span"""
+    job = {
+        "task_id": task_id,
+        "type": job_type,
+        "pdf_file": pdf_file,
+        "request": request.model_dump(),
+        "output_dir": output_dir,
+        "working_dir": working_dir,
+        "kwargs": kwargs
+    }
+    pipeline_span = task_trace.start_span(f"pipeline.{job_type}", lang_out=request.lang_out)
+    error = None
+    usage = None
+    try:
+        if worker_pool:
+            wait_span = task_trace.start_span("worker_wait")
+            
+            def on_start(pid: int):
+                if wait_span:
+                    wait_span.end()
+                    pipeline_span.set_attribute("worker.pid", pid)
+                memory_governor.add_pid(task_id, pid)
+            
+            events = worker_pool.run(job, on_start=on_start, on_end=lambda pid: memory_governor.remove_pid(task_id, pid))
+        else:
+            with task_trace.span("model_load"):
+                doc_layout_model = get_doc_layout_model()
+            events = translate_worker.run_job(job, config, doc_layout_model)
+        async for event in events:
+            if pipeline_span:
+                pipeline_span.trace.observe(pipeline_span, event)
+            if event["type"] == "progress_update":
+                # 进度日志按阶段采样，参数在写入时才格式化
+                logger.info(
+                    "Task %s [%s] %s %s/%s (%.1f%%)", task_id, request.lang_out, event.get("stage"),
+                    event.get("stage_current"), event.get("stage_total"), event.get("overall_progress", 0.0),
+                    extra={"stage": event.get("stage"), "lang_out": request.lang_out, "progress": event.get("overall_progress")}
+                )
+            if event.get("usage"):
+                usage = event["usage"]
+                record_task_usage(task_id, f"{job_type}:{request.lang_out}", request, usage)
+            if event["type"] == "error":
+                error = str(event.get("error", "未知错误"))
+            yield event
+    except GeneratorExit:
+        # 调用方在完成事件后不再迭代
+        raise
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        if pipeline_span:
+            if usage:
+                pipeline_span.set_attribute("llm.calls", usage["llm_calls"])
+                pipeline_span.set_attribute("llm.total_tokens", usage["total_tokens"])
+                pipeline_span.set_attribute("llm.rate_limit_wait_seconds", usage["rate_limit_wait_seconds"])
+            pipeline_span.end(error)
+
+def record_task_usage(task_id: str, job_key: str, request: TranslationRequest, usage: Dict[str, Any]):
+    """更新任务的LLM用量；超出token预算时终止任务"""
+    status = translation_tasks.get(task_id)
+    if not status:
+        return
+    jobs = task_usage.setdefault(task_id, {})
+    jobs[job_key] = usage
+    total = llm_usage.merge(list(jobs.values()))
+    page_count = (status.analysis or {}).get("page_count")
+    total["tokens_per_page"] = round(total["total_tokens"] / page_count, 1) if page_count else None
+    status.usage = total
+    if status.languages and request.lang_out in status.languages:
+        status.languages[request.lang_out]["usage"] = usage
+    
+    budget = request.token_budget or config["translation"]["task_token_budget"]
+    running_task = running_tasks.get(task_id)
+    if budget and total["total_tokens"] > budget and status.status == "processing" and running_task:
+        status.status = "failed"
+        status.message = f"token用量 {total['total_tokens']} 超过任务预算 {budget}，任务已终止"
+        running_task.cancel()
+        logger.warning(f"Task {task_id} exceeded token budget: {total['total_tokens']} > {budget}")
+
+def collect_result_files(result, key_prefix: str = "") -> Dict[str, str]:
+    result_files = {}
+    if result.dual_pdf_path and Path(result.dual_pdf_path).exists():
+        result_files[f"{key_prefix}dual"] = str(result.dual_pdf_path)
+    if result.mono_pdf_path and Path(result.mono_pdf_path).exists():
+        result_files[f"{key_prefix}mono"] = str(result.mono_pdf_path)
+    # watermark_output_mode为both时额外产出无水印版本
+    if result.no_watermark_dual_pdf_path and result.no_watermark_dual_pdf_path != result.dual_pdf_path and Path(result.no_watermark_dual_pdf_path).exists():
+        result_files[f"{key_prefix}no_watermark_dual"] = str(result.no_watermark_dual_pdf_path)
+    if result.no_watermark_mono_pdf_path and result.no_watermark_mono_pdf_path != result.mono_pdf_path and Path(result.no_watermark_mono_pdf_path).exists():
+        result_files[f"{key_prefix}no_watermark_mono"] = str(result.no_watermark_mono_pdf_path)
+    return result_files
+
+async def optimize_result_files(task_id: str, result_files: Dict[str, str]):
+    """在优化进程池中压缩结果PDF，记录各文件优化前后的大小；结果变大或出错时保留原文件"""
+    if not output_optimizer or not result_files:
+        return
+    with task_trace.span("pdf_optimize", files=len(result_files)) as optimize_span:
+        report = await output_optimizer.optimize(result_files)
+        original_bytes = sum(result.get("original_bytes", 0) for result in report.values())
+        output_bytes = sum(result.get("output_bytes", 0) for result in report.values())
+        if optimize_span:
+            optimize_span.set_attribute("original_bytes", original_bytes)
+            optimize_span.set_attribute("output_bytes", output_bytes)
+    status = translation_tasks[task_id]
+    status.optimization = {**(status.optimization or {}), **report}
+    logger.info(f"Optimized {len(report)} result files for task {task_id}: {original_bytes} -> {output_bytes} bytes")
+
+def add_result_files(task_id: str, result_files: Dict[str, str]):
+    translation_tasks[task_id].result_files = {**translation_tasks[task_id].result_files, **result_files}
+    task_files.setdefault(task_id, {}).update({k: Path(v) for k, v in result_files.items()})
+
+def get_base_working_dir(request: TranslationRequest) -> Optional[Path]:
+    """修订版任务对应目标语言的旧版本working_dir"""
+    if not request.base_task_id:
+        return None
+    lang_out = request.lang_out or config["translation"]["default_lang_out"]
+    base_context = task_contexts.get(request.base_task_id, {}).get(lang_out)
+    return base_context["working_dir"] if base_context else None
+
+async def run_translation_events(task_id: str, events, done_message: str, key_prefix: str = "") -> bool:
+    """消费流水线事件并更新任务状态，成功完成时返回True"""
+    async for event in events:
+        if event["type"] == "progress_update":
+            translation_tasks[task_id].progress = event.get("overall_progress", 0.0)
+            translation_tasks[task_id].message = f"{event.get('stage', '处理中')} ({event.get('stage_current', 0)}/{event.get('stage_total', 100)})"
+        elif event["type"] == "error":
+            translation_tasks[task_id].status = "failed"
+            translation_tasks[task_id].message = f"翻译失败: {event.get('error', '未知错误')}"
+            logger.error(f"Translation failed for task {task_id}: {event.get('error')}")
+            return False
+        elif event["type"] == "finish":
+            result_files = collect_result_files(event["translate_result"], key_prefix)
+            if output_optimizer:
+                translation_tasks[task_id].message = "正在优化输出PDF..."
+                await optimize_result_files(task_id, result_files)
+            translation_tasks[task_id].status = "completed"
+            translation_tasks[task_id].progress = 100.0
+            translation_tasks[task_id].message = done_message
+            add_result_files(task_id, result_files)
+            return True
+    return False
 
 async def translate_document(
     task_id: str,
@@ -112,125 +470,478 @@ async def translate_document(
     request: TranslationRequest,
     output_dir: Path
 ):
+    keep_il = config["storage"]["working_dir_retention_hours"] > 0
+    checkpoint_interval = get_checkpoint_interval()
+    task_working_dir = Path(config["storage"]["working_dir"]) / task_id if keep_il or checkpoint_interval is not None else None
     try:
         translation_tasks[task_id].status = "processing"
-        translation_tasks[task_id].message = "正在初始化翻译器..."
+        translation_tasks[task_id].message = "正在翻译文档..."
+        
+        # 修订版：复用旧版本任务中未变化页面的译文
+        base_working_dir = get_base_working_dir(request)
+        incremental_stats = {} if base_working_dir else None
+        
+        events = run_pipeline_job(
+            task_id,
+            "translate",
+            pdf_file,
+            request,
+            output_dir,
+            task_working_dir,
+            keep_il=keep_il,
+            base_working_dir=base_working_dir,
+            incremental_stats=incremental_stats,
+            checkpoint_interval=checkpoint_interval
+        )
+        if await run_translation_events(task_id, events, "翻译完成"):
+            if incremental_stats:
+                translation_tasks[task_id].incremental = {"base_task_id": request.base_task_id, **incremental_stats}
+                translation_tasks[task_id].message = f"翻译完成（复用 {incremental_stats['reused_pages']} 页，翻译 {incremental_stats['translated_pages']} 页）"
+            if keep_il:
+                effective_working_dir = translate_pipeline.get_effective_working_dir(task_working_dir, pdf_file)
+                translate_pipeline.remove_checkpoint(effective_working_dir)
+                task_contexts[task_id] = {
+                    request.lang_out or config["translation"]["default_lang_out"]: {
+                        "pdf_file": pdf_file,
+                        "request": request,
+                        "output_dir": output_dir,
+                        "working_dir": effective_working_dir
+                    }
+                }
+                os.utime(task_working_dir)
+            logger.info(f"Translation completed for task {task_id}")
+                
+    except Exception as e:
+        translation_tasks[task_id].status = "failed"
+        translation_tasks[task_id].message = f"翻译过程出错: {str(e)}"
+        logger.error(f"Translation error for task {task_id}: {e}", exc_info=True)
+    finally:
+        # 服务停止时中断的任务仍为processing，保留检查点供重启后继续
+        if task_working_dir and task_id not in task_contexts and translation_tasks[task_id].status != "processing":
+            shutil.rmtree(task_working_dir, ignore_errors=True)
+
+async def translate_document_multi(
+    task_id: str,
+    pdf_file: Path,
+    request: TranslationRequest,
+    output_dir: Path,
+    lang_outs: List[str]
+):
+    """一次上传翻译为多个目标语言：解析与版面分析只做一次，各语言并行翻译和渲染"""
+    keep_il = config["storage"]["working_dir_retention_hours"] > 0
+    checkpoint_interval = get_checkpoint_interval()
+    # 共用的预处理PDF需要落盘，不保留中间结果时任务结束后删除
+    task_working_dir = Path(config["storage"]["working_dir"]) / task_id
+    status = translation_tasks[task_id]
+    status.languages = {lang: {"status": "pending", "progress": 0.0, "message": "等待源文解析..."} for lang in lang_outs}
+    contexts: Dict[str, Dict[str, Any]] = {}
+    try:
+        status.status = "processing"
+        status.message = "正在解析文档..."
         
-        # 使用配置文件中的OpenAI设置
-        translator = OpenAITranslator(
-            lang_in=request.lang_in or config["translation"]["default_lang_in"],
-            lang_out=request.lang_out or config["translation"]["default_lang_out"],
-            model=config["openai"]["model"],
-            base_url=config["openai"]["base_url"],
-            api_key=config["openai"]["api_key"],
-            ignore_cache=False,
+        source = None
+        # 整体进度中解析阶段所占比例，由解析任务的事件给出
+        source_share = 0.0
+        parse_events = run_pipeline_job(
+            task_id, "parse", pdf_file, request, output_dir, task_working_dir / "source"
         )
+        async for event in parse_events:
+            source_share = event.get("source_share", source_share)
+            if event["type"] == "progress_update":
+                status.progress = event.get("overall_progress", 0.0) * source_share
+                status.message = f"{event.get('stage', '处理中')} ({event.get('stage_current', 0)}/{event.get('stage_total', 100)})"
+            elif event["type"] == "error":
+                raise RuntimeError(event.get("error", "未知错误"))
+            elif event["type"] == "finish":
+                source = event["translate_result"]
+                break
+        if source is None:
+            raise RuntimeError("源文解析未完成")
         
-        set_translate_rate_limiter(request.qps or config["server"]["qps"])
+        status.message = f"正在翻译为 {', '.join(lang_outs)}..."
         
-        from babeldoc.docvision.doclayout import DocLayoutModel
-        doc_layout_model = DocLayoutModel.load_onnx()
+        async def translate_language(lang: str):
+            lang_status = status.languages[lang]
+            lang_status["status"] = "processing"
+            lang_request = request.model_copy(update={"lang_out": lang})
+            base_working_dir = get_base_working_dir(lang_request)
+            incremental_stats = {} if base_working_dir else None
+            events = run_pipeline_job(
+                task_id,
+                "translate_from_source",
+                pdf_file,
+                lang_request,
+                output_dir,
+                task_working_dir / lang,
+                source=source,
+                keep_il=keep_il,
+                base_working_dir=base_working_dir,
+                incremental_stats=incremental_stats,
+                checkpoint_interval=checkpoint_interval
+            )
+            async for event in events:
+                if event["type"] == "progress_update":
+                    lang_status["progress"] = event.get("overall_progress", 0.0)
+                    lang_status["message"] = f"{event.get('stage', '处理中')} ({event.get('stage_current', 0)}/{event.get('stage_total', 100)})"
+                    status.progress = source_share * 100 + (1 - source_share) * sum(
+                        s["progress"] for s in status.languages.values()
+                    ) / len(lang_outs)
+                elif event["type"] == "error":
+                    lang_status["status"] = "failed"
+                    lang_status["message"] = f"翻译失败: {event.get('error', '未知错误')}"
+                    logger.error(f"Translation to {lang} failed for task {task_id}: {event.get('error')}")
+                    return
+                elif event["type"] == "finish":
+                    result_files = collect_result_files(event["translate_result"], f"{lang}.")
+                    if output_optimizer:
+                        lang_status["message"] = "正在优化输出PDF..."
+                        await optimize_result_files(task_id, result_files)
+                    lang_status["status"] = "completed"
+                    lang_status["progress"] = 100.0
+                    lang_status["message"] = "翻译完成"
+                    if incremental_stats:
+                        lang_status["incremental"] = {"base_task_id": request.base_task_id, **incremental_stats}
+                    add_result_files(task_id, result_files)
+                    effective_working_dir = translate_pipeline.get_effective_working_dir(task_working_dir / lang, pdf_file)
+                    translate_pipeline.remove_checkpoint(effective_working_dir)
+                    contexts[lang] = {
+                        "pdf_file": pdf_file,
+                        "request": lang_request,
+                        "output_dir": output_dir,
+                        "working_dir": effective_working_dir
+                    }
+                    return
         
-        watermark_output_mode = request.watermark_output_mode or config["translation"]["watermark_output_mode"]
-        watermark_mode = WatermarkOutputMode.Watermarked
-        if watermark_output_mode == "no_watermark":
-            watermark_mode = WatermarkOutputMode.NoWatermark
-        elif watermark_output_mode == "both":
-            watermark_mode = WatermarkOutputMode.Both
+        async def run_language(lang: str):
+            try:
+                await translate_language(lang)
+            except Exception as e:
+                status.languages[lang]["status"] = "failed"
+                status.languages[lang]["message"] = f"翻译过程出错: {str(e)}"
+                logger.error(f"Translation to {lang} error for task {task_id}: {e}", exc_info=True)
         
-        config_obj = TranslationConfig(
-            input_file=str(pdf_file),
-            font=None,
-            pages=None,
-            output_dir=str(output_dir),
-            translator=translator,
-            debug=False,
-            lang_in=request.lang_in or config["translation"]["default_lang_in"],
-            lang_out=request.lang_out or config["translation"]["default_lang_out"],
-            no_dual=request.no_dual if request.no_dual is not None else config["translation"]["no_dual"],
-            no_mono=request.no_mono if request.no_mono is not None else config["translation"]["no_mono"],
-            qps=request.qps or config["server"]["qps"],
-            formular_font_pattern=None,
-            formular_char_pattern=None,
-            split_short_lines=False,
-            short_line_split_factor=0.8,
-            doc_layout_model=doc_layout_model,
-            skip_clean=False,
-            dual_translate_first=False,
-            disable_rich_text_translate=False,
-            enhance_compatibility=False,
-            use_alternating_pages_dual=False,
-            report_interval=0.1,
-            min_text_length=5,
-            watermark_output_mode=watermark_mode,
-            split_strategy=None,
-            table_model=None,
-            show_char_box=False,
-            skip_scanned_detection=False,
-            ocr_workaround=False,
-            custom_system_prompt=None,
-            working_dir=None,
-            add_formula_placehold_hint=False,
-            glossaries=[],
-            pool_max_workers=None,
-            auto_extract_glossary=True,
-            auto_enable_ocr_workaround=False,
-            primary_font_family=None,
-            only_include_translated_page=False,
-            save_auto_extracted_glossary=False,
-        )
+        await asyncio.gather(*(run_language(lang) for lang in lang_outs))
         
-        translation_tasks[task_id].message = "正在翻译文档..."
+        failed = [lang for lang in lang_outs if status.languages[lang]["status"] != "completed"]
+        if len(failed) == len(lang_outs):
+            status.status = "failed"
+            status.message = "所有目标语言翻译失败"
+            return
+        status.status = "completed"
+        status.progress = 100.0
+        status.message = f"翻译完成，以下语言失败: {', '.join(failed)}" if failed else "翻译完成"
+        if keep_il:
+            task_contexts[task_id] = contexts
+            os.utime(task_working_dir)
+        logger.info(f"Translation to {lang_outs} completed for task {task_id}")
+    
+    except Exception as e:
+        status.status = "failed"
+        status.message = f"翻译过程出错: {str(e)}"
+        logger.error(f"Translation error for task {task_id}: {e}", exc_info=True)
+    finally:
+        # 服务停止时中断的任务仍为processing，保留检查点供重启后继续
+        if status.status != "processing":
+            shutil.rmtree(task_working_dir / "source", ignore_errors=True)
+            if task_id not in task_contexts:
+                shutil.rmtree(task_working_dir, ignore_errors=True)
+
+def is_rendering(status: TranslationStatus) -> bool:
+    """已完成的任务是否正在重新渲染"""
+    return bool(status.render) and status.render["status"] in ("pending", "processing")
+
+async def render_document_task(task_id: str, lang_out: str, request: TranslationRequest):
+    """重新渲染只更新render字段，任务保持completed，渲染期间已有结果仍可下载"""
+    context = task_contexts[task_id][lang_out]
+    render = translation_tasks[task_id].render
+    # 多语言任务的结果文件以语言代码为前缀
+    key_prefix = f"{lang_out}." if translation_tasks[task_id].languages else ""
+    # 先渲染到临时目录，完成后再替换已有结果，下载不会读到写了一半的文件
+    render_dir = context["output_dir"] / ".render"
+    try:
+        render["status"] = "processing"
+        render["message"] = "正在重新渲染..."
+        render_dir.mkdir(exist_ok=True)
         
-        async for event in babeldoc.format.pdf.high_level.async_translate(config_obj):
+        events = run_pipeline_job(
+            task_id,
+            "render",
+            context["pdf_file"],
+            request,
+            render_dir,
+            context["working_dir"].parent
+        )
+        async for event in events:
             if event["type"] == "progress_update":
-                translation_tasks[task_id].progress = event.get("overall_progress", 0.0)
-                translation_tasks[task_id].message = f"{event.get('stage', '处理中')} ({event.get('stage_current', 0)}/{event.get('stage_total', 100)})"
+                render["progress"] = event.get("overall_progress", 0.0)
+                render["message"] = f"{event.get('stage', '处理中')} ({event.get('stage_current', 0)}/{event.get('stage_total', 100)})"
             elif event["type"] == "error":
-                translation_tasks[task_id].status = "failed"
-                translation_tasks[task_id].message = f"翻译失败: {event.get('error', '未知错误')}"
-                logger.error(f"Translation failed for task {task_id}: {event.get('error')}")
+                render["status"] = "failed"
+                render["message"] = f"重新渲染失败: {event.get('error', '未知错误')}"
+                logger.error(f"Render failed for task {task_id}: {event.get('error')}")
                 return
             elif event["type"] == "finish":
-                result = event["translate_result"]
-                translation_tasks[task_id].status = "completed"
-                translation_tasks[task_id].progress = 100.0
-                translation_tasks[task_id].message = "翻译完成"
-                
-                result_files = {}
-                if result.dual_pdf_path and Path(result.dual_pdf_path).exists():
-                    result_files["dual"] = str(result.dual_pdf_path)
-                if result.mono_pdf_path and Path(result.mono_pdf_path).exists():
-                    result_files["mono"] = str(result.mono_pdf_path)
-                
-                translation_tasks[task_id].result_files = result_files
-                task_files[task_id] = {k: Path(v) for k, v in result_files.items()}
-                
-                logger.info(f"Translation completed for task {task_id}")
-                break
-                
+                result_files = collect_result_files(event["translate_result"], key_prefix)
+                if output_optimizer:
+                    render["message"] = "正在优化输出PDF..."
+                    await optimize_result_files(task_id, result_files)
+                for file_type, path in result_files.items():
+                    target = context["output_dir"] / Path(path).name
+                    os.replace(path, target)
+                    result_files[file_type] = str(target)
+                add_result_files(task_id, result_files)
+                render["status"] = "completed"
+                render["progress"] = 100.0
+                render["message"] = "重新渲染完成"
+                # 渲染成功后刷新保留期限
+                os.utime(Path(config["storage"]["working_dir"]) / task_id)
+                logger.info(f"Render completed for task {task_id}")
+                return
+        render["status"] = "failed"
+        render["message"] = "重新渲染未完成"
     except Exception as e:
-        translation_tasks[task_id].status = "failed"
-        translation_tasks[task_id].message = f"翻译过程出错: {str(e)}"
-        logger.error(f"Translation error for task {task_id}: {e}", exc_info=True)
+        render["status"] = "failed"
+        render["message"] = f"重新渲染出错: {str(e)}"
+        logger.error(f"Render error for task {task_id}: {e}", exc_info=True)
+    finally:
+        shutil.rmtree(render_dir, ignore_errors=True)
+
+async def cleanup_working_dirs_loop():
+    """定期删除超过保留时长的working_dir"""
+    retention_seconds = config["storage"]["working_dir_retention_hours"] * 3600
+    working_root = Path(config["storage"]["working_dir"])
+    while True:
+        try:
+            now = time.time()
+            for task_dir in working_root.iterdir():
+                status = translation_tasks.get(task_dir.name)
+                if status and (status.status in ("pending", "processing") or is_rendering(status)):
+                    continue
+                # 未完成任务的检查点，可能尚未恢复
+                if (task_dir / TASK_MANIFEST_FILE).exists():
+                    continue
+                if now - task_dir.stat().st_mtime < retention_seconds:
+                    continue
+                task_contexts.pop(task_dir.name, None)
+                await asyncio.to_thread(shutil.rmtree, task_dir, True)
+                logger.info(f"Removed expired working dir {task_dir}")
+        except Exception as e:
+            logger.error(f"Working dir cleanup error: {e}", exc_info=True)
+        await asyncio.sleep(WORKING_DIR_CLEANUP_INTERVAL)
+
+
+async def run_with_memory_admission(task_id: str, coro, estimated_mb: float, trace: task_trace.TaskTrace):
+    """剩余内存放得下估算占用后再执行任务，结束时保留最终的内存统计"""
+    started = False
+    rendering = is_rendering(translation_tasks[task_id])
+    try:
+        with trace.activate():
+            with task_trace.span("queue_wait", estimated_mb=round(estimated_mb, 1)):
+                if not memory_governor.fits(estimated_mb):
+                    if rendering:
+                        translation_tasks[task_id].render["message"] = "等待内存余量，排队中..."
+                    else:
+                        translation_tasks[task_id].message = "等待内存余量，排队中..."
+                await memory_governor.acquire(task_id, estimated_mb)
+            started = True
+            await coro
+    finally:
+        if not started:
+            coro.close()
+        task_memory_stats = await memory_governor.release(task_id)
+        status = translation_tasks.get(task_id)
+        if task_memory_stats and status:
+            status.memory = task_memory_stats.to_dict()
+            trace.root.set_attribute("memory.peak_mb", round(task_memory_stats.peak_mb, 1))
+        if rendering and status:
+            # 重新渲染不改变任务状态，也不再发送结束通知
+            if is_rendering(status):
+                status.render["status"] = "failed"
+                status.render["message"] = "重新渲染未完成"
+            trace.end(status.render["status"], status.render["message"])
+        else:
+            trace.end(status.status if status else "failed", status.message if status else None)
+            if status and status.status in ("completed", "failed", "cancelled"):
+                remove_task_manifest(task_id)
+                if task_id in task_callbacks:
+                    notify_task_finished(task_id)
+
+def notify_task_finished(task_id: str):
+    """把任务结束通知写入webhook发件箱"""
+    callback = task_callbacks.pop(task_id)
+    status = translation_tasks[task_id]
+    payload = {
+        "event": f"task.{status.status}",
+        "task_id": task_id,
+        "status": status.status,
+        "message": status.message,
+        "result_files": {
+            file_type: f"{callback['base_url']}/download/{task_id}/{file_type}" for file_type in status.result_files
+        },
+        "languages": {
+            lang: {"status": lang_status["status"], "message": lang_status["message"]}
+            for lang, lang_status in status.languages.items()
+        } if status.languages else None,
+        "usage": status.usage,
+        "finished_at": round(time.time(), 3)
+    }
+    try:
+        delivery_id = webhooks.enqueue(task_id, callback["url"], payload)
+        logger.info(f"Queued webhook {delivery_id} for task {task_id}")
+    except Exception as e:
+        logger.error(f"Failed to queue webhook for task {task_id}: {e}", exc_info=True)
+
+def get_checkpoint_interval() -> Optional[float]:
+    """传给流水线的检查点刷写间隔，未开启检查点时为None"""
+    return config["storage"]["checkpoint_interval"] if config["storage"]["checkpoint"] else None
 
+def write_task_manifest(task_id: str, manifest: Dict[str, Any]):
+    """把重新执行任务所需的参数写入任务的working_dir，服务重启后据此恢复"""
+    manifest_path = Path(config["storage"]["working_dir"]) / task_id / TASK_MANIFEST_FILE
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = manifest_path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+    temp_path.replace(manifest_path)
+
+def remove_task_manifest(task_id: str):
+    """任务结束后不再恢复；只剩描述文件的working_dir一并删除"""
+    task_dir = Path(config["storage"]["working_dir"]) / task_id
+    (task_dir / TASK_MANIFEST_FILE).unlink(missing_ok=True)
+    try:
+        task_dir.rmdir()
+    except OSError:
+        pass
+
+def resume_interrupted_tasks():
+    """服务启动时重新提交上次未完成的翻译任务，流水线从working_dir中的检查点继续"""
+    for manifest_path in sorted(Path(config["storage"]["working_dir"]).glob(f"*/{TASK_MANIFEST_FILE}")):
+        task_id = manifest_path.parent.name
+        try:
+            manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+            pdf_file = Path(manifest["pdf_file"])
+            if not pdf_file.exists():
+                raise FileNotFoundError(f"上传的文件已不存在: {pdf_file}")
+            request = TranslationRequest(**manifest["request"])
+        except Exception as e:
+            logger.error(f"Cannot resume task {task_id}: {e}")
+            shutil.rmtree(manifest_path.parent, ignore_errors=True)
+            continue
+        
+        resumes = manifest.get("resumes", 0) + 1
+        status = TranslationStatus(
+            task_id=task_id,
+            status="pending",
+            message="服务已重启，任务将从检查点继续...",
+            analysis=manifest["analysis"],
+            memory={"estimated_mb": manifest["estimated_mb"]},
+            resumes=resumes
+        )
+        translation_tasks[task_id] = status
+        if manifest.get("callback"):
+            task_callbacks[task_id] = manifest["callback"]
+        if resumes > config["storage"]["max_resumes"]:
+            status.status = "failed"
+            status.message = f"任务已中断 {resumes} 次，不再从检查点恢复"
+            logger.error(f"Task {task_id} was interrupted {resumes} times, giving up")
+            remove_task_manifest(task_id)
+            shutil.rmtree(manifest_path.parent, ignore_errors=True)
+            if task_id in task_callbacks:
+                notify_task_finished(task_id)
+            continue
+        write_task_manifest(task_id, {**manifest, "resumes": resumes})
+        
+        lang_outs = manifest["lang_outs"]
+        output_dir = Path(manifest["output_dir"])
+        trace = task_trace.TaskTrace(
+            task_id, "translate", trace_exporter, None,
+            file_name=pdf_file.name, lang_out=",".join(lang_outs), base_task_id=request.base_task_id, resumes=resumes
+        )
+        if len(lang_outs) > 1:
+            coro = translate_document_multi(task_id, pdf_file, request, output_dir, lang_outs)
+        else:
+            coro = translate_document(task_id, pdf_file, request, output_dir)
+        start_task(task_id, coro, manifest["estimated_mb"], trace)
+        logger.info(f"Resuming task {task_id} from checkpoint (resume {resumes})")
 
+def start_task(task_id: str, coro, estimated_mb: float, trace: task_trace.TaskTrace):
+    """在后台运行任务并保存引用，以便取消"""
+    task_traces.setdefault(task_id, []).append(trace)
+    task = asyncio.create_task(run_with_memory_admission(task_id, coro, estimated_mb, trace))
+    running_tasks[task_id] = task
+    task.add_done_callback(lambda _: running_tasks.pop(task_id, None))
 
+async def memory_monitor_loop():
+    """定期采样各任务内存，终止超出单任务上限的任务"""
+    while True:
+        try:
+            for task_id in memory_governor.sample():
+                status = translation_tasks.get(task_id)
+                running_task = running_tasks.get(task_id)
+                if not status or not running_task:
+                    continue
+                memory = memory_governor.tasks[task_id]
+                message = f"内存占用 {memory.current_mb:.0f}MB 超过单任务上限 {memory.limit_mb:.0f}MB，任务已终止"
+                if is_rendering(status):
+                    # 重新渲染失败不影响已有的翻译结果
+                    status.render["status"] = "failed"
+                    status.render["message"] = message
+                else:
+                    status.status = "failed"
+                    status.message = message
+                running_task.cancel()
+                logger.warning(f"Task {task_id} exceeded memory limit: {memory.current_mb:.0f}MB > {memory.limit_mb:.0f}MB")
+            for task_id, memory in memory_governor.tasks.items():
+                if task_id in translation_tasks:
+                    translation_tasks[task_id].memory = memory.to_dict()
+        except Exception as e:
+            logger.error(f"Memory monitor error: {e}", exc_info=True)
+        await asyncio.sleep(MEMORY_SAMPLE_INTERVAL)
 
 @app.post("/translate", response_model=dict)
 async def translate_pdf(
-    background_tasks: BackgroundTasks,
-    file: UploadFile = File(...),
+    http_request: Request,
+    file: UploadFile = File(...),  # noqa: B008
     lang_in: Optional[str] = Form(None),
     lang_out: Optional[str] = Form(None),
     qps: Optional[int] = Form(None),
     no_dual: Optional[bool] = Form(None),
     no_mono: Optional[bool] = Form(None),
-    watermark_output_mode: Optional[str] = Form(None)
+    watermark_output_mode: Optional[str] = Form(None),
+    base_task_id: Optional[str] = Form(None),
+    token_budget: Optional[int] = Form(None),
+    callback_url: Optional[str] = Form(None),
+    traceparent: Optional[str] = Header(None)
 ):
     if not file.filename.lower().endswith('.pdf'):
         raise HTTPException(status_code=400, detail="只支持PDF文件")
     
+    if callback_url and not callback_url.startswith(("http://", "https://")):
+        raise HTTPException(status_code=400, detail="callback_url必须是http或https地址")
+    
+    # lang_out支持以逗号分隔的多个目标语言，如 "zh,ja,ko"
+    lang_outs = list(dict.fromkeys(
+        lang.strip() for lang in (lang_out or config["translation"]["default_lang_out"]).split(",") if lang.strip()
+    ))
+    if not lang_outs:
+        raise HTTPException(status_code=400, detail="目标语言不能为空")
+    
+    # 增量翻译：上传的文件是base_task_id对应文档的新修订版
+    if base_task_id:
+        if base_task_id not in translation_tasks:
+            raise HTTPException(status_code=404, detail="旧版本任务不存在")
+        base_contexts = task_contexts.get(base_task_id, {})
+        if not base_contexts or not all(
+            lang in base_contexts and translate_pipeline.has_translated_il(base_contexts[lang]["working_dir"])
+            for lang in lang_outs
+        ):
+            raise HTTPException(status_code=410, detail="旧版本任务的翻译中间结果已过期或不包含这些目标语言，请不带base_task_id重新提交")
+        default_lang_in = config["translation"]["default_lang_in"]
+        base_request = next(iter(base_contexts.values()))["request"]
+        if (lang_in or default_lang_in) != (base_request.lang_in or default_lang_in):
+            raise HTTPException(status_code=400, detail="增量翻译的源语言必须与旧版本任务一致")
+        # 刷新旧版本中间结果的保留期限，避免翻译过程中被清理
+        os.utime(Path(config["storage"]["working_dir"]) / base_task_id)
+    
     task_id = str(uuid.uuid4())
 
 
@@ -243,34 +954,141 @@ async def translate_pdf(
     downloads_task_dir.mkdir(exist_ok=True)
     output_dir = downloads_task_dir  
 
+    trace = task_trace.TaskTrace(
+        task_id, "translate", trace_exporter, traceparent,
+        file_name=file.filename, lang_out=",".join(lang_outs), base_task_id=base_task_id
+    )
+    with trace.activate():
+        with task_trace.span("upload") as upload_span:
+            with open(pdf_path, "wb") as buffer:
+                shutil.copyfileobj(file.file, buffer)
+            upload_span.set_attribute("file.size", pdf_path.stat().st_size)
+        
+        # 预检：加密、损坏或无页面的文件直接拒绝，扫描件自动开启ocr_workaround
+        with task_trace.span("analyze"):
+            analysis = await asyncio.to_thread(analyze_pdf_file, pdf_path, lang_in, qps)
+    trace.root.set_attribute("page_count", analysis.get("page_count"))
+    if not analysis["valid"]:
+        shutil.rmtree(uploads_task_dir, ignore_errors=True)
+        shutil.rmtree(downloads_task_dir, ignore_errors=True)
+        trace.end("failed", analysis["error"])
+        raise HTTPException(status_code=400, detail=analysis["error"])
     
-    with open(pdf_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # 内存准入：估算占用放不下时直接拒绝
+    estimated_mb = memory_governor.estimate(analysis, len(lang_outs))
+    rejection = memory_governor.check_admissible(estimated_mb)
+    if rejection:
+        shutil.rmtree(uploads_task_dir, ignore_errors=True)
+        shutil.rmtree(downloads_task_dir, ignore_errors=True)
+        trace.end("failed", rejection)
+        raise HTTPException(status_code=413, detail=rejection)
     
     request = TranslationRequest(
         lang_in=lang_in,
-        lang_out=lang_out,
+        lang_out=lang_outs[0],
         qps=qps,
         no_dual=no_dual,
         no_mono=no_mono,
-        watermark_output_mode=watermark_output_mode
+        watermark_output_mode=watermark_output_mode,
+        ocr_workaround=analysis["needs_ocr_workaround"],
+        base_task_id=base_task_id,
+        token_budget=token_budget
     )
     
     translation_tasks[task_id] = TranslationStatus(
         task_id=task_id,
         status="pending",
-        message="任务已创建，等待处理..."
+        message="任务已创建，等待处理...",
+        analysis=analysis,
+        memory={"estimated_mb": round(estimated_mb, 1)}
     )
+    if callback_url:
+        task_callbacks[task_id] = {
+            "url": callback_url,
+            "base_url": config["webhooks"]["public_url"] or str(http_request.base_url).rstrip("/")
+        }
+    if config["storage"]["checkpoint"]:
+        write_task_manifest(task_id, {
+            "pdf_file": str(pdf_path),
+            "output_dir": str(output_dir),
+            "request": request.model_dump(),
+            "lang_outs": lang_outs,
+            "analysis": analysis,
+            "estimated_mb": round(estimated_mb, 1),
+            "callback": task_callbacks.get(task_id),
+            "resumes": 0
+        })
     
-    background_tasks.add_task(
-        translate_document,
-        task_id,
-        pdf_path,
-        request,
-        output_dir
-    )
+    if len(lang_outs) > 1:
+        start_task(task_id, translate_document_multi(task_id, pdf_path, request, output_dir, lang_outs), estimated_mb, trace)
+    else:
+        start_task(task_id, translate_document(task_id, pdf_path, request, output_dir), estimated_mb, trace)
+    
+    return {"task_id": task_id, "message": "翻译任务已创建", "analysis": analysis}
+
+@app.post("/analyze", response_model=dict)
+async def analyze_pdf(
+    file: UploadFile = File(...),  # noqa: B008
+    lang_in: Optional[str] = Form(None),
+    qps: Optional[int] = Form(None)
+):
+    if not file.filename.lower().endswith('.pdf'):
+        raise HTTPException(status_code=400, detail="只支持PDF文件")
+    
+    temp_path = Path(config["storage"]["temp_dir"]) / f"{uuid.uuid4()}.pdf"
+    try:
+        with open(temp_path, "wb") as buffer:
+            shutil.copyfileobj(file.file, buffer)
+        return await asyncio.to_thread(analyze_pdf_file, temp_path, lang_in, qps)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+@app.post("/tasks/{task_id}/render", response_model=dict)
+async def render_task(
+    task_id: str,
+    no_dual: Optional[bool] = Form(None),
+    no_mono: Optional[bool] = Form(None),
+    watermark_output_mode: Optional[str] = Form(None),
+    lang_out: Optional[str] = Form(None)
+):
+    if task_id not in translation_tasks:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    
+    if translation_tasks[task_id].status != "completed":
+        raise HTTPException(status_code=400, detail="翻译尚未完成")
+    
+    if is_rendering(translation_tasks[task_id]):
+        raise HTTPException(status_code=400, detail="任务正在重新渲染")
     
-    return {"task_id": task_id, "message": "翻译任务已创建"}
+    contexts = task_contexts.get(task_id, {})
+    if lang_out is None and len(contexts) > 1:
+        raise HTTPException(status_code=400, detail="多目标语言任务需要指定lang_out")
+    if lang_out is None and contexts:
+        lang_out = next(iter(contexts))
+    context = contexts.get(lang_out)
+    if not context or not translate_pipeline.has_translated_il(context["working_dir"]):
+        raise HTTPException(status_code=410, detail="翻译中间结果已过期，请重新提交翻译")
+    
+    update = {}
+    if no_dual is not None:
+        update["no_dual"] = no_dual
+    if no_mono is not None:
+        update["no_mono"] = no_mono
+    if watermark_output_mode is not None:
+        update["watermark_output_mode"] = watermark_output_mode
+    request = context["request"].model_copy(update=update)
+    
+    translation_tasks[task_id].render = {
+        "status": "pending",
+        "progress": 0.0,
+        "message": "重新渲染任务已创建，等待处理...",
+        "lang_out": lang_out
+    }
+    
+    trace = task_trace.TaskTrace(task_id, "render", trace_exporter, lang_out=lang_out)
+    start_task(task_id, render_document_task(task_id, lang_out, request), memory_governor.estimate(translation_tasks[task_id].analysis), trace)
+    
+    return {"task_id": task_id, "message": "重新渲染任务已创建"}
 
 @app.get("/status/{task_id}", response_model=TranslationStatus)
 async def get_translation_status(task_id: str):
@@ -279,6 +1097,83 @@ async def get_translation_status(task_id: str):
     
     return translation_tasks[task_id]
 
+@app.post("/tasks/{task_id}/cancel", response_model=dict)
+async def cancel_task(task_id: str):
+    if task_id not in translation_tasks:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    
+    if is_rendering(translation_tasks[task_id]):
+        translation_tasks[task_id].render["status"] = "cancelled"
+        translation_tasks[task_id].render["message"] = "重新渲染已取消"
+        running_task = running_tasks.get(task_id)
+        if running_task:
+            running_task.cancel()
+        logger.info(f"Render of task {task_id} cancelled")
+        return {"task_id": task_id, "message": "重新渲染已取消"}
+    
+    if translation_tasks[task_id].status not in ("pending", "processing"):
+        raise HTTPException(status_code=400, detail="任务已结束，无法取消")
+    
+    translation_tasks[task_id].status = "cancelled"
+    translation_tasks[task_id].message = "任务已取消"
+    running_task = running_tasks.get(task_id)
+    if running_task:
+        running_task.cancel()
+    logger.info(f"Task {task_id} cancelled")
+    
+    return {"task_id": task_id, "message": "任务已取消"}
+
+@app.get("/webhooks/dead", response_model=dict)
+async def list_dead_webhooks():
+    """达到最大重试次数仍未送达的任务完成通知"""
+    return {"deliveries": webhooks.dead_letters()}
+
+@app.post("/webhooks/{delivery_id}/retry", response_model=dict)
+async def retry_webhook(delivery_id: str):
+    """重新投递未送达的通知（如接收方修复后）"""
+    if not webhooks.retry(delivery_id):
+        raise HTTPException(status_code=404, detail="通知不存在或不是投递失败状态")
+    return {"id": delivery_id, "message": "已重新加入投递队列"}
+
+@app.get("/tasks/{task_id}/trace", response_model=dict)
+async def get_task_trace(task_id: str):
+    """任务每次执行（翻译、重新渲染）的span时间线"""
+    if task_id not in translation_tasks:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    
+    return {"task_id": task_id, "traces": [trace.to_dict() for trace in task_traces.get(task_id, [])]}
+
+@app.get("/tasks/{task_id}/events")
+async def task_events(task_id: str):
+    """以Server-Sent Events推送任务状态，任务结束后关闭连接"""
+    if task_id not in translation_tasks:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    
+    async def event_stream():
+        last_data = None
+        last_sent = time.monotonic()
+        while True:
+            status = translation_tasks.get(task_id)
+            if status is None:
+                return
+            data = status.model_dump_json()
+            if data != last_data:
+                yield f"data: {data}\n\n"
+                last_data = data
+                last_sent = time.monotonic()
+                if status.status in ("completed", "failed", "cancelled") and not is_rendering(status):
+                    return
+            elif time.monotonic() - last_sent >= TASK_EVENTS_KEEPALIVE_INTERVAL:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+            await asyncio.sleep(TASK_EVENTS_POLL_INTERVAL)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/download/{task_id}/{file_type}")
 async def download_result(task_id: str, file_type: str):
     if task_id not in translation_tasks:
@@ -303,7 +1198,20 @@ async def download_result(task_id: str, file_type: str):
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "service": "BabelDOC Translation API"}
+    return {
+        "status": "healthy",
+        "service": "BabelDOC Translation API",
+        "memory": memory_governor.stats(),
+        "workers": worker_pool.stats() if worker_pool else None,
+        "layout": doc_layout_model.stats() if doc_layout_model else None,
+        "fonts": font_cache.stats() if not worker_pool else None,
+        "packing": request_packer.packer.stats() if request_packer.packer and not worker_pool else None,
+        "dedup": single_flight.flights.stats() if not worker_pool else None,
+        "endpoints": worker_pool.endpoint_stats() if worker_pool else (endpoint_pool.pool.stats() if endpoint_pool.pool else None),
+        "pdf_optimize": output_optimizer.stats() if output_optimizer else None,
+        "webhooks": webhooks.stats(),
+        "llm_usage": llm_usage.merge([usage for jobs in task_usage.values() for usage in jobs.values()], parallel=False)
+    }
 
 @app.get("/")
 async def root():
@@ -318,7 +1226,14 @@ async def root():
         },
         "endpoints": {
             "translate": "POST /translate - 上传PDF文件进行翻译",
+            "analyze": "POST /analyze - 预检PDF并估算成本与耗时",
+            "render": "POST /tasks/{task_id}/render - 复用已翻译结果重新生成PDF（不调用LLM）",
             "status": "GET /status/{task_id} - 查询翻译状态",
+            "events": "GET /tasks/{task_id}/events - 以SSE推送任务状态与进度",
+            "cancel": "POST /tasks/{task_id}/cancel - 取消排队中或进行中的任务",
+            "dead_webhooks": "GET /webhooks/dead - 查询投递失败的任务完成通知",
+            "retry_webhook": "POST /webhooks/{delivery_id}/retry - 重新投递失败的通知",
+            "trace": "GET /tasks/{task_id}/trace - 查询任务各阶段耗时的span时间线",
             "download": "GET /download/{task_id}/{file_type} - 下载翻译结果",
             "health": "GET /health - 健康检查"
         }
@@ -327,7 +1242,6 @@ async def root():
 def start_server(host: Optional[str] = None, port: Optional[int] = None):
     babeldoc.format.pdf.high_level.init()
     
-    logging.basicConfig(level=logging.INFO)
     logging.getLogger("httpx").setLevel("WARNING")
     logging.getLogger("openai").setLevel("WARNING")
     
@@ -337,7 +1251,8 @@ def start_server(host: Optional[str] = None, port: Optional[int] = None):
     logger.info(f"Using OpenAI model: {config['openai']['model']}")
     logger.info(f"Default languages: {config['translation']['default_lang_in']} -> {config['translation']['default_lang_out']}")
     
-    uvicorn.run(app, host=server_host, port=server_port)
+    # 不使用uvicorn自带的日志配置，访问日志同样经队列写入
+    uvicorn.run(app, host=server_host, port=server_port, log_config=None)
 
 if __name__ == "__main__":
     start_server()
\ No newline at end of file
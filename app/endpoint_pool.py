@@ -0,0 +1,282 @@
+"""
+翻译接口池
+
+OPENAI_ENDPOINTS配置多个OpenAI兼容接口（各自的地址、密钥、模型、权重与QPS）时，
+翻译器的client换成PooledClient：每次chat.completions.create按策略挑选一个接口，
+在该接口自己的QPS配额内发送（使用工作进程池时各接口的配额由所有工作进程共用，见rate_limiter）。babeldoc的翻译器、请求合并与去重都经由client调用，
+无需各自感知接口池。
+
+- 路由：least_outstanding按 (进行中请求数+1)/权重 选择，weighted_round_robin按权重平滑轮询
+- 故障转移：连接错误、超时、5xx、鉴权错误时换一个接口重试；429时该接口短暂降级并换接口
+- 摘除与恢复：连续出错达到阈值的接口被摘除，后台线程定期用一个极小的请求探测，成功后恢复
+- 全部接口被摘除时仍按顺序尝试，不因探测间隔停止翻译
+
+翻译缓存的键仍使用OPENAI_MODEL，各接口的模型应当译文一致（同一模型的不同服务商或密钥）。
+"""
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+import openai
+
+import llm_usage
+import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# 换接口重试的错误；其余错误（如400）与接口无关，直接抛出
+FAILOVER_ERRORS = (
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    openai.AuthenticationError,
+    openai.PermissionDeniedError,
+    openai.NotFoundError,
+)
+# 计数类指标，合并多个进程的统计时相加
+COUNTERS = ("outstanding", "requests", "errors", "rate_limited", "ejections", "total_tokens")
+
+
+def parse_endpoints(raw: str, defaults: Dict[str, Any], default_qps: float) -> List[Dict[str, Any]]:
+    """
+    解析OPENAI_ENDPOINTS（JSON数组），每项可含name、base_url、api_key、model、weight、qps，
+    缺省字段取OPENAI_BASE_URL/OPENAI_API_KEY/OPENAI_MODEL与QPS
+    """
+    if not raw.strip():
+        return []
+    endpoints = []
+    for index, item in enumerate(json.loads(raw)):
+        endpoint = {
+            "name": item.get("name") or f"endpoint-{index}",
+            "base_url": item.get("base_url") or defaults["base_url"],
+            "api_key": item.get("api_key") or defaults["api_key"],
+            "model": item.get("model") or defaults["model"],
+            "weight": float(item.get("weight", 1)),
+            "qps": float(item.get("qps", default_qps)),
+        }
+        if not endpoint["api_key"]:
+            raise ValueError(f"Endpoint {endpoint['name']} has no API key")
+        if endpoint["weight"] <= 0 or endpoint["qps"] <= 0:
+            raise ValueError(f"Endpoint {endpoint['name']} needs a positive weight and qps")
+        endpoints.append(endpoint)
+    if len({endpoint["name"] for endpoint in endpoints}) != len(endpoints):
+        raise ValueError("Endpoint names must be unique")
+    return endpoints
+
+
+class Endpoint:
+    def __init__(self, spec: Dict[str, Any], limiter_state=None):
+        self.name = spec["name"]
+        self.base_url = spec["base_url"]
+        self.model = spec["model"]
+        self.weight = spec["weight"]
+        self.qps = spec["qps"]
+        if limiter_state is not None:
+            # 工作进程中与其他进程共用该接口的QPS配额
+            self.limiter = rate_limiter.SharedRateLimiter(limiter_state)
+        else:
+            self.limiter = llm_usage.MeteredRateLimiter(self.qps)
+        # 与babeldoc的OpenAITranslator相同的连接设置；重试由接口池换接口完成
+        self.client = openai.OpenAI(
+            base_url=spec["base_url"],
+            api_key=spec["api_key"],
+            max_retries=0,
+            http_client=llm_usage.instrument(httpx.Client(
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=None),
+                timeout=600,
+            )),
+        )
+        self.current_weight = 0.0
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.rate_limited = 0
+        self.throttled_until = 0.0
+        self.ejected_at: Optional[float] = None
+        self.ejections = 0
+        self.last_error: Optional[str] = None
+        self.total_tokens = 0
+        self.latency_total = 0.0
+        self.successes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "model": self.model,
+            "weight": self.weight,
+            "qps": round(self.qps, 2),
+            "healthy": self.ejected_at is None,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "ejections": self.ejections,
+            "last_error": self.last_error,
+            "total_tokens": self.total_tokens,
+            "latency_total": self.latency_total,
+            "successes": self.successes,
+            "avg_latency_ms": round(self.latency_total / self.successes * 1000, 1) if self.successes else None,
+        }
+
+
+class EndpointPool:
+    def __init__(self, settings: Dict[str, Any], limiter_states: Optional[Dict[str, Any]] = None):
+        limiter_states = limiter_states or {}
+        self.endpoints = [Endpoint(spec, limiter_states.get(spec["name"])) for spec in settings["endpoints"]]
+        self.strategy = settings["strategy"]
+        self.eject_errors = settings["eject_errors"]
+        self.probe_interval = settings["probe_interval"]
+        self.throttle_seconds = settings["throttle_seconds"]
+        self.lock = threading.Lock()
+        self.client = PooledClient(self)
+        self.prober = threading.Thread(target=self.probe_loop, name="endpoint-prober", daemon=True)
+        self.prober.start()
+
+    def acquire(self, tried: List[Endpoint]) -> Endpoint:
+        """挑选接口并计入进行中请求：优先未尝试过、未摘除、未降级的接口，逐级放宽"""
+        with self.lock:
+            now = time.monotonic()
+            untried = [endpoint for endpoint in self.endpoints if endpoint not in tried] or self.endpoints
+            healthy = [endpoint for endpoint in untried if endpoint.ejected_at is None]
+            candidates = [endpoint for endpoint in healthy if endpoint.throttled_until <= now] or healthy or untried
+            if self.strategy == "weighted_round_robin":
+                total = sum(endpoint.weight for endpoint in candidates)
+                for endpoint in candidates:
+                    endpoint.current_weight += endpoint.weight
+                endpoint = max(candidates, key=lambda endpoint: endpoint.current_weight)
+                endpoint.current_weight -= total
+            else:
+                endpoint = min(candidates, key=lambda endpoint: ((endpoint.outstanding + 1) / endpoint.weight, endpoint.requests))
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, started: float, response=None, error: Optional[Exception] = None):
+        with self.lock:
+            endpoint.outstanding -= 1
+            if error is None:
+                endpoint.consecutive_errors = 0
+                endpoint.successes += 1
+                endpoint.latency_total += time.monotonic() - started
+                usage = getattr(response, "usage", None)
+                if usage and usage.total_tokens:
+                    endpoint.total_tokens += usage.total_tokens
+                return
+            endpoint.last_error = f"{type(error).__name__}: {error}"[:200]
+            if isinstance(error, openai.RateLimitError):
+                endpoint.rate_limited += 1
+                endpoint.throttled_until = time.monotonic() + self.throttle_seconds
+                return
+            endpoint.errors += 1
+            endpoint.consecutive_errors += 1
+            if endpoint.ejected_at is None and endpoint.consecutive_errors >= self.eject_errors:
+                endpoint.ejected_at = time.monotonic()
+                endpoint.ejections += 1
+                logger.warning(f"Ejected endpoint {endpoint.name} after {endpoint.consecutive_errors} consecutive errors: {endpoint.last_error}")
+
+    def create(self, **kwargs):
+        """chat.completions.create：按策略选接口发送，接口故障或限流时换一个接口重试"""
+        tried: List[Endpoint] = []
+        attempts = max(2, len(self.endpoints))
+        for attempt in range(attempts):
+            endpoint = self.acquire(tried)
+            tried.append(endpoint)
+            # 在该接口的QPS配额内发送；等待配额期间计入进行中请求，least_outstanding据此避开排队长的接口
+            endpoint.limiter.wait()
+            started = time.monotonic()
+            try:
+                response = endpoint.client.chat.completions.create(**{**kwargs, "model": endpoint.model})
+            except (openai.RateLimitError, *FAILOVER_ERRORS) as e:
+                self.release(endpoint, started, error=e)
+                if attempt == attempts - 1:
+                    raise
+                logger.info(f"Endpoint {endpoint.name} failed ({type(e).__name__}), trying another endpoint")
+                if isinstance(e, openai.APIConnectionError):
+                    # 没有HTTP响应，响应钩子不会计数
+                    llm_usage.charge_current(retries=1)
+                continue
+            except BaseException:
+                with self.lock:
+                    endpoint.outstanding -= 1
+                raise
+            self.release(endpoint, started, response=response)
+            return response
+
+    def probe_loop(self):
+        """定期探测被摘除的接口，成功后恢复"""
+        while True:
+            time.sleep(self.probe_interval)
+            for endpoint in self.endpoints:
+                if endpoint.ejected_at is None:
+                    continue
+                try:
+                    endpoint.client.with_options(timeout=30).chat.completions.create(
+                        model=endpoint.model,
+                        max_tokens=1,
+                        messages=[{"role": "user", "content": "ping"}],
+                    )
+                except Exception as e:
+                    endpoint.last_error = f"probe: {type(e).__name__}: {e}"[:200]
+                    continue
+                with self.lock:
+                    endpoint.ejected_at = None
+                    endpoint.consecutive_errors = 0
+                logger.info(f"Re-admitted endpoint {endpoint.name} after a successful probe")
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [endpoint.stats() for endpoint in self.endpoints]
+
+
+class PooledClient:
+    """替代翻译器的openai.OpenAI，只提供翻译器用到的chat.completions.create"""
+
+    def __init__(self, pool: EndpointPool):
+        self.pool = pool
+        self.chat = self
+        self.completions = self
+
+    def create(self, **kwargs):
+        return self.pool.create(**kwargs)
+
+
+def retired_stats(report: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """已退出进程的统计只保留累计计数"""
+    return [dict(stats, outstanding=0, qps=0, healthy=True) for stats in report]
+
+
+def merge_stats(reports: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """合并多个进程的接口统计：计数相加，任一进程摘除即视为不健康；QPS配额由各进程共用，不相加"""
+    merged: Dict[str, Dict[str, Any]] = {}
+    for report in reports:
+        for stats in report:
+            entry = merged.get(stats["name"])
+            if entry is None:
+                merged[stats["name"]] = dict(stats, ejected_processes=0 if stats["healthy"] else 1)
+                continue
+            for key in COUNTERS + ("latency_total", "successes"):
+                entry[key] += stats[key]
+            entry["qps"] = max(entry["qps"], stats["qps"])
+            entry["healthy"] = entry["healthy"] and stats["healthy"]
+            entry["ejected_processes"] += 0 if stats["healthy"] else 1
+            entry["last_error"] = stats["last_error"] or entry["last_error"]
+    for entry in merged.values():
+        entry["avg_latency_ms"] = round(entry["latency_total"] / entry["successes"] * 1000, 1) if entry["successes"] else None
+    return list(merged.values())
+
+
+pool: Optional[EndpointPool] = None
+pool_lock = threading.Lock()
+
+
+def get_pool(settings: Dict[str, Any], limiter_states: Optional[Dict[str, Any]] = None) -> EndpointPool:
+    """进程内共用的接口池；工作进程传入各接口在进程间共享的限流状态（见rate_limiter）"""
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = EndpointPool(settings, limiter_states)
+        return pool
@@ -0,0 +1,112 @@
+"""
+进程级字体缓存
+
+babeldoc的FontMapper在一次流水线中会被解析、术语提取、翻译、排版、生成PDF等
+阶段各创建一次，每次都对全部嵌入字体（约270MB）做sha3校验并重新解析。install()
+之后，字体文件在进程内只校验一次，解析出的pymupdf.Font对象在所有FontMapper、
+所有任务之间共用；字形查询(has_glyph)与字宽计算(char_lengths)的结果也按字体缓存，
+重复排版同样的文字时不再重新计算。
+
+工作进程池以forkserver方式启动时，forkserver预先导入font_preload加载全部字体，
+之后fork出的工作进程共享这些只读的字体数据，不必各自再解析一份。
+"""
+import functools
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, Tuple
+
+import pymupdf
+
+from babeldoc.assets import assets
+from babeldoc.assets.embedding_assets_metadata import EMBEDDING_FONT_METADATA
+from babeldoc.format.pdf.document_il.utils import fontmap
+
+logger = logging.getLogger(__name__)
+
+# 每个字体缓存的字形与字宽查询结果数
+FONT_GLYPH_CACHE_SIZE = 65536
+
+original_get_font_and_metadata = assets.get_font_and_metadata
+verified_fonts: Dict[str, Tuple[Path, Dict[str, Any]]] = {}
+fonts: Dict[str, pymupdf.Font] = {}
+# 字体的原始查询方法与跨任务共用的缓存版本
+glyph_caches: Dict[str, Dict[str, Any]] = {}
+lock = threading.Lock()
+
+
+def get_font_and_metadata(font_file_name: str) -> Tuple[Path, Dict[str, Any]]:
+    """与assets.get_font_and_metadata相同，但每个字体文件在进程内只校验一次"""
+    cached = verified_fonts.get(font_file_name)
+    if cached:
+        return cached
+    result = original_get_font_and_metadata(font_file_name)
+    verified_fonts[font_file_name] = result
+    return result
+
+
+def get_font(font_path: str) -> pymupdf.Font:
+    """返回已解析的字体；FontMapper会替换has_glyph等方法，每次取出前恢复为共用的缓存版本"""
+    font_path = str(font_path)
+    with lock:
+        font = fonts.get(font_path)
+        if font is None:
+            font = pymupdf.Font(fontfile=font_path)
+            fonts[font_path] = font
+            glyph_caches[font_path] = {
+                "has_glyph": functools.lru_cache(maxsize=FONT_GLYPH_CACHE_SIZE, typed=True)(font.has_glyph),
+                "char_lengths": functools.lru_cache(maxsize=FONT_GLYPH_CACHE_SIZE, typed=True)(font.char_lengths),
+            }
+        font.has_glyph = glyph_caches[font_path]["has_glyph"]
+        font.char_lengths = glyph_caches[font_path]["char_lengths"]
+    return font
+
+
+class CachedFontType(type):
+    def __call__(cls, fontfile=None, **kwargs):
+        if fontfile is None or kwargs:
+            return pymupdf.Font(fontfile=fontfile, **kwargs)
+        return get_font(fontfile)
+
+    def __instancecheck__(cls, instance) -> bool:
+        return isinstance(instance, pymupdf.Font)
+
+
+class CachedFont(metaclass=CachedFontType):
+    """在fontmap中代替pymupdf.Font：按文件路径返回缓存的字体，isinstance判断不变"""
+
+
+class FontmapPymupdf:
+    """fontmap模块看到的pymupdf：Font从缓存取，其余属性照常"""
+    Font = CachedFont
+
+    def __getattr__(self, name: str):
+        return getattr(pymupdf, name)
+
+
+def install():
+    """让babeldoc的FontMapper使用进程级字体缓存"""
+    assets.get_font_and_metadata = get_font_and_metadata
+    fontmap.pymupdf = FontmapPymupdf()
+
+
+def preload():
+    """校验并解析全部嵌入字体；字体无法获取时只记录警告，留到使用时再加载"""
+    install()
+    try:
+        for font_file_name in EMBEDDING_FONT_METADATA:
+            font_path, _ = get_font_and_metadata(font_file_name)
+            get_font(font_path)
+    except (Exception, SystemExit) as e:
+        # babeldoc下载字体失败时会调用exit()
+        logger.warning(f"Font preload failed: {e!r}")
+        return
+    logger.info(f"Preloaded {len(fonts)} fonts")
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        "fonts": len(fonts),
+        "glyph_cache_hits": sum(caches["has_glyph"].cache_info().hits for caches in glyph_caches.values()),
+        "char_length_cache_hits": sum(caches["char_lengths"].cache_info().hits for caches in glyph_caches.values()),
+    }
@@ -0,0 +1,7 @@
+"""
+翻译工作进程forkserver的预加载模块：导入时加载全部字体，
+之后fork出的工作进程共享已解析的只读字体数据
+"""
+import font_cache
+
+font_cache.preload()
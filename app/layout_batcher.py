@@ -0,0 +1,185 @@
+"""
+版面分析的批量推理
+
+同一进程中所有任务共用一个ONNX会话。各任务渲染出的页面图片交给后台推理线程，
+推理线程在一个很短的时间窗口内收集来自不同任务的页面，拼成动态批次一次推理，
+再把结果按页面分发回各任务。单个文档也会提前渲染若干页放入队列，使页面较少的
+文档之间、以及同一文档的相邻页面都能合并推理，提高CPU节点的并发吞吐。
+
+ONNX Runtime的intra-op/inter-op线程数可配置；多个工作进程共用一个节点时，
+应让各进程的线程数之和不超过CPU核数。
+"""
+import collections
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List
+
+import numpy as np
+import onnxruntime
+
+from babeldoc.docvision.base_doclayout import DocLayoutModel, YoloResult
+from babeldoc.docvision.doclayout import OnnxModel
+from babeldoc.format.pdf.document_il.utils.raster_geometry import with_target_long_edge
+
+logger = logging.getLogger(__name__)
+
+# 与babeldoc的OnnxModel一致：页面渲染的长边像素与模型输入尺寸
+LAYOUT_IMAGE_SIZE = OnnxModel._FIXED_IMGSZ
+# 置信度低于该值的检测框丢弃
+LAYOUT_CONFIDENCE_THRESHOLD = 0.25
+
+
+class LayoutRequest:
+    def __init__(self, pixels: np.ndarray, orig_shape, geometry):
+        self.pixels = pixels  # 预处理后的CHW输入
+        self.orig_shape = orig_shape
+        self.geometry = geometry
+        self.future: Future = Future()
+
+
+class LayoutBatcher:
+    """后台推理线程：把各任务提交的页面合并成批次推理"""
+
+    def __init__(self, model: OnnxModel, max_batch_size: int, batch_window_ms: float):
+        self.model = model
+        # 静态输入形状的会话（如CoreML）只能逐张推理
+        input_batch = model.model.get_inputs()[0].shape[0]
+        self.max_batch_size = input_batch if isinstance(input_batch, int) else max(1, max_batch_size)
+        self.batch_window = batch_window_ms / 1000
+        self.requests: queue.Queue = queue.Queue()
+        self.batches = 0
+        self.images = 0
+        self.thread = threading.Thread(target=self.serve, name="layout-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, image: np.ndarray, geometry) -> Future:
+        """在调用方线程中预处理图片并排队，返回推理结果的Future"""
+        pixels = self.model.resize_and_pad_image(image, new_shape=LAYOUT_IMAGE_SIZE)
+        pixels = np.transpose(pixels, (2, 0, 1)).astype(np.float32) / 255.0
+        request = LayoutRequest(pixels, image.shape[:2], geometry)
+        self.requests.put(request)
+        return request.future
+
+    def collect_batch(self) -> List[LayoutRequest]:
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return [request for request in batch if request.future.set_running_or_notify_cancel()]
+
+    def serve(self):
+        while True:
+            batch = self.collect_batch()
+            if not batch:
+                continue
+            try:
+                results = self.infer(batch)
+            except Exception as e:
+                logger.error(f"Layout inference failed for a batch of {len(batch)} pages: {e}", exc_info=True)
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, result in zip(batch, results, strict=True):
+                request.future.set_result(result)
+
+    def infer(self, batch: List[LayoutRequest]) -> List[YoloResult]:
+        batch_input = np.stack([request.pixels for request in batch], axis=0)
+        new_shape = batch_input.shape[2:]
+        batch_preds = self.model.model.run(None, {"images": batch_input})[0]
+        self.batches += 1
+        self.images += len(batch)
+
+        results = []
+        for request, preds in zip(batch, batch_preds, strict=True):
+            preds = preds[preds[..., 4] > LAYOUT_CONFIDENCE_THRESHOLD]
+            if len(preds) > 0:
+                preds[..., :4] = self.model.scale_boxes(new_shape, preds[..., :4], request.orig_shape)
+                preds[..., [0, 2]] = request.geometry.px_len_to_pt(preds[..., [0, 2]], "x")
+                preds[..., [1, 3]] = request.geometry.px_len_to_pt(preds[..., [1, 3]], "y")
+            results.append(YoloResult(boxes_data=preds, names=self.model._names))
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "batch_window_ms": self.batch_window * 1000,
+            "batches": self.batches,
+            "images": self.images,
+            "avg_batch_size": round(self.images / self.batches, 2) if self.batches else None,
+            "queued": self.requests.qsize(),
+        }
+
+
+class BatchedLayoutModel(DocLayoutModel):
+    """替代babeldoc的OnnxModel传给TranslationConfig，推理交给共用的LayoutBatcher"""
+
+    def __init__(self, model: OnnxModel, max_batch_size: int, batch_window_ms: float):
+        self.model = model
+        self.batcher = LayoutBatcher(model, max_batch_size, batch_window_ms)
+        # 提前渲染并排队的页数，使单个文档的相邻页面也能合并推理
+        self.lookahead = self.batcher.max_batch_size
+
+    @property
+    def stride(self) -> int:
+        return self.model.stride
+
+    def handle_document(self, pages, mupdf_doc, translate_config, save_debug_image):
+        page_iter = iter(pages)
+        pending = collections.deque()
+
+        def submit_next() -> bool:
+            page = next(page_iter, None)
+            if page is None:
+                return False
+            translate_config.raise_if_cancelled()
+            # pymupdf渲染不是线程安全的，与babeldoc一样串行渲染
+            with self.model.lock:
+                geometry = with_target_long_edge(
+                    mupdf_doc[page.page_number],
+                    72,
+                    LAYOUT_IMAGE_SIZE,
+                    normalize_rotation=True,
+                )
+            image = geometry.image[:, :, ::-1]
+            pending.append((page, image, self.batcher.submit(image, geometry)))
+            return True
+
+        while len(pending) < self.lookahead and submit_next():
+            pass
+        while pending:
+            page, image, future = pending.popleft()
+            result = future.result()
+            submit_next()
+            save_debug_image(image, result, page.page_number + 1)
+            yield page, result
+
+    def stats(self) -> Dict[str, Any]:
+        return self.batcher.stats()
+
+
+def load_layout_model(layout_settings: Dict[str, Any]) -> BatchedLayoutModel:
+    """加载版面分析模型，按配置设置ONNX Runtime线程数并启用批量推理"""
+    model = DocLayoutModel.load_onnx()
+    intra_op_threads = layout_settings["intra_op_threads"]
+    inter_op_threads = layout_settings["inter_op_threads"]
+    providers = model.model.get_providers()
+    if (intra_op_threads or inter_op_threads) and "CoreMLExecutionProvider" not in providers:
+        options = onnxruntime.SessionOptions()
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads:
+            options.inter_op_num_threads = inter_op_threads
+            if inter_op_threads > 1:
+                options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+        model.model = onnxruntime.InferenceSession(model.model_path, sess_options=options, providers=providers)
+        logger.info(f"Layout model session: intra_op_threads={intra_op_threads or 'default'}, inter_op_threads={inter_op_threads or 'default'}")
+    return BatchedLayoutModel(model, layout_settings["batch_size"], layout_settings["batch_window_ms"])
@@ -0,0 +1,210 @@
+"""
+LLM用量统计
+
+每个翻译器（任务的一个目标语言）带一个UsageMeter，统计：
+- requests / cache_hits：翻译请求数与命中翻译缓存数（babeldoc翻译器自带的计数）
+- shared_calls：与进行中的相同请求共用结果而省去的调用数
+- llm_calls：实际发出的HTTP请求数，含openai SDK、babeldoc与接口池的重试；合并请求按提示词长度分摊，可为小数
+- retries：被限流（429）、服务端出错（5xx）或连接失败而需要重试的请求数
+- errors：重试后仍以错误结束的调用数
+- prompt_tokens / completion_tokens / total_tokens：token用量（babeldoc翻译器自带；合并请求按提示词长度分摊）
+- rate_limit_wait_seconds：等待QPS配额的时间（babeldoc的全局限流、接口池各接口的限流、合并请求的排队）
+
+babeldoc在自己的线程池中调用翻译器，限流等待与HTTP请求都发生在调用线程里：翻译器
+调用期间把本线程的当前UsageMeter记在线程局部变量中，限流器与httpx的事件钩子据此计数。
+统计快照随流水线事件带回服务进程，由服务进程汇总为任务与全局用量。
+"""
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import httpx
+import openai
+
+from babeldoc.translator import translator as babeldoc_translator
+from babeldoc.translator.translator import RateLimiter
+
+# 合并多个快照时相加的字段
+SUM_FIELDS = (
+    "requests", "cache_hits", "shared_calls", "llm_calls", "retries", "errors",
+    "prompt_tokens", "completion_tokens", "total_tokens", "rate_limit_wait_seconds",
+)
+# openai SDK会重试的响应状态码（另有全部5xx）
+RETRIED_STATUS_CODES = {408, 409, 429}
+
+active = threading.local()
+install_lock = threading.Lock()
+
+
+class UsageMeter:
+    def __init__(self, translator):
+        self.translator = translator
+        self.lock = threading.Lock()
+        self.llm_calls = 0.0
+        self.retries = 0
+        self.errors = 0
+        self.rate_limit_wait = 0.0
+        self.started = time.monotonic()
+
+    def add(self, llm_calls: float = 0.0, retries: int = 0, errors: int = 0, rate_limit_wait: float = 0.0):
+        with self.lock:
+            self.llm_calls += llm_calls
+            self.retries += retries
+            self.errors += errors
+            self.rate_limit_wait += rate_limit_wait
+
+    def snapshot(self) -> Dict[str, Any]:
+        translator = self.translator
+        with self.lock:
+            return {
+                "requests": translator.translate_call_count,
+                "cache_hits": translator.translate_cache_call_count,
+                "shared_calls": getattr(translator, "dedup_saved_count", 0),
+                "llm_calls": round(self.llm_calls, 2),
+                "retries": self.retries,
+                "errors": self.errors,
+                "prompt_tokens": translator.prompt_token_count.value,
+                "completion_tokens": translator.completion_token_count.value,
+                "total_tokens": translator.token_count.value,
+                "rate_limit_wait_seconds": round(self.rate_limit_wait, 3),
+                "elapsed_seconds": round(time.monotonic() - self.started, 3),
+            }
+
+
+def merge(snapshots: List[Dict[str, Any]], parallel: bool = True) -> Dict[str, Any]:
+    """
+    汇总多个快照。parallel为True时各快照视为同一任务中并行执行的部分，耗时取最大值，
+    并给出每秒token数；否则（全局汇总）不计耗时
+    """
+    merged: Dict[str, Any] = {field: 0 for field in SUM_FIELDS}
+    for snapshot in snapshots:
+        for field in SUM_FIELDS:
+            merged[field] += snapshot.get(field, 0)
+    merged["llm_calls"] = round(merged["llm_calls"], 2)
+    merged["rate_limit_wait_seconds"] = round(merged["rate_limit_wait_seconds"], 3)
+    if parallel:
+        elapsed = max((snapshot.get("elapsed_seconds", 0) for snapshot in snapshots), default=0)
+        merged["elapsed_seconds"] = elapsed
+        merged["tokens_per_second"] = round(merged["total_tokens"] / elapsed, 1) if elapsed else None
+    return merged
+
+
+def on_request(request: httpx.Request):
+    charge_current(llm_calls=1)
+
+
+def on_response(response: httpx.Response):
+    if response.status_code in RETRIED_STATUS_CODES or response.status_code >= 500:
+        charge_current(retries=1)
+
+
+def instrument(http_client: httpx.Client) -> httpx.Client:
+    """在httpx客户端上挂事件钩子，每个HTTP请求与需要重试的响应计入调用线程当前的UsageMeter"""
+    http_client.event_hooks["request"].append(on_request)
+    http_client.event_hooks["response"].append(on_response)
+    return http_client
+
+
+class MeteredClient:
+    """包装翻译器的client（openai.OpenAI或接口池）：调用期间以本翻译器的UsageMeter计数"""
+
+    def __init__(self, client, meter: UsageMeter):
+        self.inner = client
+        self.meter = meter
+        self.chat = self
+        self.completions = self
+
+    def create(self, **kwargs):
+        with metering(self.meter):
+            try:
+                return self.inner.chat.completions.create(**kwargs)
+            except openai.RateLimitError:
+                # 已由响应钩子计为重试，babeldoc按指数退避再次调用
+                raise
+            except Exception:
+                self.meter.add(errors=1)
+                raise
+
+
+def unmetered(client):
+    """取被MeteredClient包装的client；合并请求自行按比例分摊用量"""
+    return client.inner if isinstance(client, MeteredClient) else client
+
+
+class MeteredRateLimiter(RateLimiter):
+    """等待时间计入调用线程当前的UsageMeter"""
+
+    def wait(self, _rate_limit_params: dict = None):
+        started = time.monotonic()
+        super().wait(_rate_limit_params)
+        charge_current(rate_limit_wait=time.monotonic() - started)
+
+
+@contextmanager
+def metering(meter: Optional[UsageMeter]) -> Iterator[None]:
+    previous = getattr(active, "meter", None)
+    active.meter = meter
+    try:
+        yield
+    finally:
+        active.meter = previous
+
+
+def charge(translator, **deltas):
+    """计入翻译器的UsageMeter（未统计的翻译器忽略）"""
+    meter = getattr(translator, "usage", None)
+    if meter:
+        meter.add(**deltas)
+
+
+def charge_current(**deltas):
+    """计入调用线程当前的UsageMeter"""
+    meter = getattr(active, "meter", None)
+    if meter:
+        meter.add(**deltas)
+
+
+class UsageMeteredTranslator:
+    """翻译器混入类，须放在最前：调用期间把本翻译器的UsageMeter设为线程当前的统计对象"""
+
+    usage: Optional[UsageMeter] = None
+
+    def translate(self, text, ignore_cache=False, rate_limit_params: dict = None):
+        with metering(self.usage):
+            return super().translate(text, ignore_cache, rate_limit_params)
+
+    def llm_translate(self, text, ignore_cache=False, rate_limit_params: dict = None):
+        with metering(self.usage):
+            return super().llm_translate(text, ignore_cache, rate_limit_params)
+
+
+@functools.lru_cache(maxsize=None)
+def with_usage_meter(translator_class: type) -> type:
+    """返回在translator_class上混入UsageMeteredTranslator的子类"""
+    return type(f"UsageMetered{translator_class.__name__}", (UsageMeteredTranslator, translator_class), {})
+
+
+def attach(translator) -> UsageMeter:
+    """给翻译器装上UsageMeter，并包装其client；接口池的各接口客户端创建时已挂好钩子"""
+    install()
+    meter = UsageMeter(translator)
+    translator.usage = meter
+    client = translator.client
+    if isinstance(client, openai.OpenAI):
+        # 与babeldoc创建的客户端相同的连接设置
+        client = client.copy(http_client=instrument(httpx.Client(
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=None),
+            timeout=600,
+        )))
+    translator.client = MeteredClient(client, meter)
+    return meter
+
+
+def install():
+    """把babeldoc的全局限流器换成计时的版本，保留当前QPS"""
+    with install_lock:
+        current = babeldoc_translator._translate_rate_limiter
+        if not isinstance(current, MeteredRateLimiter):
+            babeldoc_translator._translate_rate_limiter = MeteredRateLimiter(current.max_qps)
@@ -0,0 +1,172 @@
+"""
+异步结构化日志
+
+日志调用方（事件循环、流水线线程）只做级别判断、补充任务上下文与采样，然后把
+LogRecord放入内存队列；格式化、JSON序列化与写文件都在QueueListener的后台线程中
+进行，不占用事件循环。
+
+每条记录写成一行JSON，带有task_id与stage字段：显式传入的extra优先，否则取当前
+任务trace中活动的span。日志文件按大小或时间轮转。带progress字段的进度日志按
+(task_id, lang_out, stage)采样，同一阶段在采样间隔内只保留第一条。
+
+工作进程的日志经outbox转发给服务进程，与服务进程的日志写入同一个文件。
+MCP服务使用同一套日志管道。
+"""
+import collections
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import task_trace
+
+# 工作进程中当前任务的ID（服务进程内由task_trace.current_span提供）
+current_task_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_task_id", default=None)
+
+# LogRecord自带的属性，其余属性视为extra写入JSON
+RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime", "taskName"}
+# 进度采样记住的(task_id, stage)数量上限
+SAMPLER_MAX_KEYS = 10000
+
+
+class TaskContextFilter(logging.Filter):
+    """在调用方线程中补充task_id与stage"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        span = task_trace.current_span.get()
+        if not hasattr(record, "task_id"):
+            record.task_id = span.trace.task_id if span else current_task_id.get()
+        if not hasattr(record, "stage") and span:
+            record.stage = span.name
+        return True
+
+
+class ProgressSampler(logging.Filter):
+    """同一任务同一阶段的进度日志在interval秒内只放行一条"""
+
+    def __init__(self, interval: float):
+        super().__init__()
+        self.interval = interval
+        self.last_emitted: "collections.OrderedDict[tuple, float]" = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.interval <= 0 or not hasattr(record, "progress"):
+            return True
+        key = (getattr(record, "task_id", None), getattr(record, "lang_out", None), getattr(record, "stage", None))
+        now = time.monotonic()
+        with self.lock:
+            last = self.last_emitted.get(key)
+            if last is not None and now - last < self.interval:
+                return False
+            self.last_emitted[key] = now
+            self.last_emitted.move_to_end(key)
+            if len(self.last_emitted) > SAMPLER_MAX_KEYS:
+                self.last_emitted.popitem(last=False)
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """不在调用方格式化消息，记录原样入队，由监听线程格式化"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "task_id": getattr(record, "task_id", None),
+            "stage": getattr(record, "stage", None),
+            "process": record.process,
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RotatingLogFileHandler(logging.handlers.RotatingFileHandler):
+    """文件超过max_bytes或距上次轮转超过rotate_seconds时轮转，保留backup_count个旧文件"""
+
+    def __init__(self, filename: str, max_bytes: int, rotate_seconds: float, backup_count: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.rotate_seconds = rotate_seconds
+        self.rollover_at = time.time() + rotate_seconds if rotate_seconds > 0 else None
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+                return True
+            self.rollover_at = time.time() + self.rotate_seconds
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        super().doRollover()
+        if self.rollover_at is not None:
+            self.rollover_at = time.time() + self.rotate_seconds
+
+
+def setup(log_file: Optional[str], settings: Dict[str, Any]) -> logging.handlers.QueueListener:
+    """在根logger上安装队列日志：JSON写入log_file（为空时不写文件），文本输出到stderr，返回已启动的监听器"""
+    console_handler = logging.StreamHandler(sys.stderr)
+    console_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    handlers = [console_handler]
+    if log_file:
+        os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+        file_handler = RotatingLogFileHandler(
+            log_file,
+            settings["max_bytes"],
+            settings["rotate_seconds"],
+            settings["backup_count"],
+        )
+        file_handler.setFormatter(JsonFormatter())
+        handlers.insert(0, file_handler)
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(TaskContextFilter())
+    queue_handler.addFilter(ProgressSampler(settings["progress_interval"]))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(settings["level"])
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class OutboxHandler(logging.handlers.QueueHandler):
+    """工作进程中使用：消息与异常在本进程中格式化后，以("log", record)经outbox发给服务进程"""
+
+    def enqueue(self, record: logging.LogRecord):
+        self.queue.put_nowait(("log", record))
+
+
+def forward_to(outbox, level: str):
+    """把工作进程的日志转发给服务进程"""
+    handler = OutboxHandler(outbox)
+    handler.addFilter(TaskContextFilter())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
@@ -0,0 +1,142 @@
+"""
+PDF预检
+
+只读取xref/trailer与页面树（不渲染、不解压内容流），毫秒级得出页数、加密状态、
+文本/图片比例，并估算token数、LLM调用数与耗时，供提交前的成本/耗时预估与准入判断。
+API服务与MCP服务共用。
+"""
+import math
+import mmap
+import time
+from pathlib import Path
+from typing import Any, Dict
+
+# 预检估算参数（经验值，只用于成本/耗时预估与准入判断）
+ANALYZE_CHARS_PER_COMPRESSED_BYTE = 1.0  # 压缩内容流每字节约对应的正文字符数
+ANALYZE_CHARS_PER_RAW_BYTE = 0.2         # 未压缩内容流每字节约对应的正文字符数
+ANALYZE_TOKENS_PER_LLM_CALL = 200        # BabelDOC每次LLM请求约打包200 token的段落
+ANALYZE_LLM_CALL_FACTOR = 2              # 术语自动提取会再过一遍全文
+ANALYZE_SECONDS_PER_PAGE = 1.0           # 解析、布局识别与排版的CPU耗时（秒/页）
+ANALYZE_SCANNED_PAGE_RATIO = 0.8         # 纯图片页占比超过该值视为扫描件
+CJK_LANGS = ("zh", "ja", "ko")
+
+
+def analyze_pdf_file(file_path: Path, lang_in: str, qps: float) -> Dict[str, Any]:
+    """
+    预检PDF文件：通过mmap只读取xref/trailer和页面树，不渲染、不解压内容流
+
+    Args:
+        file_path: 文件路径
+        lang_in: 源语言代码，用于估算token数
+        qps: 每秒请求数限制，用于估算耗时
+
+    Returns:
+        dict: 页数、加密状态、文本/图片比例、token与耗时估算、是否需要ocr_workaround；
+              valid为False时error说明拒绝原因
+    """
+    # 在调用时导入BabelDOC的pdfminer，未安装BabelDOC的委托模式MCP服务也能导入本模块
+    from babeldoc.pdfminer.pdfdocument import PDFDocument, PDFPasswordIncorrect
+    from babeldoc.pdfminer.pdfpage import PDFPage
+    from babeldoc.pdfminer.pdfparser import PDFParser
+    from babeldoc.pdfminer.psparser import literal_name
+    from babeldoc.pdfminer.pdftypes import PDFStream, resolve1
+
+    started = time.perf_counter()
+    analysis: Dict[str, Any] = {
+        "valid": False,
+        "error": None,
+        "file_size": 0,
+        "page_count": 0,
+        "encrypted": False,
+        "password_required": False,
+        "xref_repaired": False,
+        "text_pages": 0,
+        "image_only_pages": 0,
+        "text_ratio": 0.0,
+        "estimated_tokens": 0,
+        "estimated_llm_calls": 0,
+        "estimated_seconds": 0.0,
+        "needs_ocr_workaround": False,
+    }
+    try:
+        analysis["file_size"] = file_path.stat().st_size
+        if analysis["file_size"] == 0:
+            analysis["error"] = "文件为空"
+            return analysis
+
+        estimated_chars = 0.0
+        with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm.find(b"%PDF-", 0, 1024) == -1:
+                analysis["error"] = "文件不是有效的PDF格式"
+                return analysis
+
+            parser = PDFParser(mm)
+            try:
+                document = PDFDocument(parser)
+            except PDFPasswordIncorrect:
+                analysis["encrypted"] = True
+                analysis["password_required"] = True
+                analysis["error"] = "PDF已加密，需要密码才能打开"
+                return analysis
+
+            analysis["encrypted"] = document.encryption is not None
+            analysis["xref_repaired"] = parser.fallback
+
+            for page in PDFPage.create_pages(document):
+                analysis["page_count"] += 1
+                try:
+                    resources = resolve1(page.resources) or {}
+                    has_fonts = bool(resolve1(resources.get("Font")))
+                    has_images = False
+                    for xobject in (resolve1(resources.get("XObject")) or {}).values():
+                        xobject = resolve1(xobject)
+                        if not isinstance(xobject, PDFStream):
+                            continue
+                        subtype = literal_name(xobject.attrs.get("Subtype"))
+                        if subtype == "Image":
+                            has_images = True
+                        elif subtype == "Form":
+                            form_resources = resolve1(xobject.attrs.get("Resources")) or {}
+                            has_fonts = has_fonts or bool(resolve1(form_resources.get("Font")))
+
+                    # 只读取内容流字典中的Length，不解压数据
+                    page_chars = 0.0
+                    for stream in page.contents:
+                        stream = resolve1(stream)
+                        if not isinstance(stream, PDFStream):
+                            continue
+                        length = resolve1(stream.attrs.get("Length")) or 0
+                        if stream.attrs.get("Filter"):
+                            page_chars += length * ANALYZE_CHARS_PER_COMPRESSED_BYTE
+                        else:
+                            page_chars += length * ANALYZE_CHARS_PER_RAW_BYTE
+                except Exception:
+                    continue
+
+                if has_fonts:
+                    analysis["text_pages"] += 1
+                    estimated_chars += page_chars
+                elif has_images:
+                    analysis["image_only_pages"] += 1
+
+        page_count = analysis["page_count"]
+        if page_count == 0:
+            analysis["error"] = "PDF中没有可识别的页面"
+            return analysis
+
+        chars_per_token = 1.5 if lang_in.lower().startswith(CJK_LANGS) else 4.0
+        estimated_tokens = int(estimated_chars / chars_per_token)
+        estimated_llm_calls = math.ceil(estimated_tokens / ANALYZE_TOKENS_PER_LLM_CALL) * ANALYZE_LLM_CALL_FACTOR
+
+        analysis["valid"] = True
+        analysis["text_ratio"] = round(analysis["text_pages"] / page_count, 3)
+        analysis["needs_ocr_workaround"] = analysis["image_only_pages"] / page_count >= ANALYZE_SCANNED_PAGE_RATIO
+        analysis["estimated_tokens"] = estimated_tokens
+        analysis["estimated_llm_calls"] = estimated_llm_calls
+        analysis["estimated_seconds"] = round(estimated_llm_calls / qps + page_count * ANALYZE_SECONDS_PER_PAGE, 1)
+        return analysis
+    except Exception as e:
+        analysis["error"] = f"PDF结构损坏，无法解析: {str(e)}"
+        return analysis
+    finally:
+        analysis["analysis_ms"] = round((time.perf_counter() - started) * 1000, 2)
@@ -0,0 +1,148 @@
+"""
+输出PDF优化
+
+翻译结果（尤其是双语PDF）常为原文件的两三倍大，下载与上传都要为此付出带宽、存储与时间。
+流水线完成后，结果文件交给独立的优化进程池重新保存：
+- garbage=4合并内容相同的对象（重复嵌入的字体、图片），并删除未引用的对象
+- 压缩未压缩的内容流、图片与字体，小对象打包进对象流（object stream）
+- 可选线性化（Fast Web View），浏览器可在下载完成前显示首页。MuPDF已不支持线性化，
+  由qpdf命令行完成，未安装qpdf时跳过
+
+优化结果写入临时文件，比原文件小时才替换原文件，否则保留原文件。PDF重写是CPU密集的
+操作，默认放在进程池中执行，不占用服务进程的GIL；调用方也可以传入自己的执行器。
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+
+logger = logging.getLogger(__name__)
+
+# 汇总统计中相加的字段
+COUNTERS = ("files", "optimized", "kept_original", "errors", "original_bytes", "output_bytes")
+
+
+def optimize_file(path: str, linearize: bool) -> Dict[str, Any]:
+    """在优化进程中执行：重写path，变小时替换原文件，返回优化前后的大小"""
+    # PyMuPDF随BabelDOC安装，在调用时导入，未安装BabelDOC的委托模式MCP服务也能导入本模块
+    import pymupdf
+
+    started = time.monotonic()
+    source = Path(path)
+    optimized = source.with_name(f"{source.stem}.optimized.pdf")
+    linearized_path = source.with_name(f"{source.stem}.linearized.pdf")
+    original_bytes = source.stat().st_size
+    try:
+        with pymupdf.open(source) as doc:
+            doc.save(
+                optimized,
+                garbage=4,
+                deflate=True,
+                deflate_images=True,
+                deflate_fonts=True,
+                use_objstms=1,
+            )
+        linearized = False
+        if linearize:
+            subprocess.run(
+                ["qpdf", "--linearize", "--object-streams=generate", str(optimized), str(linearized_path)],
+                check=True,
+                capture_output=True,
+                timeout=600,
+            )
+            os.replace(linearized_path, optimized)
+            linearized = True
+        optimized_bytes = optimized.stat().st_size
+        kept_original = optimized_bytes >= original_bytes
+        if not kept_original:
+            os.replace(optimized, source)
+    finally:
+        optimized.unlink(missing_ok=True)
+        linearized_path.unlink(missing_ok=True)
+    return {
+        "original_bytes": original_bytes,
+        "optimized_bytes": optimized_bytes,
+        "output_bytes": original_bytes if kept_original else optimized_bytes,
+        "kept_original": kept_original,
+        "linearized": linearized and not kept_original,
+        "seconds": round(time.monotonic() - started, 3),
+    }
+
+
+class PdfOptimizer:
+    def __init__(self, settings: Dict[str, Any], executor: Optional[Executor] = None):
+        """executor为空时使用独立的优化进程池"""
+        self.workers = settings["workers"]
+        self.linearize = settings["linearize"]
+        if self.linearize and not shutil.which("qpdf"):
+            logger.warning("PDF_OPTIMIZE_LINEARIZE is set but qpdf is not installed, skipping linearization")
+            self.linearize = False
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.totals = {counter: 0 for counter in COUNTERS}
+
+    def get_executor(self) -> Executor:
+        # 与翻译工作进程相同，优先由forkserver创建进程
+        if self.executor is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+        return self.executor
+
+    def start(self):
+        """预先启动优化进程，首个任务完成时无需等待进程启动与导入"""
+        self.get_executor().submit(os.getpid)
+
+    async def optimize(self, result_files: Dict[str, str]) -> Dict[str, Dict[str, Any]]:
+        """并行优化一个任务的结果文件，返回各文件的优化结果；出错的文件保持原样"""
+        loop = asyncio.get_running_loop()
+        executor = self.get_executor()
+        futures = {
+            file_type: loop.run_in_executor(executor, optimize_file, path, self.linearize)
+            for file_type, path in result_files.items()
+        }
+        report = {}
+        for file_type, future in futures.items():
+            try:
+                report[file_type] = await future
+            except BrokenProcessPool as e:
+                # 优化进程意外退出（如内存不足被杀）后进程池不可再用，下次调用时重建
+                logger.warning(f"Failed to optimize {result_files[file_type]}: {e}")
+                report[file_type] = {"error": f"{type(e).__name__}: {e}"[:200]}
+                if self.executor is executor:
+                    self.executor = None
+                    executor.shutdown(wait=False)
+            except Exception as e:
+                logger.warning(f"Failed to optimize {result_files[file_type]}: {e}")
+                report[file_type] = {"error": f"{type(e).__name__}: {e}"[:200]}
+            self.record(report[file_type])
+        return report
+
+    def record(self, result: Dict[str, Any]):
+        with self.lock:
+            self.totals["files"] += 1
+            if "error" in result:
+                self.totals["errors"] += 1
+                return
+            self.totals["kept_original" if result["kept_original"] else "optimized"] += 1
+            self.totals["original_bytes"] += result["original_bytes"]
+            self.totals["output_bytes"] += result["output_bytes"]
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            totals = dict(self.totals)
+        totals["saved_ratio"] = round(1 - totals["output_bytes"] / totals["original_bytes"], 3) if totals["original_bytes"] else None
+        totals["linearize"] = self.linearize
+        return totals
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
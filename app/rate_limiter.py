@@ -0,0 +1,65 @@
+"""
+工作进程共用的QPS限流
+
+babeldoc的RateLimiter只在一个进程内有效。使用工作进程池时，服务进程创建共享状态
+（下一个请求的最早发送时间与请求间隔），随启动参数传给各工作进程，各进程的翻译线程
+按同一个时间表领取发送时间：整个服务的请求速率不超过QPS，只有一个任务运行时也能
+用满全部QPS。与在服务进程内执行时一样，任务的qps参数设置的是全局的请求间隔。
+各翻译接口（OPENAI_ENDPOINTS）的QPS配额同样在进程间共享。
+
+time.monotonic在Linux上是系统范围的时钟，不同进程取得的时间可以直接比较。
+"""
+import time
+from typing import Any, Dict
+
+from babeldoc.translator import translator as babeldoc_translator
+
+import llm_usage
+
+
+def create_state(context, max_qps: float):
+    """在服务进程中创建共享状态：[下一个请求的最早发送时间, 请求间隔]"""
+    return context.Array("d", [0.0, 1.0 / max_qps])
+
+
+def create_states(context, settings: Dict[str, Any]) -> Dict[str, Any]:
+    """服务的全局QPS与各翻译接口的QPS配额"""
+    return {
+        "translate": create_state(context, settings["server"]["qps"]),
+        "endpoints": {
+            endpoint["name"]: create_state(context, endpoint["qps"])
+            for endpoint in settings["endpoints"]["endpoints"]
+        },
+    }
+
+
+class SharedRateLimiter(llm_usage.MeteredRateLimiter):
+    """接口与babeldoc的RateLimiter相同，状态在进程间共享；等待时间计入调用线程当前的UsageMeter"""
+
+    def __init__(self, state):
+        self.state = state
+
+    @property
+    def max_qps(self) -> float:
+        return 1.0 / self.state[1]
+
+    def wait(self, _rate_limit_params: dict = None):
+        # 在锁内领取发送时间、在锁外等待，其他进程的线程不必排队等锁
+        with self.state.get_lock():
+            now = time.monotonic()
+            send_at = max(self.state[0], now)
+            self.state[0] = send_at + self.state[1]
+        if send_at > now:
+            time.sleep(send_at - now)
+        llm_usage.charge_current(rate_limit_wait=send_at - now)
+
+    def set_max_qps(self, max_qps: float):
+        if max_qps <= 0:
+            raise ValueError("max_qps must be a positive number")
+        with self.state.get_lock():
+            self.state[1] = 1.0 / max_qps
+
+
+def install(state):
+    """工作进程启动时把babeldoc的全局限流器换成共享的版本"""
+    babeldoc_translator._translate_rate_limiter = SharedRateLimiter(state)
@@ -0,0 +1,355 @@
+"""
+LLM请求合并
+
+在服务商QPS上限下，吞吐受请求数而非token数限制。babeldoc只在同一页内把段落
+合并成一次请求，页面上只有少量短段落、图注、表格单元格时，每页仍各占一次请求；
+JSON解析失败后的逐段回退也是一段一次请求。
+
+PackingTranslator在翻译器与OpenAI兼容接口之间加一层：内容较短的请求不直接发送，
+而是交给进程内共用的RequestPacker。合并线程每拿到一个QPS配额，就把这段时间里
+各任务（同一模型与接口）排队的短请求按token预算拼成一个结构化提示词一次发出，
+再按id拆分、逐个校验响应；整体解析失败或个别响应不合格时，相应请求回退为
+单独调用。缓存的读写与babeldoc相同，命中缓存的请求不进入合并。所属任务已取消
+的请求在组包前移出队列，不再占用配额。
+"""
+import itertools
+import json
+import logging
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import openai
+from tenacity import before_sleep_log, retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+from babeldoc.translator import translator as babeldoc_translator
+from babeldoc.translator.translator import OpenAITranslator
+
+import llm_usage
+
+logger = logging.getLogger(__name__)
+
+PACK_SYSTEM_PROMPT = (
+    "You are a professional, authentic machine translation engine. "
+    "You will receive a JSON array of independent requests, each with an id and a prompt. "
+    "Handle every prompt on its own, exactly as if it had been sent alone, and follow its instructions. "
+    "Reply with a single JSON object and nothing else: "
+    '{"responses": [{"id": <id>, "output": <your reply to that prompt>}]}. '
+    "Include one response for every id. When a prompt asks for JSON output, put that JSON value in output "
+    "directly; otherwise output is a string."
+)
+JSON_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数（宁多勿少）：ASCII字符按4个一个token，其余字符各一个token"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+class Segment:
+    def __init__(self, translator: "PackingTranslator", kind: str, text: str, rate_limit_params: Optional[Dict[str, Any]]):
+        self.translator = translator
+        self.kind = kind  # translate: 纯文本翻译；llm: babeldoc构造的完整提示词
+        self.text = text
+        self.rate_limit_params = rate_limit_params or {}
+        self.json_mode = kind == "llm" and bool(self.rate_limit_params.get("request_json_mode"))
+        self.prompt = text if kind == "llm" else translator.prompt(text)[1]["content"]
+        self.tokens = estimate_tokens(self.prompt)
+        self.cancel_event = translator.cancel_event
+        self.future: Future = Future()
+        self.enqueued = time.monotonic()
+
+    def cancelled(self) -> bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def call_single(self) -> str:
+        """单独发送（调用方已取得QPS配额）"""
+        if self.kind == "llm":
+            return self.translator.do_llm_translate(self.text, self.rate_limit_params)
+        return self.translator.do_translate(self.text, self.rate_limit_params)
+
+
+class RequestPacker:
+    """进程内共用的合并器：后台线程按QPS配额取出排队的短请求，合并后交给发送线程池"""
+
+    def __init__(self, settings: Dict[str, Any]):
+        self.max_tokens = settings["max_tokens"]
+        self.max_segments = settings["max_segments"]
+        self.segment_max_tokens = settings["segment_max_tokens"]
+        self.max_output_tokens = settings["max_output_tokens"]
+        self.window = settings["window_ms"] / 1000
+        self.pending: deque = deque()
+        self.pending_tokens = 0
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=settings["max_inflight"], thread_name_prefix="llm-pack")
+        self.request_ids = itertools.count()
+        self.requests = 0
+        self.segments = 0
+        self.packed_segments = 0
+        self.fallback_segments = 0
+        self.cancelled_segments = 0
+        self.thread = threading.Thread(target=self.serve, name="llm-packer", daemon=True)
+        self.thread.start()
+
+    def accepts(self, translator: "PackingTranslator", kind: str, text: str, rate_limit_params: Optional[Dict[str, Any]]) -> bool:
+        """只合并内容较短的请求；llm请求以babeldoc给出的段落token数衡量"""
+        if text is None:
+            return False
+        content_tokens = (rate_limit_params or {}).get("paragraph_token_count") if kind == "llm" else None
+        return (content_tokens or estimate_tokens(text)) <= self.segment_max_tokens
+
+    def submit(self, segment: Segment) -> str:
+        with self.condition:
+            self.pending.append(segment)
+            self.pending_tokens += segment.tokens
+            self.condition.notify()
+        return segment.future.result()
+
+    def serve(self):
+        while True:
+            with self.condition:
+                self.drop_cancelled()
+                while not self.pending:
+                    self.condition.wait()
+            # 先取得QPS配额；等待配额期间到达的请求一并合并
+            babeldoc_translator._translate_rate_limiter.wait()
+            with self.condition:
+                if self.window > 0:
+                    self.condition.wait_for(
+                        lambda: self.pending_tokens >= self.max_tokens or len(self.pending) >= self.max_segments,
+                        timeout=self.window,
+                    )
+                # 等待配额与合并窗口期间任务可能已取消
+                self.drop_cancelled()
+                if not self.pending:
+                    continue
+                pack = self.take_pack()
+                self.requests += 1
+                self.segments += len(pack)
+            self.executor.submit(self.send, pack)
+
+    def drop_cancelled(self):
+        """移除所属任务已取消的请求，其调用方得到CancelledError"""
+        if not any(segment.cancelled() for segment in self.pending):
+            return
+        remaining = deque()
+        for segment in self.pending:
+            if segment.cancelled():
+                segment.future.cancel()
+                self.cancelled_segments += 1
+            else:
+                remaining.append(segment)
+        self.pending = remaining
+        self.pending_tokens = sum(segment.tokens for segment in remaining)
+
+    def take_pack(self) -> List[Segment]:
+        """从队首起取出与首个请求同一接口的请求，直到达到token预算或数量上限"""
+        first = self.pending.popleft()
+        pack = [first]
+        tokens = first.tokens
+        remaining = deque()
+        while self.pending:
+            segment = self.pending.popleft()
+            if (
+                len(pack) < self.max_segments
+                and tokens + segment.tokens <= self.max_tokens
+                and segment.translator.endpoint_key == first.translator.endpoint_key
+            ):
+                pack.append(segment)
+                tokens += segment.tokens
+            else:
+                remaining.append(segment)
+        self.pending = remaining
+        self.pending_tokens = sum(segment.tokens for segment in remaining)
+        return pack
+
+    def send(self, pack: List[Segment]):
+        # 排队等待QPS配额与合并窗口的时间计入各请求所属任务
+        now = time.monotonic()
+        for segment in pack:
+            llm_usage.charge(segment.translator, rate_limit_wait=now - segment.enqueued)
+        if len(pack) == 1:
+            self.call_single(pack[0], acquired=True)
+            return
+        request_id = next(self.request_ids)
+        try:
+            outputs = self.request_pack(pack)
+        except Exception as e:
+            logger.warning(f"Packed request {request_id} with {len(pack)} segments failed, falling back to single calls: {e}")
+            outputs = {}
+        failed = []
+        for index, segment in enumerate(pack):
+            output = self.validate(segment, outputs.get(index))
+            if output is None:
+                failed.append(segment)
+            else:
+                segment.future.set_result(output)
+        with self.condition:
+            self.packed_segments += len(pack) - len(failed)
+            self.fallback_segments += len(failed)
+        if failed:
+            if outputs:
+                logger.info(f"Packed request {request_id}: {len(failed)}/{len(pack)} responses invalid, falling back to single calls")
+            for segment in failed:
+                self.executor.submit(self.call_single, segment)
+
+    def call_single(self, segment: Segment, acquired: bool = False):
+        try:
+            if not acquired:
+                # 回退的单独调用另占一次请求
+                with self.condition:
+                    self.requests += 1
+                babeldoc_translator._translate_rate_limiter.wait()
+            segment.future.set_result(segment.call_single())
+        except BaseException as e:
+            segment.future.set_exception(e)
+
+    @retry(
+        retry=retry_if_exception_type(openai.RateLimitError),
+        stop=stop_after_attempt(100),
+        wait=wait_exponential(multiplier=1, min=1, max=15),
+        before_sleep=before_sleep_log(logger, logging.WARNING),
+    )
+    def request_pack(self, pack: List[Segment]) -> Dict[int, Any]:
+        """一次请求发送整组提示词，返回id -> 响应"""
+        translator = pack[0].translator
+        options = dict(translator.options) if translator.send_temperature else {}
+        if translator.enable_json_mode_if_requested:
+            options["response_format"] = {"type": "json_object"}
+        try:
+            response = llm_usage.unmetered(translator.client).chat.completions.create(
+                model=translator.model,
+                **options,
+                max_tokens=self.max_output_tokens,
+                messages=[
+                    {"role": "system", "content": PACK_SYSTEM_PROMPT},
+                    {"role": "user", "content": json.dumps(
+                        [{"id": index, "prompt": segment.prompt} for index, segment in enumerate(pack)], ensure_ascii=False
+                    )},
+                ],
+                extra_body=translator.extra_body,
+            )
+        except Exception:
+            # 失败的合并调用（之后重试或回退为单独调用）计入首个请求所属的任务
+            llm_usage.charge(translator, llm_calls=1, retries=1)
+            raise
+        self.record_usage(pack, response)
+        content = JSON_FENCE.sub("", response.choices[0].message.content.strip())
+        parsed = json.loads(content)
+        items = parsed.get("responses") if isinstance(parsed, dict) else parsed
+        if not isinstance(items, list):
+            raise ValueError("response is not a list of outputs")
+        outputs = {}
+        for item in items:
+            if isinstance(item, dict) and "id" in item and "output" in item:
+                try:
+                    outputs[int(item["id"])] = item["output"]
+                except (TypeError, ValueError):
+                    continue
+        return outputs
+
+    @staticmethod
+    def validate(segment: Segment, output: Any) -> Optional[str]:
+        """校验并还原单个请求的响应，不合格返回None"""
+        if output is None:
+            return None
+        if segment.json_mode:
+            if isinstance(output, (dict, list)):
+                return json.dumps(output, ensure_ascii=False)
+            if not isinstance(output, str):
+                return None
+            try:
+                json.loads(JSON_FENCE.sub("", output.strip()))
+            except ValueError:
+                return None
+            return output.strip()
+        if not isinstance(output, str) or not output.strip():
+            return None
+        return output.strip()
+
+    @staticmethod
+    def record_usage(pack: List[Segment], response):
+        """按各请求的提示词长度把调用次数与token用量分摊到各自的翻译器"""
+        total = sum(segment.tokens for segment in pack)
+        for segment in pack:
+            llm_usage.charge(segment.translator, llm_calls=segment.tokens / total)
+        usage = getattr(response, "usage", None)
+        if not usage:
+            return
+        for segment in pack:
+            share = segment.tokens / total
+            counters = (
+                (segment.translator.token_count, usage.total_tokens),
+                (segment.translator.prompt_token_count, usage.prompt_tokens),
+                (segment.translator.completion_token_count, usage.completion_tokens),
+            )
+            for counter, value in counters:
+                if value:
+                    counter.inc(round(value * share))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "segments": self.segments,
+            "packed_segments": self.packed_segments,
+            "fallback_segments": self.fallback_segments,
+            "cancelled_segments": self.cancelled_segments,
+            "segments_per_request": round(self.segments / self.requests, 2) if self.requests else None,
+            "queued": len(self.pending),
+        }
+
+
+packer: Optional[RequestPacker] = None
+packer_lock = threading.Lock()
+
+
+def get_packer(settings: Dict[str, Any]) -> RequestPacker:
+    global packer
+    with packer_lock:
+        if packer is None:
+            packer = RequestPacker(settings)
+        return packer
+
+
+class PackingTranslator(OpenAITranslator):
+    """与OpenAITranslator相同，但短请求交给RequestPacker合并发送"""
+
+    def __init__(self, *args, packer: RequestPacker, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.packer = packer
+        self.cancel_event: Optional[threading.Event] = None  # 所属任务的取消事件，流水线开始执行时设置
+        self.endpoint_key = (self.model, str(self.client.base_url), self.client.api_key)
+
+    def translate(self, text, ignore_cache=False, rate_limit_params: dict = None):
+        if not self.packer.accepts(self, "translate", text, rate_limit_params):
+            return super().translate(text, ignore_cache, rate_limit_params)
+        return self.packed_translate("translate", text, ignore_cache, rate_limit_params)
+
+    def llm_translate(self, text, ignore_cache=False, rate_limit_params: dict = None):
+        if not self.packer.accepts(self, "llm", text, rate_limit_params):
+            return super().llm_translate(text, ignore_cache, rate_limit_params)
+        return self.packed_translate("llm", text, ignore_cache, rate_limit_params)
+
+    def packed_translate(self, kind: str, text: str, ignore_cache: bool, rate_limit_params: Optional[dict]) -> str:
+        """与BaseTranslator.translate的缓存逻辑相同，QPS配额由合并器按请求取得"""
+        self.translate_call_count += 1
+        use_cache = not (self.ignore_cache or ignore_cache)
+        if use_cache:
+            try:
+                cache = self.cache.get(text)
+                if cache is not None:
+                    self.translate_cache_call_count += 1
+                    return cache
+            except Exception as e:
+                logger.debug(f"try get cache failed, ignore it: {e}")
+        translation = self.packer.submit(Segment(self, kind, text, rate_limit_params))
+        if use_cache:
+            try:
+                self.cache.set(text, translation)
+            except Exception as e:
+                logger.debug(f"try set cache failed, ignore it: {e}")
+        return translation
@@ -0,0 +1,117 @@
+"""
+已译段落日志（翻译检查点）
+
+大文档翻译到一半时服务重启（部署、崩溃、内存不足被杀），已完成的翻译与已花费的LLM调用
+全部丢失。任务的working_dir中保存两类检查点：解析完成后的源文IR（见translate_pipeline），
+以及本模块的已译段落日志。
+
+SegmentJournal替换翻译器的翻译缓存对象：每次写入翻译缓存（即一次成功的翻译请求，含术语
+提取）时，同时以一行JSON追加到日志文件并写入操作系统，进程被杀也不会丢失；每隔interval秒
+fsync一次，防止机器掉电。读取缓存时先查日志。恢复的任务重新执行翻译阶段时，源文IR取自
+检查点，段落划分与请求内容和中断前相同，已翻译的请求直接从日志取得译文（计为缓存命中），
+只有剩余的段落调用LLM。
+
+全局翻译缓存同样可能命中这些请求，但它会被清理，也不一定在持久存储上；日志随任务的
+working_dir保存，任务结束后删除。
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+def load_entries(path: Path) -> Dict[str, str]:
+    """读取日志；进程被杀时最后一行可能不完整，跳过无法解析的行"""
+    entries = {}
+    if not path.exists():
+        return entries
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries[entry["k"]] = entry["t"]
+    return entries
+
+
+def ends_with_newline(path: Path) -> bool:
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+class SegmentJournal:
+    """包装babeldoc的TranslationCache，其余属性（translate_engine、add_params等）取自原缓存"""
+
+    def __init__(self, cache, path: Path, interval: float):
+        self.inner = cache
+        self.path = Path(path)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.entries = load_entries(self.path)
+        self.restored = len(self.entries)
+        self.hits = 0
+        self.file = open(self.path, "a", encoding="utf-8")
+        if self.file.tell() and not ends_with_newline(self.path):
+            # 结束被截断的最后一行，新记录从下一行开始
+            self.file.write("\n")
+        self.synced_at = time.monotonic()
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def key(self, original_text: str) -> str:
+        # 与翻译缓存相同的键：翻译引擎、影响译文的参数（模型、提示词等）与原文
+        raw = json.dumps([self.inner.translate_engine, self.inner.translate_engine_params, original_text], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, original_text: str):
+        translation = self.entries.get(self.key(original_text))
+        if translation is not None:
+            with self.lock:
+                self.hits += 1
+            return translation
+        return self.inner.get(original_text)
+
+    def set(self, original_text: str, translation: str):
+        key = self.key(original_text)
+        line = json.dumps({"k": key, "t": translation}, ensure_ascii=False)
+        with self.lock:
+            self.entries[key] = translation
+            self.file.write(line + "\n")
+            self.file.flush()
+            if time.monotonic() - self.synced_at >= self.interval:
+                os.fsync(self.file.fileno())
+                self.synced_at = time.monotonic()
+        self.inner.set(original_text, translation)
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+
+
+def attach(translator, path: Path, interval: float) -> SegmentJournal:
+    """给翻译器装上已译段落日志，已有日志时从中恢复"""
+    journal = SegmentJournal(translator.cache, path, interval)
+    translator.cache = journal
+    if journal.restored:
+        logger.info(f"Restored {journal.restored} translated segments from checkpoint {path}")
+    return journal
+
+
+def detach(translator, journal: SegmentJournal):
+    """刷写日志并恢复翻译器原来的缓存"""
+    journal.close()
+    translator.cache = journal.inner
+    if journal.restored:
+        logger.info(f"Reused {journal.hits} of {journal.restored} checkpointed segments")
@@ -0,0 +1,125 @@
+"""
+相同翻译请求的并发去重（single-flight）
+
+同一批相似文档并发翻译时，多个任务（以及同一任务各页重复的页眉、页脚）常在几秒内
+请求相同的段落。翻译缓存只在请求完成后写入，这些并发请求都会未命中缓存，各自调用
+一次LLM。
+
+SingleFlightTranslator混入翻译器类：同一进程内，原文、语言对、模型与提示词
+（即翻译缓存的键）以及限流参数都相同的请求在前一个请求仍在进行时，不再发送，而是等待进行中的
+那一次调用并共用其结果（翻译器出错时共用其异常）；结果照常写入缓存，之后的相同请求
+直接命中缓存。进行中的调用因其所属任务被取消（含超出token预算、内存超限被终止）而中止时，
+等待方不共用这个异常，由其中一个等待方自己发起调用。
+"""
+import functools
+import json
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderAborted(Exception):
+    """进行中的调用因其所属任务被中止而结束，等待方需要自己调用"""
+
+
+class SingleFlight:
+    """按键合并并发调用：同一键同时只执行一次，其余调用方等待并共用结果"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight: Dict[Tuple, Future] = {}
+        self.calls = 0
+        self.saved_calls = 0
+
+    def do(self, key: Tuple, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """返回(结果, 是否共用了进行中的调用)"""
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is None:
+                future = Future()
+                self.inflight[key] = future
+                self.calls += 1
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            error = future.exception()
+            if isinstance(error, LeaderAborted):
+                # 进行中的调用被中止，与本请求无关：重新竞争，由一个等待方自己调用
+                return self.do(key, fn)
+            with self.lock:
+                self.saved_calls += 1
+            if error is not None:
+                raise error
+            return future.result(), True
+        try:
+            result = fn()
+        except BaseException as e:
+            with self.lock:
+                self.inflight.pop(key, None)
+            if isinstance(e, Exception) and not isinstance(e, MemoryError):
+                # 翻译器的错误（接口出错、响应不合格等）与请求本身有关，等待方共用
+                future.set_exception(e)
+            else:
+                # 任务取消（含超出token预算、内存超限被终止）只中止领头方自己的任务
+                future.set_exception(LeaderAborted())
+            raise
+        # 结果已写入缓存，之后到达的相同请求直接命中缓存
+        with self.lock:
+            self.inflight.pop(key, None)
+        future.set_result(result)
+        return result, False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "saved_calls": self.saved_calls,
+            "inflight": len(self.inflight),
+        }
+
+
+flights = SingleFlight()
+
+
+class SingleFlightTranslator:
+    """翻译器混入类，须放在具体翻译器类之前"""
+
+    dedup_saved_count = 0
+
+    def translate(self, text, ignore_cache=False, rate_limit_params: dict = None):
+        call = functools.partial(super().translate, text, ignore_cache, rate_limit_params)
+        return self.single_flight("translate", text, ignore_cache, rate_limit_params, call)
+
+    def llm_translate(self, text, ignore_cache=False, rate_limit_params: dict = None):
+        call = functools.partial(super().llm_translate, text, ignore_cache, rate_limit_params)
+        return self.single_flight("llm", text, ignore_cache, rate_limit_params, call)
+
+    def single_flight(
+        self, kind: str, text: str, ignore_cache: bool, rate_limit_params: Optional[dict], call: Callable[[], str]
+    ) -> str:
+        # 不使用缓存时调用方要求重新翻译，不共用其他请求的结果
+        if self.ignore_cache or ignore_cache or text is None:
+            return call()
+        # 限流参数决定请求如何发送（是否要求JSON输出、按多少token计入配额、能否进入合并），
+        # 参数不同的请求各自调用，不共用对方的结果或错误
+        key = (
+            kind,
+            self.cache.translate_engine,
+            self.cache.translate_engine_params,
+            json.dumps(rate_limit_params or {}, sort_keys=True, default=str),
+            text,
+        )
+        translation, shared = flights.do(key, call)
+        if shared:
+            self.translate_call_count += 1
+            self.dedup_saved_count += 1
+        return translation
+
+
+@functools.lru_cache(maxsize=None)
+def with_single_flight(translator_class: type) -> type:
+    """返回在translator_class上混入SingleFlightTranslator的子类"""
+    return type(f"SingleFlight{translator_class.__name__}", (SingleFlightTranslator, translator_class), {})
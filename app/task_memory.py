@@ -0,0 +1,218 @@
+"""
+翻译任务的内存统计与准入控制
+
+每个任务启动前按预检结果估算内存占用，只有节点剩余内存放得下时才开始执行，
+否则保持排队；放不下整个节点预算的任务在提交时直接拒绝。
+
+任务运行期间定期采样RSS：在工作进程中运行的任务（登记了pid）读取这些进程及其
+子进程的RSS，只计入超出工作进程预热后基线的部分；各工作进程的基线（无论空闲
+与否）作为常驻开销从节点可用内存中扣除。在本进程线程中运行的任务无法单独测量，按各任务的估算占用
+比例分摊本进程超出空闲基线的部分。独立进程中的任务超出单任务上限即被终止；
+本进程中的任务只有一个时按上限终止，有多个时无法区分各自的占用，只在整个节点
+超出内存预算时终止估算占用最大的一个，以保住其他任务。
+"""
+import asyncio
+import logging
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# cgroup v2 / v1 的内存上限文件
+CGROUP_MEMORY_LIMIT_FILES = (
+    Path("/sys/fs/cgroup/memory.max"),
+    Path("/sys/fs/cgroup/memory/memory.limit_in_bytes"),
+)
+
+
+def read_cgroup_memory_limit() -> Optional[int]:
+    """读取容器的内存上限（字节），未限制时返回None"""
+    for limit_file in CGROUP_MEMORY_LIMIT_FILES:
+        try:
+            value = limit_file.read_text().strip()
+        except OSError:
+            continue
+        if value == "max":
+            return None
+        limit = int(value)
+        # cgroup v1未限制时为一个接近int64上限的值
+        if limit >= psutil.virtual_memory().total:
+            return None
+        return limit
+    return None
+
+
+def get_process_rss(pid: int) -> int:
+    """进程及其子进程的RSS之和（字节）"""
+    process = psutil.Process(pid)
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            continue
+    return rss
+
+
+class TaskMemory:
+    def __init__(self, estimated_mb: float, limit_mb: float):
+        self.estimated_mb = estimated_mb
+        self.limit_mb = limit_mb
+        self.current_mb = 0.0
+        self.peak_mb = 0.0
+        self.pids: Set[int] = set()  # 任务正在使用的工作进程
+        self.measured = False  # 任务在工作进程中运行，内存可直接测量
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "estimated_mb": round(self.estimated_mb, 1),
+            "current_mb": round(self.current_mb, 1),
+            "peak_mb": round(self.peak_mb, 1),
+            "limit_mb": self.limit_mb or None,
+            "measured": self.measured,
+        }
+
+
+class MemoryGovernor:
+    """按估算占用做准入控制，并定期采样各任务的内存"""
+
+    def __init__(
+        self,
+        budget_mb: float,
+        task_limit_mb: float,
+        reserve_mb: float,
+        base_mb: float,
+        page_mb: float,
+        scanned_page_mb: float,
+    ):
+        self.budget_mb = budget_mb
+        self.task_limit_mb = task_limit_mb
+        self.reserve_mb = reserve_mb
+        self.base_mb = base_mb
+        self.page_mb = page_mb
+        self.scanned_page_mb = scanned_page_mb
+        self.process = psutil.Process()
+        self.idle_rss_mb = self.process.memory_info().rss / MB  # 没有任务运行时本进程的RSS
+        # 返回各就绪工作进程的pid到预热后基线RSS（字节），由工作进程池启动后设置
+        self.worker_baselines: Callable[[], Dict[int, int]] = dict
+        self.tasks: Dict[str, TaskMemory] = {}
+        self.terminating: set = set()  # 已判定超限、等待调用方终止的任务
+        self.condition: Optional[asyncio.Condition] = None
+
+    def estimate(self, analysis: Optional[Dict[str, Any]], copies: int = 1) -> float:
+        """按预检结果估算任务的内存占用（MB），copies为同时持有的IR份数（目标语言数）"""
+        if not analysis:
+            return self.base_mb
+        image_only_pages = analysis.get("image_only_pages", 0)
+        text_pages = analysis.get("page_count", 0) - image_only_pages
+        return self.base_mb + (text_pages * self.page_mb + image_only_pages * self.scanned_page_mb) * copies
+
+    def committed_mb(self) -> float:
+        return sum(max(task.estimated_mb, task.current_mb) for task in self.tasks.values())
+
+    def resident_mb(self) -> float:
+        """不归任何任务的常驻内存：本进程的空闲基线与各工作进程的基线"""
+        return self.idle_rss_mb + sum(self.worker_baselines().values()) / MB
+
+    def available_mb(self) -> float:
+        return self.budget_mb - self.reserve_mb - self.resident_mb() - self.committed_mb()
+
+    def check_admissible(self, estimated_mb: float) -> Optional[str]:
+        """估算占用超过单任务上限或整个节点预算时返回原因"""
+        if self.task_limit_mb and estimated_mb > self.task_limit_mb:
+            return f"预计内存占用 {estimated_mb:.0f}MB 超过单任务上限 {self.task_limit_mb:.0f}MB"
+        if estimated_mb > self.budget_mb - self.reserve_mb - self.resident_mb():
+            return f"预计内存占用 {estimated_mb:.0f}MB 超过节点可用内存"
+        return None
+
+    def fits(self, estimated_mb: float) -> bool:
+        return not self.tasks or estimated_mb <= self.available_mb()
+
+    async def acquire(self, task_id: str, estimated_mb: float):
+        """等待剩余内存放得下该任务后登记；没有其他任务运行时总是放行"""
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.fits(estimated_mb))
+            self.tasks[task_id] = TaskMemory(estimated_mb, self.task_limit_mb)
+
+    async def release(self, task_id: str) -> Optional[TaskMemory]:
+        task = self.tasks.pop(task_id, None)
+        self.terminating.discard(task_id)
+        if task and not task.measured:
+            # 已结束任务未归还给系统的内存计入基线，不再分摊给其他任务
+            remaining_mb = sum(other.current_mb for other in self.tasks.values() if not other.measured)
+            self.idle_rss_mb = max(self.idle_rss_mb, self.process.memory_info().rss / MB - remaining_mb)
+        if self.condition is not None:
+            async with self.condition:
+                self.condition.notify_all()
+        return task
+
+    def add_pid(self, task_id: str, pid: int):
+        task = self.tasks.get(task_id)
+        if task:
+            task.pids.add(pid)
+            task.measured = True
+
+    def remove_pid(self, task_id: str, pid: int):
+        task = self.tasks.get(task_id)
+        if task:
+            task.pids.discard(pid)
+
+    def sample(self) -> List[str]:
+        """采样各任务当前内存，返回超出单任务上限的任务ID"""
+        process_rss_mb = self.process.memory_info().rss / MB
+        if not self.tasks:
+            self.idle_rss_mb = process_rss_mb
+            return []
+
+        in_process = {task_id: task for task_id, task in self.tasks.items() if not task.measured}
+        worker_baselines = self.worker_baselines()
+        for task in self.tasks.values():
+            if not task.measured:
+                continue
+            rss = 0
+            for pid in list(task.pids):
+                try:
+                    # 工作进程预热后的基线不属于任务，只计入任务带来的增长
+                    rss += max(0, get_process_rss(pid) - worker_baselines.get(pid, 0))
+                except psutil.Error:
+                    continue
+            task.current_mb = rss / MB
+        growth_mb = max(0.0, process_rss_mb - self.idle_rss_mb)
+        if in_process:
+            # 线程中运行的任务共享本进程的内存，按估算占用比例分摊增量
+            total_estimated = sum(task.estimated_mb for task in in_process.values())
+            for task in in_process.values():
+                task.current_mb = growth_mb * task.estimated_mb / total_estimated
+
+        over_limit = []
+        for task_id, task in self.tasks.items():
+            task.peak_mb = max(task.peak_mb, task.current_mb)
+            if task.measured and task.limit_mb and task.current_mb > task.limit_mb:
+                over_limit.append(task_id)
+        if in_process and not self.terminating.intersection(in_process):
+            measured_mb = sum(task.current_mb for task in self.tasks.values() if task.measured)
+            if len(in_process) == 1 and self.task_limit_mb and growth_mb > self.task_limit_mb:
+                over_limit.extend(in_process)
+            elif process_rss_mb + sum(worker_baselines.values()) / MB + measured_mb > self.budget_mb:
+                over_limit.append(max(in_process, key=lambda task_id: in_process[task_id].estimated_mb))
+        over_limit = [task_id for task_id in over_limit if task_id not in self.terminating]
+        self.terminating.update(over_limit)
+        return over_limit
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "budget_mb": round(self.budget_mb, 1),
+            "reserve_mb": self.reserve_mb,
+            "task_limit_mb": self.task_limit_mb or None,
+            "process_rss_mb": round(self.process.memory_info().rss / MB, 1),
+            "worker_baseline_mb": round(sum(self.worker_baselines().values()) / MB, 1),
+            "committed_mb": round(self.committed_mb(), 1),
+            "available_mb": round(self.available_mb(), 1),
+            "running_tasks": len(self.tasks),
+        }
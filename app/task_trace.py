@@ -0,0 +1,251 @@
+"""
+任务级链路追踪
+
+每次执行任务（翻译或重新渲染）对应一条trace：根span覆盖从提交到结束的全过程，
+其下是上传、预检、排队、模型加载、流水线等子span。BabelDOC内部各阶段（解析、
+版面分析、术语提取、翻译、排版、生成PDF等）没有回调可挂，按流水线的
+progress_start/progress_end事件推导出阶段span。
+
+span的ID、时间戳与状态字段遵循OpenTelemetry约定；结束的span逐条以OTLP/JSON
+（ExportTraceServiceRequest）写入本地JSONL文件，可直接被OpenTelemetry Collector
+的otlpjsonfile receiver读取。请求带有W3C traceparent头时沿用其中的trace ID，
+与调用方（如MCP服务）的trace串联。MCP服务使用同一模块记录自己的trace。
+"""
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "pdftranslate-api"
+# OTLP状态码
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+# 当前协程所属任务的trace与span
+current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+def new_id(length: int) -> str:
+    return os.urandom(length).hex()
+
+
+def parse_traceparent(traceparent: Optional[str]) -> Optional[Dict[str, str]]:
+    """解析W3C traceparent头：00-<trace_id>-<parent_span_id>-<flags>"""
+    if not traceparent:
+        return None
+    parts = traceparent.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return {"trace_id": parts[1], "span_id": parts[2]}
+
+
+def otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class SpanExporter:
+    """把结束的span以OTLP/JSON逐行追加到文件"""
+
+    def __init__(self, path: Optional[str], service_name: str = SERVICE_NAME):
+        self.path = Path(path) if path else None
+        self.service_name = service_name
+        self.lock = threading.Lock()
+
+    def export(self, spans: List["Span"]):
+        if not self.path or not spans:
+            return
+        line = json.dumps({
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{
+                    "scope": {"name": __name__},
+                    "spans": [span.to_otlp() for span in spans],
+                }],
+            }]
+        }, ensure_ascii=False)
+        try:
+            with self.lock:
+                # 首次导出时才创建目录，导入服务模块时不在当前目录下生成文件
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with self.path.open("a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+        except OSError as e:
+            logger.warning(f"Failed to export spans to {self.path}: {e}")
+
+
+class Span:
+    def __init__(self, trace: "TaskTrace", name: str, parent_span_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = new_id(8)
+        self.parent_span_id = parent_span_id
+        self.attributes = {key: value for key, value in attributes.items() if value is not None}
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.status_code = STATUS_UNSET
+        self.status_message = ""
+        self.stages: Dict[str, "Span"] = {}  # 由流水线事件推导、尚未结束的阶段span
+
+    def set_attribute(self, key: str, value: Any):
+        if value is not None:
+            self.attributes[key] = value
+
+    def end(self, error: Optional[str] = None):
+        if self.end_ns is not None:
+            return
+        for stage in list(self.stages.values()):
+            stage.end(error)
+        self.end_ns = time.time_ns()
+        if error:
+            self.status_code = STATUS_ERROR
+            self.status_message = error
+        elif self.status_code == STATUS_UNSET:
+            self.status_code = STATUS_OK
+        self.trace.exporter.export([self])
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [{"key": key, "value": otlp_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": self.status_code, "message": self.status_message} if self.status_message else {"code": self.status_code},
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        return span
+
+    def to_dict(self, origin_ns: int) -> Dict[str, Any]:
+        end_ns = self.end_ns or time.time_ns()
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_offset_ms": round((self.start_ns - origin_ns) / 1e6, 1),
+            "duration_ms": round((end_ns - self.start_ns) / 1e6, 1),
+            "ended": self.end_ns is not None,
+            "status": {STATUS_UNSET: "unset", STATUS_OK: "ok", STATUS_ERROR: "error"}[self.status_code],
+            "error": self.status_message or None,
+            "attributes": self.attributes,
+        }
+
+
+class TaskTrace:
+    def __init__(self, task_id: Optional[str], name: str, exporter: SpanExporter, traceparent: Optional[str] = None, **attributes):
+        parent = parse_traceparent(traceparent)
+        self.task_id = task_id
+        self.exporter = exporter
+        self.trace_id = parent["trace_id"] if parent else new_id(16)
+        self.spans: List[Span] = []
+        self.root = self.start_span(name, parent_span_id=parent["span_id"] if parent else None, task_id=task_id, **attributes)
+
+    def start_span(self, name: str, parent: Optional[Span] = None, parent_span_id: Optional[str] = None, **attributes) -> Span:
+        if parent is None and parent_span_id is None and self.spans:
+            active = current_span.get()
+            parent = active if active is not None and active.trace is self else self.root
+        span = Span(self, name, parent.span_id if parent else parent_span_id, attributes)
+        self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name: str, parent: Optional[Span] = None, **attributes) -> Iterator[Span]:
+        """记录一个子span，默认挂在当前span（或根span）下"""
+        child = self.start_span(name, parent=parent, **attributes)
+        try:
+            yield child
+        except BaseException as e:
+            child.end(repr(e))
+            raise
+        finally:
+            child.end()
+
+    def traceparent(self, span: Span) -> str:
+        """W3C traceparent头，使下游服务的span挂在span之下"""
+        return f"00-{self.trace_id}-{span.span_id}-01"
+
+    @contextmanager
+    def activate(self, span: Optional[Span] = None) -> Iterator[Span]:
+        """在当前协程（及其创建的子任务）中把span设为后续span的父span"""
+        span = span or self.root
+        token = current_span.set(span)
+        try:
+            yield span
+        finally:
+            current_span.reset(token)
+
+    def observe(self, span: Span, event: Dict[str, Any]):
+        """按流水线的阶段开始/结束事件在span下记录阶段span"""
+        stage_name = event.get("stage")
+        if not stage_name:
+            return
+        if event["type"] == "progress_start" and stage_name not in span.stages:
+            span.stages[stage_name] = self.start_span(stage_name, parent=span, stage_total=event.get("stage_total"))
+        elif event["type"] == "progress_end":
+            stage = span.stages.pop(stage_name, None)
+            if stage:
+                stage.end()
+
+    def end(self, status: str, error: Optional[str] = None):
+        """结束根span；仍未结束的子span（如被取消的任务）一并结束"""
+        if self.root.end_ns is not None:
+            return
+        self.root.set_attribute("task.status", status)
+        error = None if status == "completed" else (error or status)
+        for span in reversed(self.spans):
+            if span is not self.root:
+                span.end(error)
+        self.root.end(error)
+
+    def to_dict(self) -> Dict[str, Any]:
+        origin_ns = self.root.start_ns
+        return {
+            "trace_id": self.trace_id,
+            "name": self.root.name,
+            "started_at": origin_ns / 1e9,
+            "duration_ms": round(((self.root.end_ns or time.time_ns()) - origin_ns) / 1e6, 1),
+            "spans": [span.to_dict(origin_ns) for span in sorted(self.spans, key=lambda span: span.start_ns)],
+        }
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """在当前任务的trace中记录一个子span；不在任务中时什么也不做"""
+    active = current_span.get()
+    if active is None:
+        yield None
+        return
+    child = active.trace.start_span(name, parent=active, **attributes)
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.end(repr(e))
+        raise
+    finally:
+        current_span.reset(token)
+        child.end()
+
+
+def start_span(name: str, **attributes) -> Optional[Span]:
+    """在当前任务的trace中开始一个span，由调用方结束"""
+    active = current_span.get()
+    if active is None:
+        return None
+    return active.trace.start_span(name, parent=active, **attributes)
@@ -0,0 +1,197 @@
+"""
+翻译接口池的选择与故障转移测试：每个接口是一个本地的OpenAI兼容服务，
+按预设的状态码应答chat.completions请求
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import endpoint_pool
+import openai
+import pytest
+
+
+class ChatHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.requests.append(request)
+            status = server.status
+        if status == 200:
+            body = {
+                "id": "chatcmpl-test",
+                "object": "chat.completion",
+                "created": 0,
+                "model": request["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": server.name}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5},
+            }
+        else:
+            body = {"error": {"message": f"status {status}", "type": "test_error", "code": None}}
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+@pytest.fixture
+def upstreams():
+    servers = {}
+    for name in ("primary", "secondary", "tertiary"):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), ChatHandler)
+        server.name = name
+        server.status = 200
+        server.requests = []
+        server.lock = threading.Lock()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers[name] = server
+    yield servers
+    for server in servers.values():
+        server.shutdown()
+        server.server_close()
+
+
+def make_pool(upstreams, names=("primary", "secondary"), strategy="least_outstanding", weights=None):
+    endpoints = [
+        {
+            "name": name,
+            "base_url": f"http://127.0.0.1:{upstreams[name].server_port}/v1",
+            "api_key": "test-key",
+            "model": f"model-{name}",
+            "weight": (weights or {}).get(name, 1.0),
+            "qps": 1000.0,
+        }
+        for name in names
+    ]
+    return endpoint_pool.EndpointPool({
+        "endpoints": endpoints,
+        "strategy": strategy,
+        "eject_errors": 2,
+        "probe_interval": 3600,
+        "throttle_seconds": 60,
+    })
+
+
+def chat(pool):
+    response = pool.client.chat.completions.create(model="ignored", messages=[{"role": "user", "content": "hi"}])
+    return response.choices[0].message.content
+
+
+def test_parse_endpoints_defaults():
+    defaults = {"base_url": "https://api.example.com/v1", "api_key": "default-key", "model": "default-model"}
+    endpoints = endpoint_pool.parse_endpoints('[{"name": "a", "weight": 2}, {"model": "other", "qps": 3}]', defaults, 5.0)
+    assert endpoints == [
+        {"name": "a", "base_url": defaults["base_url"], "api_key": "default-key", "model": "default-model", "weight": 2.0, "qps": 5.0},
+        {"name": "endpoint-1", "base_url": defaults["base_url"], "api_key": "default-key", "model": "other", "weight": 1.0, "qps": 3.0},
+    ]
+    assert endpoint_pool.parse_endpoints("  ", defaults, 5.0) == []
+    with pytest.raises(ValueError):
+        endpoint_pool.parse_endpoints('[{"name": "a"}, {"name": "a"}]', defaults, 5.0)
+
+
+def test_acquire_prefers_untried_healthy_endpoints(upstreams):
+    """优先未尝试过、未摘除、未降级的接口，没有时逐级放宽"""
+    pool = make_pool(upstreams, names=("primary", "secondary", "tertiary"))
+    primary, secondary, tertiary = pool.endpoints
+
+    assert pool.acquire([]) is primary
+    # least_outstanding避开进行中请求多的接口
+    assert pool.acquire([]) is secondary
+    assert pool.acquire([primary, secondary]) is tertiary
+
+    secondary.ejected_at = 1.0
+    tertiary.throttled_until = float("inf")
+    assert pool.acquire([primary]) is tertiary  # 降级的接口好于被摘除的接口
+    tertiary.ejected_at = 1.0
+    assert pool.acquire([primary]) in (secondary, tertiary)  # 全部摘除时仍然尝试
+    primary.throttled_until = float("inf")
+    assert pool.acquire([secondary, tertiary]) is primary
+
+
+def test_weighted_round_robin(upstreams):
+    pool = make_pool(upstreams, strategy="weighted_round_robin", weights={"primary": 3.0})
+    picks = []
+    for _ in range(8):
+        endpoint = pool.acquire([])
+        picks.append(endpoint.name)
+        pool.release(endpoint, 0.0)
+    assert picks.count("primary") == 6
+    assert picks.count("secondary") == 2
+    assert picks[:4] != ["primary"] * 4  # 平滑轮询，不连续集中在同一接口
+
+
+def test_create_fails_over_on_server_error(upstreams):
+    """5xx时换接口重试；连续出错达到阈值后摘除，之后的请求不再发往该接口"""
+    upstreams["primary"].status = 503
+    pool = make_pool(upstreams)
+    primary, secondary = pool.endpoints
+
+    assert chat(pool) == "secondary"
+    assert upstreams["secondary"].requests[0]["model"] == "model-secondary"
+    assert primary.errors == 1 and primary.ejected_at is None
+    assert primary.outstanding == 0 and secondary.outstanding == 0
+
+    # least_outstanding在请求数相同的接口间轮换，第二次请求又先到primary
+    assert chat(pool) == "secondary"
+    assert primary.ejected_at is not None and primary.ejections == 1
+    requests_before = len(upstreams["primary"].requests)
+    for _ in range(3):
+        assert chat(pool) == "secondary"
+    assert len(upstreams["primary"].requests) == requests_before
+    assert secondary.total_tokens == 5 * 5
+    assert "InternalServerError" in primary.last_error
+
+
+def test_create_throttles_rate_limited_endpoint(upstreams):
+    """429时该接口短暂降级并换接口，降级期间优先其他接口"""
+    upstreams["primary"].status = 429
+    pool = make_pool(upstreams)
+    primary, _ = pool.endpoints
+
+    assert chat(pool) == "secondary"
+    assert primary.rate_limited == 1
+    assert primary.errors == 0 and primary.ejected_at is None
+    for _ in range(3):
+        assert chat(pool) == "secondary"
+    assert len(upstreams["primary"].requests) == 1
+
+
+def test_create_raises_when_all_endpoints_fail(upstreams):
+    upstreams["primary"].status = 503
+    upstreams["secondary"].status = 503
+    pool = make_pool(upstreams)
+    with pytest.raises(openai.InternalServerError):
+        chat(pool)
+    assert [endpoint.errors for endpoint in pool.endpoints] == [1, 1]
+    assert [endpoint.outstanding for endpoint in pool.endpoints] == [0, 0]
+
+
+def test_create_does_not_fail_over_on_bad_request(upstreams):
+    """与接口无关的错误（如400）直接抛出，不换接口"""
+    upstreams["primary"].status = 400
+    pool = make_pool(upstreams)
+    with pytest.raises(openai.BadRequestError):
+        chat(pool)
+    assert upstreams["secondary"].requests == []
+    assert pool.endpoints[0].outstanding == 0
+
+
+def test_merge_stats():
+    """计数相加，QPS取各进程共用的配额，任一进程摘除即为不健康"""
+    base = {
+        "name": "primary", "qps": 5.0, "healthy": True, "last_error": None, "latency_total": 1.0, "successes": 2,
+        **dict.fromkeys(endpoint_pool.COUNTERS, 1),
+    }
+    merged = endpoint_pool.merge_stats([[base], [dict(base, healthy=False, last_error="boom")]])
+    [entry] = merged
+    assert entry["requests"] == 2 and entry["qps"] == 5.0
+    assert not entry["healthy"] and entry["ejected_processes"] == 1
+    assert entry["last_error"] == "boom"
+    assert entry["avg_latency_ms"] == 500.0
@@ -0,0 +1,136 @@
+"""请求合并的取包与响应校验测试"""
+import threading
+from concurrent.futures import CancelledError
+from types import SimpleNamespace
+
+import pytest
+import request_packer
+
+SETTINGS = {
+    "max_tokens": 100,
+    "max_segments": 3,
+    "segment_max_tokens": 40,
+    "max_output_tokens": 1000,
+    "window_ms": 0,
+    "max_inflight": 1,
+}
+
+
+def make_translator(endpoint_key="model-a", cancel_event=None):
+    return SimpleNamespace(
+        endpoint_key=endpoint_key, cancel_event=cancel_event, prompt=lambda text: [None, {"content": f"Translate: {text}"}]
+    )
+
+
+def make_segment(translator, tokens, kind="llm", rate_limit_params=None):
+    # llm请求的提示词即原文；按estimate_tokens构造指定token数的文本（每字符一个token，外加1）
+    return request_packer.Segment(translator, kind, "字" * (tokens - 1), rate_limit_params)
+
+
+@pytest.fixture
+def packer():
+    # 测试直接操作队列而不通知合并线程，合并线程保持等待
+    return request_packer.RequestPacker(SETTINGS)
+
+
+def fill(packer, segments):
+    with packer.condition:
+        packer.pending.extend(segments)
+        packer.pending_tokens += sum(segment.tokens for segment in segments)
+
+
+def take(packer):
+    with packer.condition:
+        return packer.take_pack()
+
+
+def test_estimate_tokens():
+    assert request_packer.estimate_tokens("abcdefgh") == 3
+    assert request_packer.estimate_tokens("字" * 10) == 11
+
+
+def test_accepts_only_short_requests(packer):
+    translator = make_translator()
+    assert packer.accepts(translator, "translate", "short text", None)
+    assert not packer.accepts(translator, "translate", "字" * 60, None)
+    assert not packer.accepts(translator, "translate", None, None)
+    # llm请求按babeldoc给出的段落token数衡量，而非整个提示词
+    assert packer.accepts(translator, "llm", "字" * 200, {"paragraph_token_count": 30})
+    assert not packer.accepts(translator, "llm", "字" * 10, {"paragraph_token_count": 50})
+
+
+def test_take_pack_respects_token_budget(packer):
+    """取到token预算为止，放不下的请求留在队列中，顺序不变"""
+    translator = make_translator()
+    segments = [make_segment(translator, tokens) for tokens in (40, 30, 40, 20)]
+    fill(packer, segments)
+    assert take(packer) == [segments[0], segments[1], segments[3]]
+    assert list(packer.pending) == [segments[2]]
+    assert packer.pending_tokens == 40
+    assert take(packer) == [segments[2]]
+    assert packer.pending_tokens == 0
+
+
+def test_take_pack_respects_segment_limit(packer):
+    translator = make_translator()
+    segments = [make_segment(translator, 5) for _ in range(5)]
+    fill(packer, segments)
+    assert take(packer) == segments[:3]
+    assert take(packer) == segments[3:]
+
+
+def test_take_pack_groups_by_endpoint(packer):
+    """只合并与队首请求同一模型与接口的请求"""
+    first, second = make_translator("model-a"), make_translator("model-b")
+    segments = [make_segment(first, 10), make_segment(second, 10), make_segment(first, 10), make_segment(second, 10)]
+    fill(packer, segments)
+    assert take(packer) == [segments[0], segments[2]]
+    assert take(packer) == [segments[1], segments[3]]
+    assert not packer.pending
+
+
+def test_take_pack_oversized_first_segment(packer):
+    """单个请求超出预算时也单独成包"""
+    translator = make_translator()
+    segments = [make_segment(translator, 150), make_segment(translator, 10)]
+    fill(packer, segments)
+    assert take(packer) == [segments[0]]
+    assert take(packer) == [segments[1]]
+
+
+def test_drop_cancelled_segments(packer):
+    """所属任务已取消的请求移出队列，不进入合并，等待的调用方得到CancelledError"""
+    cancel_event = threading.Event()
+    cancelled, active = make_translator(cancel_event=cancel_event), make_translator()
+    segments = [make_segment(cancelled, 10), make_segment(active, 20), make_segment(cancelled, 30)]
+    fill(packer, segments)
+    cancel_event.set()
+    with packer.condition:
+        packer.drop_cancelled()
+    assert list(packer.pending) == [segments[1]]
+    assert packer.pending_tokens == 20
+    assert packer.stats()["cancelled_segments"] == 2
+    with pytest.raises(CancelledError):
+        segments[0].future.result(timeout=0)
+    assert take(packer) == [segments[1]]
+
+
+def test_validate_text_output():
+    segment = make_segment(make_translator(), 5, kind="translate")
+    assert segment.prompt == "Translate: " + "字" * 4
+    assert request_packer.RequestPacker.validate(segment, "  译文  ") == "译文"
+    assert request_packer.RequestPacker.validate(segment, None) is None
+    assert request_packer.RequestPacker.validate(segment, "   ") is None
+    assert request_packer.RequestPacker.validate(segment, {"text": "译文"}) is None
+
+
+def test_validate_json_output():
+    """要求JSON输出的请求：对象直接序列化，字符串必须能解析为JSON"""
+    segment = make_segment(make_translator(), 5, rate_limit_params={"request_json_mode": True})
+    assert segment.json_mode
+    validate = request_packer.RequestPacker.validate
+    assert validate(segment, [{"id": 1, "output": "译文"}]) == '[{"id": 1, "output": "译文"}]'
+    assert validate(segment, ' {"a": 1} ') == '{"a": 1}'
+    assert validate(segment, '```json\n{"a": 1}\n```') == '```json\n{"a": 1}\n```'
+    assert validate(segment, "not json") is None
+    assert validate(segment, 42) is None
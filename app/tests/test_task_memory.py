@@ -0,0 +1,178 @@
+"""内存准入控制与采样的测试：本进程与工作进程的RSS都用可设置的假值代替"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import task_memory
+
+MB = task_memory.MB
+
+
+class FakeProcess:
+    def __init__(self, rss_mb):
+        self.rss_mb = rss_mb
+
+    def memory_info(self):
+        return SimpleNamespace(rss=int(self.rss_mb * MB))
+
+
+@pytest.fixture
+def governor(monkeypatch):
+    process = FakeProcess(500)
+    monkeypatch.setattr(task_memory.psutil, "Process", lambda *_: process)
+    governor = task_memory.MemoryGovernor(
+        budget_mb=4000, task_limit_mb=1000, reserve_mb=500, base_mb=200, page_mb=10, scanned_page_mb=30,
+    )
+    worker_rss = {}
+    monkeypatch.setattr(task_memory, "get_process_rss", lambda pid: int(worker_rss[pid] * MB))
+    governor.fake_process = process
+    governor.worker_rss = worker_rss
+    return governor
+
+
+def test_estimate(governor):
+    assert governor.estimate(None) == 200
+    analysis = {"page_count": 10, "image_only_pages": 4}
+    assert governor.estimate(analysis) == 200 + 6 * 10 + 4 * 30
+    assert governor.estimate(analysis, copies=2) == 200 + 2 * (6 * 10 + 4 * 30)
+
+
+def test_check_admissible(governor):
+    assert governor.check_admissible(900) is None
+    assert "单任务上限" in governor.check_admissible(1200)
+    governor.task_limit_mb = 0
+    assert "节点可用内存" in governor.check_admissible(3100)
+
+
+def test_acquire_waits_for_memory(governor):
+    """剩余内存放不下时等待，有任务结束后放行；没有其他任务时总是放行"""
+
+    async def scenario():
+        await governor.acquire("big", 5000)
+        waiting = asyncio.create_task(governor.acquire("a", 1500))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        await governor.release("big")
+        await asyncio.wait_for(waiting, 1)
+
+        await governor.acquire("b", 1200)
+        assert governor.available_mb() == pytest.approx(4000 - 500 - 500 - 1500 - 1200)
+        waiting = asyncio.create_task(governor.acquire("c", 900))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        assert "c" not in governor.tasks
+        await governor.release("a")
+        await asyncio.wait_for(waiting, 1)
+        assert set(governor.tasks) == {"b", "c"}
+
+    asyncio.run(scenario())
+
+
+def test_sample_splits_in_process_growth(governor):
+    """线程中运行的任务按估算占用分摊本进程超出空闲基线的部分"""
+
+    async def scenario():
+        await governor.acquire("small", 100)
+        await governor.acquire("large", 300)
+
+    asyncio.run(scenario())
+    governor.fake_process.rss_mb = 900
+    assert governor.sample() == []
+    assert governor.tasks["small"].current_mb == pytest.approx(100)
+    assert governor.tasks["large"].current_mb == pytest.approx(300)
+
+    governor.fake_process.rss_mb = 700
+    governor.sample()
+    assert governor.tasks["large"].current_mb == pytest.approx(150)
+    assert governor.tasks["large"].peak_mb == pytest.approx(300)
+
+
+def test_sample_measures_worker_processes(governor):
+    """工作进程中的任务按登记的pid测量，超出单任务上限时只报告一次"""
+
+    async def scenario():
+        await governor.acquire("worker-task", 400)
+
+    asyncio.run(scenario())
+    governor.add_pid("worker-task", 101)
+    governor.add_pid("worker-task", 102)
+    governor.worker_rss.update({101: 600, 102: 300})
+    assert governor.sample() == []
+    assert governor.tasks["worker-task"].current_mb == pytest.approx(900)
+    assert governor.tasks["worker-task"].measured
+
+    governor.worker_rss[102] = 500
+    assert governor.sample() == ["worker-task"]
+    assert governor.sample() == []
+
+    governor.remove_pid("worker-task", 102)
+    asyncio.run(governor.release("worker-task"))
+    assert governor.terminating == set()
+
+
+def test_worker_baselines_not_charged_to_tasks(governor):
+    """工作进程预热后的基线只从可用内存中扣除一次，不计入在其中运行的任务"""
+    governor.worker_baselines = lambda: {101: 700 * MB, 102: 700 * MB}
+    assert governor.available_mb() == pytest.approx(4000 - 500 - 500 - 1400)
+    governor.task_limit_mb = 0
+    assert "节点可用内存" in governor.check_admissible(1700)
+    governor.task_limit_mb = 1000
+
+    async def scenario():
+        await governor.acquire("worker-task", 400)
+
+    asyncio.run(scenario())
+    governor.add_pid("worker-task", 101)
+    governor.worker_rss.update({101: 1000, 102: 700})
+    assert governor.sample() == []
+    assert governor.tasks["worker-task"].current_mb == pytest.approx(300)
+    assert governor.available_mb() == pytest.approx(4000 - 500 - 500 - 1400 - 400)
+
+    governor.worker_rss[101] = 700 + 1100
+    assert governor.sample() == ["worker-task"]
+
+
+def test_sample_single_in_process_task_over_limit(governor):
+    async def scenario():
+        await governor.acquire("only", 400)
+
+    asyncio.run(scenario())
+    governor.fake_process.rss_mb = 500 + 1100
+    assert governor.sample() == ["only"]
+
+
+def test_sample_over_budget_terminates_largest_estimate(governor):
+    """多个线程中任务无法区分各自占用，节点超出预算时终止估算占用最大的一个"""
+
+    async def scenario():
+        for task_id, estimated_mb in (("a", 300), ("b", 800), ("c", 500)):
+            await governor.acquire(task_id, estimated_mb)
+
+    asyncio.run(scenario())
+    governor.fake_process.rss_mb = 3000
+    assert governor.sample() == []
+    governor.fake_process.rss_mb = 4100
+    assert governor.sample() == ["b"]
+    # 被终止的任务结束之前不再终止其他任务
+    assert governor.sample() == []
+
+
+def test_release_raises_idle_baseline(governor):
+    """已结束的线程中任务未归还的内存计入基线，不再分摊给其他任务"""
+
+    async def scenario():
+        await governor.acquire("a", 100)
+        await governor.acquire("b", 100)
+        governor.fake_process.rss_mb = 900
+        governor.sample()
+        await governor.release("a")
+
+    asyncio.run(scenario())
+    assert governor.idle_rss_mb == pytest.approx(700)
+    governor.sample()
+    assert governor.tasks["b"].current_mb == pytest.approx(200)
+
+    asyncio.run(governor.release("b"))
+    governor.fake_process.rss_mb = 650
+    governor.sample()
+    assert governor.idle_rss_mb == pytest.approx(650)
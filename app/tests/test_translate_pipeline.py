@@ -0,0 +1,114 @@
+"""增量翻译的页面指纹与译文拼接测试"""
+import pytest
+import translate_pipeline
+from babeldoc.format.pdf.document_il import il_version_1 as il
+
+
+def make_paragraph(text, y=700.0, font_size=10.0):
+    return il.PdfParagraph(
+        box=il.Box(x=72.0, y=y, x2=540.0, y2=y + 12.0),
+        pdf_style=il.PdfStyle(font_id="F1", font_size=font_size),
+        unicode=text,
+        layout_label="plain text",
+    )
+
+
+def make_page(*texts, page_number=0):
+    return il.Page(
+        mediabox=il.Mediabox(box=il.Box(x=0.0, y=0.0, x2=612.0, y2=792.0)),
+        cropbox=il.Cropbox(box=il.Box(x=0.0, y=0.0, x2=612.0, y2=792.0)),
+        pdf_paragraph=[make_paragraph(text, y=700.0 - 20 * i) for i, text in enumerate(texts)],
+        page_number=page_number,
+    )
+
+
+def translate(page, suffix=" (zh)"):
+    """模拟翻译阶段：写入译文并生成排版用的段落组成"""
+    for paragraph in page.pdf_paragraph:
+        paragraph.unicode += suffix
+        paragraph.pdf_paragraph_composition = [
+            il.PdfParagraphComposition(
+                pdf_same_style_unicode_characters=il.PdfSameStyleUnicodeCharacters(unicode=paragraph.unicode)
+            )
+        ]
+
+
+def make_base_state(pages):
+    """旧版本：先按源文计算指纹，再翻译，与流水线保存IR的顺序一致"""
+    fingerprints = [translate_pipeline.page_fingerprint(page) for page in pages]
+    for page in pages:
+        translate(page)
+    return {"docs": il.Document(page=pages), "page_fingerprints": fingerprints}
+
+
+def test_fingerprint_depends_only_on_source_layout():
+    page = make_page("Hello", "World")
+    assert translate_pipeline.page_fingerprint(page) == translate_pipeline.page_fingerprint(make_page("Hello", "World"))
+    # 页码不同（页面被插入或删除后整体后移）指纹不变
+    assert translate_pipeline.page_fingerprint(page) == translate_pipeline.page_fingerprint(make_page("Hello", "World", page_number=3))
+
+    edited = make_page("Hello", "World!")
+    moved = make_page("Hello", "World")
+    moved.pdf_paragraph[1].box.y += 5
+    resized = make_page("Hello", "World")
+    resized.pdf_paragraph[0].pdf_style.font_size = 12.0
+    fingerprints = {translate_pipeline.page_fingerprint(p) for p in (page, edited, moved, resized)}
+    assert len(fingerprints) == 4
+
+
+def test_splice_reuses_unchanged_pages():
+    base_state = make_base_state([make_page("A1", "A2"), make_page("B1"), make_page("C1")])
+    # 新修订版：开头插入一页，原第二页有改动
+    pages = [make_page("New"), make_page("A1", "A2"), make_page("B1 edited"), make_page("C1")]
+    fingerprints = [translate_pipeline.page_fingerprint(page) for page in pages]
+
+    changed = translate_pipeline.splice_cached_pages(il.Document(page=pages), base_state, fingerprints)
+
+    assert changed == [pages[0], pages[2]]
+    assert [p.unicode for p in pages[1].pdf_paragraph] == ["A1 (zh)", "A2 (zh)"]
+    assert pages[3].pdf_paragraph[0].unicode == "C1 (zh)"
+    assert pages[2].pdf_paragraph[0].unicode == "B1 edited"
+    # 段落组成是拷贝，之后排版修改新文档不影响旧版本IR
+    base_composition = base_state["docs"].page[0].pdf_paragraph[0].pdf_paragraph_composition
+    assert pages[1].pdf_paragraph[0].pdf_paragraph_composition == base_composition
+    assert pages[1].pdf_paragraph[0].pdf_paragraph_composition is not base_composition
+
+
+def test_splice_without_base_fingerprints_translates_everything():
+    base_state = make_base_state([make_page("A1")])
+    base_state["page_fingerprints"] = None
+    pages = [make_page("A1")]
+
+    changed = translate_pipeline.splice_cached_pages(il.Document(page=pages), base_state, [translate_pipeline.page_fingerprint(pages[0])])
+
+    assert changed == pages
+    assert pages[0].pdf_paragraph[0].unicode == "A1"
+
+
+def test_splice_rejects_mismatched_fingerprints():
+    base_state = make_base_state([make_page("A1"), make_page("B1")])
+    pages = [make_page("A1"), make_page("B1")]
+    with pytest.raises(ValueError):
+        translate_pipeline.splice_cached_pages(il.Document(page=pages), base_state, [translate_pipeline.page_fingerprint(pages[0])])
+
+    base_state["page_fingerprints"] = base_state["page_fingerprints"][:1]
+    with pytest.raises(ValueError):
+        translate_pipeline.splice_cached_pages(
+            il.Document(page=pages), base_state, [translate_pipeline.page_fingerprint(p) for p in pages]
+        )
+
+
+def test_splice_from_saved_il_state(tmp_path):
+    base_state = make_base_state([make_page("A1"), make_page("B1")])
+    translate_pipeline.dump_il_state(
+        tmp_path / translate_pipeline.TRANSLATED_IL_FILE, base_state["docs"], {}, base_state["page_fingerprints"]
+    )
+
+    saved_state = translate_pipeline.load_il_state(tmp_path)
+    pages = [make_page("A1"), make_page("B2")]
+    changed = translate_pipeline.splice_cached_pages(
+        il.Document(page=pages), saved_state, [translate_pipeline.page_fingerprint(p) for p in pages]
+    )
+
+    assert changed == [pages[1]]
+    assert pages[0].pdf_paragraph[0].unicode == "A1 (zh)"
@@ -0,0 +1,179 @@
+"""
+webhook发件箱测试：本地起一个HTTP接收方，按预设的状态码依次应答并记录收到的请求
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import httpx
+import pytest
+import webhook_outbox
+
+SECRET = "test-secret"  # noqa: S105
+
+
+class ReceiverHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with receiver.lock:
+            receiver.requests.append((dict(self.headers), body))
+            status = receiver.statuses.pop(0) if len(receiver.statuses) > 1 else receiver.statuses[0]
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class Receiver:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.statuses = [200]
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ReceiverHandler)
+        self.server.receiver = self
+        self.url = f"http://127.0.0.1:{self.server.server_port}/callback"
+
+
+@pytest.fixture
+def receiver():
+    receiver = Receiver()
+    thread = threading.Thread(target=receiver.server.serve_forever, daemon=True)
+    thread.start()
+    yield receiver
+    receiver.server.shutdown()
+    receiver.server.server_close()
+
+
+def make_settings(tmp_path, **overrides):
+    settings = {
+        "outbox_path": str(tmp_path / "webhooks.db"),
+        "secret": SECRET,
+        "timeout": 5.0,
+        "max_attempts": 3,
+        "backoff_base": 0.05,
+        "backoff_max": 1.0,
+    }
+    settings.update(overrides)
+    return settings
+
+
+async def run_until(outbox, condition, timeout: float = 5.0):
+    """运行投递循环直到条件满足"""
+    runner = asyncio.create_task(outbox.run())
+    try:
+        deadline = time.monotonic() + timeout
+        while not condition():
+            assert time.monotonic() < deadline, "webhook outbox did not reach the expected state"
+            await asyncio.sleep(0.01)
+    finally:
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+
+
+def status_of(outbox, delivery_id):
+    row = outbox.db.execute("SELECT status, attempts FROM deliveries WHERE id = ?", (delivery_id,)).fetchone()
+    return row and {"status": row[0], "attempts": row[1]}
+
+
+def test_delivery_is_signed(tmp_path, receiver):
+    """通知带HMAC签名，接收方用共享密钥校验；送达后从发件箱删除"""
+    outbox = webhook_outbox.WebhookOutbox(make_settings(tmp_path))
+    delivery_id = outbox.enqueue("task-1", receiver.url, {"task_id": "task-1", "status": "completed"})
+    asyncio.run(run_until(outbox, lambda: outbox.stats()["delivered"] == 1))
+
+    headers, body = receiver.requests[0]
+    expected = hmac.new(SECRET.encode(), headers["X-Webhook-Timestamp"].encode() + b"." + body, hashlib.sha256)
+    assert hmac.compare_digest(headers["X-Webhook-Signature"], "sha256=" + expected.hexdigest())
+    assert headers["X-Webhook-Id"] == delivery_id
+    assert headers["X-Webhook-Attempt"] == "1"
+    assert json.loads(body) == {"id": delivery_id, "task_id": "task-1", "status": "completed"}
+    assert status_of(outbox, delivery_id) is None
+    assert outbox.stats()["pending"] == 0
+
+
+def test_unsigned_without_secret(tmp_path, receiver):
+    outbox = webhook_outbox.WebhookOutbox(make_settings(tmp_path, secret=""))
+    outbox.enqueue("task-1", receiver.url, {"status": "completed"})
+    asyncio.run(run_until(outbox, lambda: outbox.stats()["delivered"] == 1))
+    assert "X-Webhook-Signature" not in receiver.requests[0][0]
+
+
+def test_failed_delivery_backs_off_exponentially(tmp_path, receiver, monkeypatch):
+    """每次失败后的重试间隔翻倍，不超过backoff_max"""
+    monkeypatch.setattr(webhook_outbox.random, "uniform", lambda *_: 1.0)
+    receiver.statuses = [503]
+    outbox = webhook_outbox.WebhookOutbox(make_settings(tmp_path, max_attempts=10, backoff_base=2.0, backoff_max=10.0))
+    delivery_id = outbox.enqueue("task-1", receiver.url, {"status": "failed"})
+
+    async def deliver_rounds():
+        outbox.client = httpx.AsyncClient(timeout=outbox.timeout)
+        delays = []
+        try:
+            for attempts in range(5):
+                row = outbox.db.execute("SELECT task_id, url, payload FROM deliveries WHERE id = ?", (delivery_id,)).fetchone()
+                before = time.time()
+                await outbox.deliver(delivery_id, *row, attempts)
+                next_attempt_at = outbox.db.execute(
+                    "SELECT next_attempt_at FROM deliveries WHERE id = ?", (delivery_id,)
+                ).fetchone()[0]
+                delays.append(next_attempt_at - before)
+        finally:
+            await outbox.client.aclose()
+        return delays
+
+    delays = asyncio.run(deliver_rounds())
+    assert [round(delay) for delay in delays] == [2, 4, 8, 10, 10]
+    assert status_of(outbox, delivery_id) == {"status": "pending", "attempts": 5}
+    assert outbox.stats()["last_error"] == "HTTP 503"
+
+
+def test_gives_up_after_max_attempts_and_retry(tmp_path, receiver):
+    """达到最大次数后标记为dead；retry()后重新投递"""
+    receiver.statuses = [500]
+    outbox = webhook_outbox.WebhookOutbox(make_settings(tmp_path))
+    delivery_id = outbox.enqueue("task-1", receiver.url, {"status": "completed"})
+    asyncio.run(run_until(outbox, lambda: outbox.stats()["dead"] == 1))
+
+    assert [headers["X-Webhook-Attempt"] for headers, _ in receiver.requests] == ["1", "2", "3"]
+    assert status_of(outbox, delivery_id) == {"status": "dead", "attempts": 3}
+    [dead] = outbox.dead_letters()
+    assert dead["id"] == delivery_id
+    assert dead["last_error"] == "HTTP 500"
+    assert outbox.stats()["gave_up"] == 1
+
+    assert not outbox.retry("unknown-delivery")
+    receiver.statuses = [200]
+    assert outbox.retry(delivery_id)
+    assert not outbox.retry(delivery_id)
+    asyncio.run(run_until(outbox, lambda: outbox.stats()["delivered"] == 1))
+    assert receiver.requests[-1][0]["X-Webhook-Attempt"] == "1"
+    assert status_of(outbox, delivery_id) is None
+    assert outbox.dead_letters() == []
+
+
+def test_pending_deliveries_survive_restart(tmp_path, receiver):
+    """服务重启后，新的发件箱继续投递上次未送达的通知"""
+    receiver.statuses = [502]
+    outbox = webhook_outbox.WebhookOutbox(make_settings(tmp_path, max_attempts=5, backoff_base=60.0))
+    delivery_id = outbox.enqueue("task-1", receiver.url, {"status": "completed"})
+    asyncio.run(run_until(outbox, lambda: outbox.stats()["failed_attempts"] == 1))
+    outbox.db.close()
+
+    receiver.statuses = [200]
+    restarted = webhook_outbox.WebhookOutbox(make_settings(tmp_path, max_attempts=5, backoff_base=60.0))
+    assert restarted.stats()["pending"] == 1
+    # 重启后的重试时间沿用发件箱中记录的值，这里改为立即到期
+    restarted.db.execute("UPDATE deliveries SET next_attempt_at = ?", (time.time(),))
+    asyncio.run(run_until(restarted, lambda: restarted.stats()["delivered"] == 1))
+
+    assert [headers["X-Webhook-Id"] for headers, _ in receiver.requests] == [delivery_id, delivery_id]
+    assert receiver.requests[-1][0]["X-Webhook-Attempt"] == "2"
+    assert restarted.stats()["pending"] == 0
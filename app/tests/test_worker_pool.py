@@ -0,0 +1,207 @@
+"""
+工作进程池回收逻辑的测试：进程换成不执行任何代码的假进程，
+由测试按工作进程的协议发送ready/event/done消息
+"""
+import asyncio
+import queue
+
+import pytest
+import translate_worker
+
+MB = translate_worker.MB
+SETTINGS = {
+    "server": {"qps": 10},
+    "endpoints": {"endpoints": []},
+}
+
+
+class FakeProcess:
+    pids = iter(range(1000, 2000))
+
+    def __init__(self, target, args, name, daemon):
+        self.args = args
+        self.name = name
+        self.pid = next(self.pids)
+        self.alive = False
+        self.exitcode = None
+
+    def start(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def join(self, timeout=None):
+        pass
+
+    def kill(self):
+        self.alive = False
+
+
+class FakeContext:
+    Process = FakeProcess
+    Queue = queue.Queue
+
+
+def run(scenario, **pool_options):
+    """在事件循环中创建使用假进程的池并执行测试步骤"""
+
+    async def main():
+        options = {"size": 1, "max_tasks": 2, "max_rss_growth_mb": 500, **pool_options}
+        pool = translate_worker.WorkerPool(options["size"], options["max_tasks"], options["max_rss_growth_mb"], SETTINGS)
+        pool.context = FakeContext()
+        pool.loop = asyncio.get_running_loop()
+        pool.worker_available = asyncio.Event()
+        for _ in range(pool.size):
+            pool.spawn_worker()
+        await scenario(pool)
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+
+
+def ready(pool, worker_id, rss_mb=1000):
+    worker = pool.workers[worker_id]
+    pool.handle_message(("ready", worker_id, worker.process.pid, rss_mb * MB))
+
+
+async def start_job(pool, worker_id=None):
+    """通过acquire_worker取得空闲进程并登记任务（与run相同的步骤）"""
+    worker = await asyncio.wait_for(pool.acquire_worker(), 1)
+    if worker_id is not None:
+        assert worker.worker_id == worker_id
+    job_id = next(pool.job_ids)
+    worker.job_id = job_id
+    return worker, job_id
+
+
+def finish_job(pool, worker, job_id, rss_mb=1000):
+    pool.handle_message(("done", worker.worker_id, job_id, rss_mb * MB))
+
+
+def test_recycles_after_max_tasks():
+    """达到任务数上限后启动替代进程，替代进程就绪前旧进程继续服务，就绪后旧进程空闲即退出"""
+
+    async def scenario(pool):
+        ready(pool, 0)
+        for _ in range(2):
+            worker, job_id = await start_job(pool, 0)
+            finish_job(pool, worker, job_id)
+        assert set(pool.workers) == {0, 1}
+        assert pool.workers[0].replacement == 1
+        assert pool.workers[1].replaces == 0
+
+        # 替代进程预热期间，旧进程仍接收任务，且不会再次触发回收
+        worker, job_id = await start_job(pool, 0)
+        finish_job(pool, worker, job_id)
+        assert set(pool.workers) == {0, 1}
+
+        ready(pool, 1)
+        assert set(pool.workers) == {1}
+        assert pool.recycled == 1
+        assert worker.inbox.get_nowait() == ("stop",)
+        await start_job(pool, 1)
+
+    run(scenario)
+
+
+def test_busy_worker_retires_after_current_task():
+    """替代进程就绪时旧进程正在执行任务：不中断任务，任务结束后退出，期间不再分配任务"""
+
+    async def scenario(pool):
+        ready(pool, 0)
+        worker, job_id = await start_job(pool, 0)
+        finish_job(pool, worker, job_id, rss_mb=1600)  # RSS增长超过阈值
+        assert pool.workers[0].replacement == 1
+
+        old_worker, job_id = await start_job(pool, 0)
+        ready(pool, 1)
+        assert old_worker.retiring and 0 in pool.workers
+        assert old_worker.inbox.empty()
+        new_worker, _ = await start_job(pool, 1)
+
+        finish_job(pool, old_worker, job_id)
+        assert set(pool.workers) == {1}
+        assert old_worker.inbox.get_nowait() == ("stop",)
+        assert pool.recycled == 1
+        assert new_worker.replaces == 0
+
+    run(scenario)
+
+
+def test_below_thresholds_keeps_worker():
+    async def scenario(pool):
+        ready(pool, 0)
+        worker, job_id = await start_job(pool, 0)
+        finish_job(pool, worker, job_id, rss_mb=1400)
+        assert set(pool.workers) == {0}
+        assert pool.workers[0].replacement is None
+        assert pool.stats()["workers"][0]["rss_growth_mb"] == 400
+
+    run(scenario, max_tasks=5)
+
+
+def test_replacement_dies_during_warmup():
+    """替代进程在预热中退出时旧进程继续服务，下一个任务结束后再尝试回收"""
+
+    async def scenario(pool):
+        ready(pool, 0)
+        worker, job_id = await start_job(pool, 0)
+        finish_job(pool, worker, job_id)
+        assert pool.workers[0].replacement == 1
+
+        pool.workers[1].process.alive = False
+        pool.check_workers()
+        assert set(pool.workers) == {0}
+        assert pool.workers[0].replacement is None
+        assert pool.startup_failures == 1
+
+        worker, job_id = await start_job(pool, 0)
+        finish_job(pool, worker, job_id)
+        assert pool.workers[0].replacement == 2
+
+    run(scenario, max_tasks=1)
+
+
+def test_crashed_worker_fails_its_job_and_is_replaced():
+    """工作进程意外退出：其任务以错误结束，并补充新的进程"""
+
+    async def scenario(pool):
+        ready(pool, 0)
+        events = []
+
+        async def consume():
+            async for event in pool.run({"kwargs": {}}):
+                events.append(event)
+
+        consumer = asyncio.create_task(consume())
+        await asyncio.sleep(0.01)
+        worker = pool.workers[0]
+        assert worker.job_id is not None
+        pool.handle_message(("event", worker.job_id, {"type": "progress", "progress": 10}))
+        worker.process.alive = False
+        worker.process.exitcode = -9
+        pool.check_workers()
+        await asyncio.wait_for(consumer, 1)
+
+        assert events[0] == {"type": "progress", "progress": 10}
+        assert events[1]["type"] == "error"
+        assert "-9" in events[1]["error"]
+        assert set(pool.workers) == {1}
+        assert pool.startup_failures == 0
+
+    run(scenario)
+
+
+def test_repeated_startup_failures_stop_respawning():
+    async def scenario(pool):
+        for _ in range(translate_worker.WORKER_MAX_STARTUP_FAILURES):
+            [worker] = pool.workers.values()
+            worker.process.alive = False
+            pool.check_workers()
+        assert not pool.workers
+        assert pool.failure
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(pool.acquire_worker(), 1)
+
+    run(scenario)
@@ -0,0 +1,530 @@
+"""
+分阶段执行BabelDOC翻译流水线
+
+流程与 babeldoc.format.pdf.high_level.async_translate 一致（单文件、不分片），
+区别在于把流水线拆成 准备/解析 -> 翻译 -> 排版渲染 三段，并在翻译完成后把
+中间表示(IR)保存到任务的working_dir中。之后可以只执行排版和渲染阶段，
+重新生成单语/双语/水印等不同版本的PDF，而不再调用LLM。
+
+保存的IR同时记录每页的源文指纹。翻译同一文档的新修订版时，指纹未变的页面
+直接沿用旧版本的译文，只有变化的页面进入翻译阶段。
+
+一次翻译为多个目标语言时，先用run_parse解析一次并把源文IR保存到working_dir，再为每个
+目标语言分别执行run_translate_from_source（术语提取、翻译、排版渲染）。各语言的任务只
+传递源文IR所在的目录，由执行任务的进程自行读取，不经过工作进程的队列。
+
+指定checkpoint_interval时保存检查点：解析完成后把源文IR保存到working_dir，翻译阶段
+已译的段落逐条记入日志（见segment_journal）。中断的任务以同一working_dir重新执行时，
+跳过准备与解析阶段，已翻译的段落不再调用LLM。
+"""
+import asyncio
+import copy
+import contextvars
+import functools
+import hashlib
+import logging
+import pickle
+import shutil
+import threading
+import time
+from asyncio import CancelledError
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import babeldoc
+from babeldoc import asynchronize
+from babeldoc.babeldoc_exception.BabelDOCException import ExtractTextError
+from babeldoc.babeldoc_exception.BabelDOCException import InputFileGeneratedByBabelDOCError
+from babeldoc.const import close_process_pool
+from babeldoc.format.pdf.document_il.backend.pdf_creater import SAVE_PDF_STAGE_NAME
+from babeldoc.format.pdf.document_il.backend.pdf_creater import SUBSET_FONT_STAGE_NAME
+from babeldoc.format.pdf.document_il.backend.pdf_creater import PDFCreater
+from babeldoc.format.pdf.document_il.midend.automatic_term_extractor import AutomaticTermExtractor
+from babeldoc.format.pdf.document_il.midend.detect_scanned_file import DetectScannedFile
+from babeldoc.format.pdf.document_il.midend.il_translator import ILTranslator
+from babeldoc.format.pdf.document_il.midend.il_translator_llm_only import ILTranslatorLLMOnly
+from babeldoc.format.pdf.document_il.midend.layout_parser import LayoutParser
+from babeldoc.format.pdf.document_il.midend.paragraph_finder import ParagraphFinder
+from babeldoc.format.pdf.document_il.midend.styles_and_formulas import StylesAndFormulas
+from babeldoc.format.pdf.document_il.midend.table_parser import TableParser
+from babeldoc.format.pdf.document_il.midend.typesetting import Typesetting
+from babeldoc.format.pdf.document_il.utils.fontmap import FontMapper
+from babeldoc.format.pdf.high_level import (
+    add_metadata,
+    check_cid_char,
+    check_metadata,
+    fix_cmap,
+    fix_filter,
+    fix_media_box,
+    fix_null_page_content,
+    fix_null_xref,
+    generate_first_page_with_watermark,
+    get_translation_stage,
+    merge_watermark_doc,
+    migrate_toc,
+    open_pdf_with_save_fallback,
+    save_pdf_with_same_path_fallback,
+    translator_supports_llm,
+)
+from babeldoc.format.pdf.new_parser.native_parse import parse_prepared_pdf_with_new_parser_to_legacy_ir
+from babeldoc.format.pdf.translation_config import TranslateResult, TranslationConfig, WatermarkOutputMode
+from babeldoc.progress_monitor import ProgressMonitor
+from pymupdf import Document
+
+import segment_journal
+
+logger = logging.getLogger(__name__)
+
+# working_dir中保存的文件
+PREPARED_INPUT_FILE = "input.pdf"
+TRANSLATED_IL_FILE = "translated_il.pkl"
+# 检查点：解析完成后的源文IR与已译段落日志，任务完成后删除
+PARSED_IL_FILE = "parsed_il.pkl"
+SEGMENT_JOURNAL_FILE = "segments.jsonl"
+CHECKPOINT_FILES = (PARSED_IL_FILE, SEGMENT_JOURNAL_FILE)
+
+# 重新渲染只经过排版与生成PDF的阶段
+RENDER_STAGE_NAMES = (
+    Typesetting.stage_name,
+    FontMapper.stage_name,
+    PDFCreater.stage_name,
+    SUBSET_FONT_STAGE_NAME,
+    SAVE_PDF_STAGE_NAME,
+)
+
+
+# 每个目标语言单独执行的阶段（术语提取结果带有目标语言译文，不能共用）
+TARGET_STAGE_NAMES = (
+    AutomaticTermExtractor.stage_name,
+    ILTranslator.stage_name,
+) + RENDER_STAGE_NAMES
+
+
+def get_render_stages(translation_config: TranslationConfig) -> List[Tuple[str, float]]:
+    """重新渲染时的进度阶段及权重"""
+    return [stage for stage in get_translation_stage(translation_config) if stage[0] in RENDER_STAGE_NAMES]
+
+
+def get_source_stages(translation_config: TranslationConfig) -> List[Tuple[str, float]]:
+    """共用源文IR的准备与解析阶段"""
+    return [stage for stage in get_translation_stage(translation_config) if stage[0] not in TARGET_STAGE_NAMES]
+
+
+def get_target_stages(translation_config: TranslationConfig) -> List[Tuple[str, float]]:
+    """单个目标语言的翻译与渲染阶段"""
+    return [stage for stage in get_translation_stage(translation_config) if stage[0] in TARGET_STAGE_NAMES]
+
+
+def prepare_input(translation_config: TranslationConfig) -> Tuple[Document, Path, Dict[int, Any]]:
+    """修复输入PDF并保存到working_dir，返回 (pymupdf文档, 预处理后的PDF路径, mediabox数据)"""
+    temp_pdf_path = translation_config.get_working_file_path(PREPARED_INPUT_FILE)
+    doc_pdf = open_pdf_with_save_fallback(translation_config.input_file, temp_pdf_path)
+    try:
+        fix_null_page_content(doc_pdf)
+        fix_filter(doc_pdf)
+        fix_null_xref(doc_pdf)
+    except Exception:
+        logger.exception("auto fix failed, please check the pdf file")
+
+    mediabox_data = fix_media_box(doc_pdf)
+    doc_pdf = save_pdf_with_same_path_fallback(doc_pdf, temp_pdf_path)
+    return doc_pdf, temp_pdf_path, mediabox_data
+
+
+def parse_document(translation_config: TranslationConfig, doc_pdf: Document, temp_pdf_path: Path, mediabox_data: Dict[int, Any]):
+    """解析PDF并完成版面分析，返回源语言侧的中间表示"""
+    docs = parse_prepared_pdf_with_new_parser_to_legacy_ir(
+        temp_pdf_path,
+        config=translation_config,
+        doc_pdf=doc_pdf,
+    )
+    if check_cid_char(docs):
+        raise ExtractTextError("The document contains too many CID chars.")
+
+    if not translation_config.skip_scanned_detection:
+        DetectScannedFile(translation_config).process(docs, temp_pdf_path, mediabox_data)
+
+    docs = LayoutParser(translation_config).process(docs, doc_pdf)
+    close_process_pool()
+
+    if translation_config.table_model:
+        docs = TableParser(translation_config).process(docs, doc_pdf)
+    ParagraphFinder(translation_config).process(docs)
+    StylesAndFormulas(translation_config).process(docs)
+    return docs
+
+
+def translate_il(translation_config: TranslationConfig, docs):
+    """提取术语并翻译中间表示中的段落（唯一调用LLM的阶段）"""
+    translate_engine = translation_config.translator
+    term_extraction_engine = translation_config.get_term_extraction_translator()
+
+    if translation_config.auto_extract_glossary and translator_supports_llm(term_extraction_engine):
+        AutomaticTermExtractor(term_extraction_engine, translation_config).procress(docs)
+
+    if translator_supports_llm(translate_engine):
+        il_translator = ILTranslatorLLMOnly(translate_engine, translation_config)
+    else:
+        il_translator = ILTranslator(translate_engine, translation_config)
+    il_translator.translate(docs)
+
+
+def render_document(translation_config: TranslationConfig, docs, doc_pdf: Document, temp_pdf_path: Path, mediabox_data: Dict[int, Any]) -> TranslateResult:
+    """排版并生成PDF，按水印模式合并首页水印"""
+    mono_watermark_first_page = None
+    dual_watermark_first_page = None
+    try:
+        if translation_config.watermark_output_mode == WatermarkOutputMode.Both:
+            mono_watermark_first_page, dual_watermark_first_page = generate_first_page_with_watermark(
+                doc_pdf, translation_config, docs, mediabox_data
+            )
+    except Exception:
+        logger.warning("Failed to generate watermark for first page, using no watermark")
+        translation_config.watermark_output_mode = WatermarkOutputMode.NoWatermark
+        mono_watermark_first_page = None
+        dual_watermark_first_page = None
+
+    Typesetting(translation_config).typesetting_document(docs)
+
+    result = PDFCreater(str(temp_pdf_path), docs, translation_config, mediabox_data).write(translation_config)
+    try:
+        if mono_watermark_first_page:
+            result.mono_pdf_path = merge_watermark_doc(result.mono_pdf_path, mono_watermark_first_page, translation_config)
+    except Exception:
+        result.mono_pdf_path = result.no_watermark_mono_pdf_path
+    try:
+        if dual_watermark_first_page:
+            result.dual_pdf_path = merge_watermark_doc(result.dual_pdf_path, dual_watermark_first_page, translation_config)
+    except Exception:
+        result.dual_pdf_path = result.no_watermark_dual_pdf_path
+    return result
+
+
+def finalize_result(translation_config: TranslationConfig, result: TranslateResult, start_time: float) -> TranslateResult:
+    """与babeldoc一致的收尾处理：修复cmap、写入元数据、迁移目录"""
+    result.total_seconds = time.time() - start_time
+    result.original_pdf_path = translation_config.input_file
+    fix_cmap(result, translation_config)
+    add_metadata(result, translation_config)
+    try:
+        migrate_toc(translation_config, result)
+    except Exception as e:
+        logger.error(f"Failed to migrate TOC from {translation_config.input_file}: {e}")
+    return result
+
+
+def page_fingerprint(page) -> str:
+    """
+    页面源文指纹：页面尺寸 + 每个段落的位置、文本、版面标签与字体。
+    必须在翻译前计算，指纹相同的页面解析出的段落一一对应
+    """
+    def box_key(box):
+        return None if box is None else (round(box.x, 1), round(box.y, 1), round(box.x2, 1), round(box.y2, 1))
+
+    parts = [box_key(page.mediabox.box if page.mediabox else None), box_key(page.cropbox.box if page.cropbox else None)]
+    for paragraph in page.pdf_paragraph:
+        style = paragraph.pdf_style
+        parts.append((
+            box_key(paragraph.box),
+            paragraph.unicode,
+            paragraph.layout_label,
+            paragraph.xobj_id,
+            style.font_id if style else None,
+            round(style.font_size, 1) if style and style.font_size else None,
+        ))
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+
+def splice_cached_pages(docs, base_state: Dict[str, Any], fingerprints: List[str]) -> List[Any]:
+    """把指纹未变页面的译文从旧版本IR拷贝过来，返回仍需翻译的页面"""
+    base_pages = {}
+    # 旧版本没有记录页面指纹时，所有页面都需要翻译
+    base_fingerprints = base_state.get("page_fingerprints")
+    if base_fingerprints:
+        for base_page, fingerprint in zip(base_state["docs"].page, base_fingerprints, strict=True):
+            base_pages.setdefault(fingerprint, base_page)
+
+    changed_pages = []
+    for page, fingerprint in zip(docs.page, fingerprints, strict=True):
+        base_page = base_pages.get(fingerprint)
+        if base_page is None or len(base_page.pdf_paragraph) != len(page.pdf_paragraph):
+            changed_pages.append(page)
+            continue
+        for paragraph, base_paragraph in zip(page.pdf_paragraph, base_page.pdf_paragraph, strict=True):
+            paragraph.unicode = base_paragraph.unicode
+            paragraph.pdf_paragraph_composition = copy.deepcopy(base_paragraph.pdf_paragraph_composition)
+    return changed_pages
+
+
+def dump_il_state(il_path: Path, docs, mediabox_data: Dict[int, Any], page_fingerprints: Optional[List[str]]):
+    """先写临时文件再替换，中途被杀不会留下不完整的中间表示"""
+    temp_path = il_path.with_suffix(".tmp")
+    with open(temp_path, "wb") as f:
+        pickle.dump(
+            {
+                "babeldoc_version": babeldoc.__version__,
+                "docs": docs,
+                "mediabox_data": mediabox_data,
+                "page_fingerprints": page_fingerprints,
+            },
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    temp_path.replace(il_path)
+
+
+def save_translated_il(translation_config: TranslationConfig, docs, mediabox_data: Dict[int, Any], page_fingerprints: Optional[List[str]] = None):
+    """保存翻译后、排版前的中间表示，供之后重新渲染或增量翻译"""
+    dump_il_state(translation_config.get_working_file_path(TRANSLATED_IL_FILE), docs, mediabox_data, page_fingerprints)
+
+
+def load_il_state(working_dir: Path, file_name: str = TRANSLATED_IL_FILE) -> Dict[str, Any]:
+    """读取working_dir中保存的中间表示"""
+    with open(Path(working_dir) / file_name, "rb") as f:
+        state = pickle.load(f)
+    if state.get("babeldoc_version") != babeldoc.__version__:
+        raise ValueError(f"中间表示由BabelDOC {state.get('babeldoc_version')} 生成，与当前版本 {babeldoc.__version__} 不兼容")
+    return state
+
+
+def load_translated_il(translation_config: TranslationConfig):
+    """读取保存的中间表示，返回 (docs, mediabox_data)"""
+    state = load_il_state(translation_config.working_dir)
+    return state["docs"], state["mediabox_data"]
+
+
+def get_effective_working_dir(working_dir: Path, input_file: Path) -> Path:
+    """TranslationConfig实际使用的working_dir：指定目录下以输入文件名命名的子目录"""
+    return Path(working_dir) / Path(input_file).stem
+
+
+def has_translated_il(working_dir: Optional[Path]) -> bool:
+    """working_dir中是否保留了可用于重新渲染的中间表示"""
+    return bool(working_dir) and (Path(working_dir) / TRANSLATED_IL_FILE).exists() and (Path(working_dir) / PREPARED_INPUT_FILE).exists()
+
+
+def has_parse_checkpoint(working_dir: Optional[Path]) -> bool:
+    """working_dir中是否保存了解析完成后的源文IR"""
+    return bool(working_dir) and (Path(working_dir) / PARSED_IL_FILE).exists() and (Path(working_dir) / PREPARED_INPUT_FILE).exists()
+
+
+def remove_checkpoint(working_dir: Path):
+    """任务完成后删除检查点，保留供重新渲染的中间表示"""
+    for file_name in CHECKPOINT_FILES:
+        (Path(working_dir) / file_name).unlink(missing_ok=True)
+
+
+def prepare_and_parse(translation_config: TranslationConfig, checkpoint: bool) -> Tuple[Document, Path, Dict[int, Any], Any, List[str]]:
+    """
+    准备并解析输入，返回 (pymupdf文档, 预处理后的PDF路径, mediabox数据, 源文IR, 页面指纹)。
+    checkpoint为True时优先从解析检查点恢复，否则解析完成后保存检查点
+    """
+    if checkpoint and has_parse_checkpoint(translation_config.working_dir):
+        try:
+            state = load_il_state(translation_config.working_dir, PARSED_IL_FILE)
+            temp_pdf_path = translation_config.get_working_file_path(PREPARED_INPUT_FILE)
+            logger.info(f"resume from parse checkpoint: {translation_config.working_dir}")
+            return Document(str(temp_pdf_path)), temp_pdf_path, state["mediabox_data"], state["docs"], state["page_fingerprints"]
+        except Exception as e:
+            logger.warning(f"Failed to load parse checkpoint from {translation_config.working_dir}, parse again: {e}")
+
+    check_input_metadata(translation_config)
+    doc_pdf, temp_pdf_path, mediabox_data = prepare_input(translation_config)
+    docs = parse_document(translation_config, doc_pdf, temp_pdf_path, mediabox_data)
+    fingerprints = [page_fingerprint(page) for page in docs.page]
+    if checkpoint:
+        dump_il_state(translation_config.get_working_file_path(PARSED_IL_FILE), docs, mediabox_data, fingerprints)
+    return doc_pdf, temp_pdf_path, mediabox_data, docs, fingerprints
+
+
+@contextmanager
+def segment_checkpoint(translation_config: TranslationConfig, checkpoint_interval: Optional[float]) -> Iterator[None]:
+    """翻译期间把已译段落记入working_dir中的日志，每checkpoint_interval秒刷写到磁盘"""
+    if checkpoint_interval is None:
+        yield
+        return
+    translator = translation_config.translator
+    journal = segment_journal.attach(translator, translation_config.get_working_file_path(SEGMENT_JOURNAL_FILE), checkpoint_interval)
+    try:
+        yield
+    finally:
+        segment_journal.detach(translator, journal)
+
+
+def translate_pages(
+    translation_config: TranslationConfig,
+    docs,
+    fingerprints: List[str],
+    base_working_dir: Optional[Path] = None,
+    incremental_stats: Optional[Dict[str, int]] = None,
+):
+    """翻译源文IR；指定base_working_dir时只翻译与旧版本指纹不同的页面"""
+    pages_to_translate = docs.page
+    if base_working_dir:
+        try:
+            pages_to_translate = splice_cached_pages(docs, load_il_state(base_working_dir), fingerprints)
+        except Exception as e:
+            logger.warning(f"Failed to load base il from {base_working_dir}, translate all pages: {e}")
+        logger.info(f"incremental translate: {len(docs.page) - len(pages_to_translate)} pages reused, {len(pages_to_translate)} pages to translate")
+    if incremental_stats is not None:
+        incremental_stats["reused_pages"] = len(docs.page) - len(pages_to_translate)
+        incremental_stats["translated_pages"] = len(pages_to_translate)
+
+    if pages_to_translate:
+        # 只把需要翻译的页面交给翻译阶段，随后恢复完整页面列表
+        all_pages = docs.page
+        docs.page = pages_to_translate
+        try:
+            translate_il(translation_config, docs)
+        finally:
+            docs.page = all_pages
+
+
+def check_input_metadata(translation_config: TranslationConfig):
+    """拒绝BabelDOC自己生成的PDF，其他元数据错误只记录警告"""
+    try:
+        check_metadata(Document(translation_config.input_file))
+    except InputFileGeneratedByBabelDOCError:
+        raise
+    except Exception as e:
+        logger.warning(f"Error in check metadata, continue: {e}")
+
+
+def run_with_monitor(pm: ProgressMonitor, translation_config: TranslationConfig, body: Callable[[], Any], finalize: bool = True):
+    """与babeldoc.do_translate相同的进度与异常处理外壳；finalize为False时body的返回值原样作为结果"""
+    try:
+        translation_config.progress_monitor = pm
+        # 任务取消后，合并器中尚未发送的请求随之丢弃（见request_packer）
+        translation_config.translator.cancel_event = pm.cancel_event
+        start_time = time.time()
+        result = body()
+        if finalize:
+            result = finalize_result(translation_config, result, start_time)
+        pm.translate_done(result)
+        return result
+    except Exception as e:
+        logger.error(f"translate error: {e}")
+        pm.disable = False
+        pm.translate_error(e)
+        raise
+    finally:
+        pm.on_finish()
+        translation_config.cleanup_temp_files()
+
+
+def run_translate(
+    pm: ProgressMonitor,
+    translation_config: TranslationConfig,
+    keep_il: bool = True,
+    base_working_dir: Optional[Path] = None,
+    incremental_stats: Optional[Dict[str, int]] = None,
+    checkpoint_interval: Optional[float] = None,
+) -> TranslateResult:
+    """
+    完整翻译；keep_il为True时保存翻译后的中间表示。
+    指定base_working_dir时按修订版增量翻译，只翻译与旧版本指纹不同的页面，
+    复用/翻译的页数写入incremental_stats。
+    指定checkpoint_interval时保存检查点，并从已有的检查点继续
+    """
+    def body():
+        logger.info(f"start to translate: {translation_config.input_file}")
+        checkpoint = checkpoint_interval is not None
+        doc_pdf, temp_pdf_path, mediabox_data, docs, fingerprints = prepare_and_parse(translation_config, checkpoint)
+        with segment_checkpoint(translation_config, checkpoint_interval):
+            translate_pages(translation_config, docs, fingerprints, base_working_dir, incremental_stats)
+        if keep_il:
+            save_translated_il(translation_config, docs, mediabox_data, fingerprints)
+        return render_document(translation_config, docs, doc_pdf, temp_pdf_path, mediabox_data)
+
+    return run_with_monitor(pm, translation_config, body)
+
+
+def run_parse(pm: ProgressMonitor, translation_config: TranslationConfig) -> Dict[str, str]:
+    """
+    只执行准备与解析阶段，把多个目标语言共用的源文IR保存到working_dir，
+    返回 {"working_dir": 源文IR所在目录}。working_dir中已有解析结果时直接沿用
+    """
+    def body():
+        logger.info(f"start to parse: {translation_config.input_file}")
+        doc_pdf, _, _, _, _ = prepare_and_parse(translation_config, checkpoint=True)
+        doc_pdf.close()
+        return {"working_dir": translation_config.working_dir}
+
+    return run_with_monitor(pm, translation_config, body, finalize=False)
+
+
+def run_translate_from_source(
+    pm: ProgressMonitor,
+    translation_config: TranslationConfig,
+    source: Dict[str, str],
+    keep_il: bool = True,
+    base_working_dir: Optional[Path] = None,
+    incremental_stats: Optional[Dict[str, int]] = None,
+    checkpoint_interval: Optional[float] = None,
+) -> TranslateResult:
+    """
+    读取run_parse保存的源文IR，翻译并渲染一个目标语言；
+    指定checkpoint_interval时已译段落记入本语言working_dir中的日志
+    """
+    def body():
+        logger.info(f"start to translate {translation_config.lang_out} from shared source: {translation_config.input_file}")
+        state = load_il_state(source["working_dir"], PARSED_IL_FILE)
+        temp_pdf_path = translation_config.get_working_file_path(PREPARED_INPUT_FILE)
+        shutil.copyfile(Path(source["working_dir"]) / PREPARED_INPUT_FILE, temp_pdf_path)
+        doc_pdf = Document(str(temp_pdf_path))
+        docs, mediabox_data, fingerprints = state["docs"], state["mediabox_data"], state["page_fingerprints"]
+        with segment_checkpoint(translation_config, checkpoint_interval):
+            translate_pages(translation_config, docs, fingerprints, base_working_dir, incremental_stats)
+        if keep_il:
+            save_translated_il(translation_config, docs, mediabox_data, fingerprints)
+        return render_document(translation_config, docs, doc_pdf, temp_pdf_path, mediabox_data)
+
+    return run_with_monitor(pm, translation_config, body)
+
+
+def run_render(pm: ProgressMonitor, translation_config: TranslationConfig) -> TranslateResult:
+    """只执行排版与渲染阶段，从保存的中间表示重新生成PDF，不调用LLM"""
+    def body():
+        logger.info(f"start to render from cached il: {translation_config.working_dir}")
+        docs, mediabox_data = load_translated_il(translation_config)
+        temp_pdf_path = translation_config.get_working_file_path(PREPARED_INPUT_FILE)
+        doc_pdf = Document(str(temp_pdf_path))
+        return render_document(translation_config, docs, doc_pdf, temp_pdf_path, mediabox_data)
+
+    return run_with_monitor(pm, translation_config, body)
+
+
+async def async_run(translation_config: TranslationConfig, target: Callable, stages: List[Tuple[str, float]], **kwargs):
+    """
+    在线程池中执行target(pm, translation_config, **kwargs)，并以
+    babeldoc.async_translate相同格式的事件字典逐个产出进度
+    """
+    loop = asyncio.get_running_loop()
+    callback = asynchronize.AsyncCallback()
+
+    finish_event = asyncio.Event()
+    cancel_event = threading.Event()
+    with ProgressMonitor(
+        stages,
+        progress_change_callback=callback.step_callback,
+        finish_callback=callback.finished_callback,
+        finish_event=finish_event,
+        cancel_event=cancel_event,
+        loop=loop,
+        report_interval=translation_config.report_interval,
+    ) as pm:
+        # 在调用方的上下文中执行，流水线线程的日志同样带有任务ID
+        context = contextvars.copy_context()
+        future = loop.run_in_executor(None, context.run, functools.partial(target, pm, translation_config, **kwargs))
+        try:
+            async for event in callback:
+                event = event.kwargs
+                yield event
+                if event["type"] == "error":
+                    break
+        except CancelledError:
+            cancel_event.set()
+    if cancel_event.is_set():
+        future.cancel()
+    await finish_event.wait()
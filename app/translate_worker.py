@@ -0,0 +1,545 @@
+"""
+翻译任务的执行：本进程内执行，或交给独立的工作进程池
+
+任务以可序列化的描述(job)传递：type(translate/parse/translate_from_source/render)、
+pdf_file、request(TranslationRequest的字典)、output_dir、working_dir 与流水线参数
+kwargs。TranslationConfig、翻译器与版面分析模型都在执行任务的进程中创建，
+API服务进程本身不加载模型。
+
+工作进程池中每个进程同一时间只执行一个任务。进程启动后先预热（加载版面分析
+模型；字体由forkserver预先加载，各工作进程共享，见font_cache）再接收任务；
+处理的任务数或RSS相对预热后的增长超过阈值时回收：先启动并预热替代进程，
+替代进程就绪后旧进程不再接收新任务，当前任务结束后退出，进行中的任务不会被
+中断。工作进程意外退出（如被OOM终止）只影响其正在执行的任务，池会补充新的
+进程。工作进程的日志经outbox转发，由服务进程统一写入（见log_pipeline）。
+"""
+import asyncio
+import gc
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+import psutil
+
+import babeldoc.format.pdf.high_level
+from babeldoc.format.pdf.translation_config import TranslationConfig, WatermarkOutputMode
+from babeldoc.translator.translator import OpenAITranslator, set_translate_rate_limiter
+
+import font_cache
+import log_pipeline
+import request_packer
+import single_flight
+import endpoint_pool
+import llm_usage
+import rate_limiter
+import translate_pipeline
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# 等待工作进程消息的超时（秒），超时后检查是否有进程意外退出
+WORKER_POLL_INTERVAL = 1.0
+# 回收工作进程时等待其退出的时间（秒）
+WORKER_STOP_TIMEOUT = 30
+# 工作进程连续多少次在预热完成前退出后停止补充（通常是模型或字体无法加载）
+WORKER_MAX_STARTUP_FAILURES = 3
+# 工作进程上报接口池统计的间隔（秒）
+ENDPOINT_STATS_INTERVAL = 5.0
+
+# 任务类型 -> (流水线函数, 阶段列表)
+JOB_TARGETS = {
+    "translate": (translate_pipeline.run_translate, babeldoc.format.pdf.high_level.get_translation_stage),
+    "parse": (translate_pipeline.run_parse, translate_pipeline.get_source_stages),
+    "translate_from_source": (translate_pipeline.run_translate_from_source, translate_pipeline.get_target_stages),
+    "render": (translate_pipeline.run_render, translate_pipeline.get_render_stages),
+}
+
+
+def build_translation_config(
+    settings: Dict[str, Any],
+    request: Dict[str, Any],
+    pdf_file: Path,
+    output_dir: Path,
+    working_dir: Optional[Path],
+    doc_layout_model,
+) -> TranslationConfig:
+    translation_settings = settings["translation"]
+    lang_in = request.get("lang_in") or translation_settings["default_lang_in"]
+    lang_out = request.get("lang_out") or translation_settings["default_lang_out"]
+    # 使用配置文件中的OpenAI设置
+    translator_options = dict(
+        lang_in=lang_in,
+        lang_out=lang_out,
+        model=settings["openai"]["model"],
+        base_url=settings["openai"]["base_url"],
+        api_key=settings["openai"]["api_key"],
+        ignore_cache=False,
+    )
+    translator_class = OpenAITranslator
+    if settings["packing"]["enabled"]:
+        # 短请求跨页面、跨任务合并发送
+        translator_class = request_packer.PackingTranslator
+        translator_options["packer"] = request_packer.get_packer(settings["packing"])
+    if translation_settings["dedup"]:
+        # 并发的相同请求只调用一次LLM
+        translator_class = single_flight.with_single_flight(translator_class)
+    translator = llm_usage.with_usage_meter(translator_class)(**translator_options)
+    if settings["endpoints"]["endpoints"]:
+        # 请求分发到多个接口，各接口有自己的QPS配额
+        translator.client = endpoint_pool.get_pool(settings["endpoints"]).client
+    # 统计调用次数、token用量、重试与限流等待
+    llm_usage.attach(translator)
+
+    watermark_output_mode = request.get("watermark_output_mode") or translation_settings["watermark_output_mode"]
+    watermark_mode = WatermarkOutputMode.Watermarked
+    if watermark_output_mode == "no_watermark":
+        watermark_mode = WatermarkOutputMode.NoWatermark
+    elif watermark_output_mode == "both":
+        watermark_mode = WatermarkOutputMode.Both
+
+    return TranslationConfig(
+        input_file=str(pdf_file),
+        font=None,
+        pages=None,
+        output_dir=str(output_dir),
+        translator=translator,
+        debug=False,
+        lang_in=lang_in,
+        lang_out=lang_out,
+        no_dual=request["no_dual"] if request.get("no_dual") is not None else translation_settings["no_dual"],
+        no_mono=request["no_mono"] if request.get("no_mono") is not None else translation_settings["no_mono"],
+        qps=request.get("qps") or settings["server"]["qps"],
+        formular_font_pattern=None,
+        formular_char_pattern=None,
+        split_short_lines=False,
+        short_line_split_factor=0.8,
+        doc_layout_model=doc_layout_model,
+        skip_clean=False,
+        dual_translate_first=False,
+        disable_rich_text_translate=False,
+        enhance_compatibility=False,
+        use_alternating_pages_dual=False,
+        report_interval=0.1,
+        min_text_length=5,
+        watermark_output_mode=watermark_mode,
+        split_strategy=None,
+        table_model=None,
+        show_char_box=False,
+        skip_scanned_detection=False,
+        ocr_workaround=bool(request.get("ocr_workaround")),
+        custom_system_prompt=None,
+        working_dir=str(working_dir) if working_dir else None,
+        add_formula_placehold_hint=False,
+        glossaries=[],
+        pool_max_workers=None,
+        auto_extract_glossary=True,
+        auto_enable_ocr_workaround=False,
+        primary_font_family=None,
+        only_include_translated_page=False,
+        save_auto_extracted_glossary=False,
+    )
+
+
+async def run_job(job: Dict[str, Any], settings: Dict[str, Any], doc_layout_model) -> AsyncIterator[Dict[str, Any]]:
+    """
+    在当前进程中执行任务，产出与translate_pipeline.async_run相同格式的事件；
+    parse任务的事件附带source_share（解析阶段在完整翻译进度中的占比）
+    """
+    translation_config = build_translation_config(
+        settings, job["request"], job["pdf_file"], job["output_dir"], job["working_dir"], doc_layout_model
+    )
+    # 任务的qps设置全局的请求间隔；工作进程中为各进程共用的限流器（见rate_limiter）
+    set_translate_rate_limiter(job["request"].get("qps") or settings["server"]["qps"])
+
+    target, get_stages = JOB_TARGETS[job["type"]]
+    stages = get_stages(translation_config)
+    if (
+        job["type"] == "translate"
+        and job["kwargs"].get("checkpoint_interval") is not None
+        and translate_pipeline.has_parse_checkpoint(translation_config.working_dir)
+    ):
+        # 从解析检查点继续的任务跳过准备与解析阶段
+        stages = translate_pipeline.get_target_stages(translation_config)
+    extra = {}
+    if job["type"] == "parse":
+        all_stages = babeldoc.format.pdf.high_level.get_translation_stage(translation_config)
+        extra["source_share"] = sum(w for _, w in stages) / sum(w for _, w in all_stages)
+
+    usage = translation_config.translator.usage
+    async for event in translate_pipeline.async_run(translation_config, target, stages, **job["kwargs"]):
+        event.update(extra)
+        if event["type"] in ("progress_update", "finish", "error"):
+            # LLM用量随事件带回，由服务进程汇总
+            event["usage"] = usage.snapshot()
+        yield event
+    snapshot = usage.snapshot()
+    if snapshot["requests"]:
+        logger.info(
+            f"LLM usage for {job['type']} [{translation_config.lang_out}]: {snapshot['llm_calls']} calls, "
+            f"{snapshot['total_tokens']} tokens, {snapshot['cache_hits']} cache hits, {snapshot['shared_calls']} shared calls, "
+            f"{snapshot['retries']} retries, {snapshot['rate_limit_wait_seconds']:.1f}s waiting for rate limit",
+            extra={"llm_usage": snapshot}
+        )
+
+
+def worker_main(worker_id: int, settings: Dict[str, Any], rate_limits: Dict[str, Any], inbox, outbox):
+    """工作进程入口：预热后循环执行inbox中的任务，事件写入outbox"""
+    log_pipeline.forward_to(outbox, settings["logging"]["level"])
+    logging.getLogger("httpx").setLevel("WARNING")
+    logging.getLogger("openai").setLevel("WARNING")
+    # 各工作进程的翻译请求共用服务与各接口的QPS配额
+    rate_limiter.install(rate_limits["translate"])
+    if settings["endpoints"]["endpoints"]:
+        endpoint_pool.get_pool(settings["endpoints"], rate_limits["endpoints"])
+
+    babeldoc.format.pdf.high_level.init()
+    import layout_batcher
+    doc_layout_model = layout_batcher.load_layout_model(settings["layout"])
+    # 以forkserver启动时字体已在forkserver中加载，这里只需安装缓存
+    font_cache.preload()
+
+    process = psutil.Process()
+    outbox.put(("ready", worker_id, os.getpid(), process.memory_info().rss))
+    asyncio.run(worker_loop(worker_id, settings, doc_layout_model, inbox, outbox))
+
+
+async def worker_loop(worker_id: int, settings: Dict[str, Any], doc_layout_model, inbox, outbox):
+    loop = asyncio.get_running_loop()
+    process = psutil.Process()
+    current: Dict[int, asyncio.Task] = {}
+
+    async def execute(job_id: int, job: Dict[str, Any]):
+        log_pipeline.current_task_id.set(job.get("task_id"))
+        try:
+            async for event in run_job(job, settings, doc_layout_model):
+                if event["type"] == "error":
+                    event["error"] = str(event.get("error", "未知错误"))
+                elif event["type"] == "finish" and job["kwargs"].get("incremental_stats") is not None:
+                    # 流水线在本进程中更新的统计随完成事件带回
+                    event["incremental_stats"] = job["kwargs"]["incremental_stats"]
+                outbox.put(("event", job_id, event))
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}", exc_info=True)
+            outbox.put(("event", job_id, {"type": "error", "error": str(e)}))
+        finally:
+            current.pop(job_id, None)
+            gc.collect()
+            outbox.put(("done", worker_id, job_id, process.memory_info().rss))
+
+    async def report_endpoint_stats():
+        while True:
+            await asyncio.sleep(ENDPOINT_STATS_INTERVAL)
+            if endpoint_pool.pool:
+                outbox.put(("endpoints", worker_id, endpoint_pool.pool.stats()))
+
+    reporter = asyncio.create_task(report_endpoint_stats())
+    while True:
+        message = await loop.run_in_executor(None, inbox.get)
+        if message[0] == "job":
+            _, job_id, job = message
+            current[job_id] = asyncio.create_task(execute(job_id, job))
+        elif message[0] == "cancel":
+            running = current.get(message[1])
+            if running:
+                running.cancel()
+        elif message[0] == "stop":
+            if current:
+                await asyncio.gather(*current.values(), return_exceptions=True)
+            reporter.cancel()
+            return
+
+
+class WorkerProcess:
+    def __init__(self, worker_id: int, process, inbox, replaces: Optional[int] = None):
+        self.worker_id = worker_id
+        self.process = process
+        self.inbox = inbox
+        self.replaces = replaces  # 被本进程替代、等待回收的旧进程
+        self.pid: Optional[int] = None
+        self.ready = False
+        self.retiring = False  # 不再接收新任务，当前任务结束后退出
+        self.replacement: Optional[int] = None
+        self.job_id: Optional[int] = None
+        self.tasks_done = 0
+        self.baseline_rss = 0
+        self.rss = 0
+        self.endpoint_stats: List[Dict[str, Any]] = []  # 最近一次上报的接口池统计
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "worker_id": self.worker_id,
+            "pid": self.pid,
+            "ready": self.ready,
+            "busy": self.job_id is not None,
+            "retiring": self.retiring,
+            "tasks_done": self.tasks_done,
+            "rss_mb": round(self.rss / MB, 1),
+            "rss_growth_mb": round((self.rss - self.baseline_rss) / MB, 1),
+        }
+
+
+class WorkerPool:
+    """固定数量的翻译工作进程，按任务数或RSS增长回收"""
+
+    def __init__(self, size: int, max_tasks: int, max_rss_growth_mb: float, settings: Dict[str, Any]):
+        self.size = size
+        self.max_tasks = max_tasks
+        self.max_rss_growth_mb = max_rss_growth_mb
+        self.settings = settings
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            # forkserver预先加载字体，工作进程fork后共享这部分只读内存。Python 3.11的
+            # forkserver不继承sys.path，font_preload要能从工作目录导入（Docker中为/app），
+            # 导入失败时各工作进程自行加载字体
+            self.context = multiprocessing.get_context("forkserver")
+            self.context.set_forkserver_preload(["font_preload"])
+        else:
+            self.context = multiprocessing.get_context("spawn")
+        self.outbox = self.context.Queue()
+        # 服务与各接口的QPS配额，由所有工作进程共用
+        self.rate_limits = rate_limiter.create_states(self.context, settings)
+        self.workers: Dict[int, WorkerProcess] = {}
+        self.worker_ids = itertools.count()
+        self.job_ids = itertools.count()
+        self.job_streams: Dict[int, asyncio.Queue] = {}
+        self.recycled = 0
+        self.retired_endpoint_stats: List[Dict[str, Any]] = []  # 已退出工作进程的累计接口统计
+        self.startup_failures = 0
+        self.failure: Optional[str] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.worker_available: Optional[asyncio.Event] = None
+        self.stopping = False
+        self.reader: Optional[threading.Thread] = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.worker_available = asyncio.Event()
+        for _ in range(self.size):
+            self.spawn_worker()
+        self.reader = threading.Thread(target=self.read_outbox, name="translate-worker-reader", daemon=True)
+        self.reader.start()
+
+    async def stop(self):
+        self.stopping = True
+        for worker in list(self.workers.values()):
+            worker.inbox.put(("stop",))
+        await asyncio.gather(*(self.join_worker(worker) for worker in list(self.workers.values())))
+        self.workers.clear()
+
+    def spawn_worker(self, replaces: Optional[int] = None) -> WorkerProcess:
+        worker_id = next(self.worker_ids)
+        inbox = self.context.Queue()
+        process = self.context.Process(
+            target=worker_main,
+            args=(worker_id, self.settings, self.rate_limits, inbox, self.outbox),
+            name=f"translate-worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        worker = WorkerProcess(worker_id, process, inbox, replaces)
+        self.workers[worker_id] = worker
+        logger.info(f"Started translate worker {worker_id} (pid {process.pid})" + (f" to replace worker {replaces}" if replaces is not None else ""))
+        return worker
+
+    async def join_worker(self, worker: WorkerProcess):
+        await asyncio.to_thread(worker.process.join, WORKER_STOP_TIMEOUT)
+        if worker.process.is_alive():
+            worker.process.kill()
+            await asyncio.to_thread(worker.process.join)
+
+    def retire_worker(self, worker: WorkerProcess):
+        """旧进程空闲时立即退出，否则当前任务结束后退出"""
+        worker.retiring = True
+        if worker.job_id is not None:
+            return
+        self.remove_worker(worker)
+        worker.inbox.put(("stop",))
+        self.recycled += 1
+        logger.info(f"Retired translate worker {worker.worker_id} after {worker.tasks_done} tasks, RSS {worker.rss / MB:.0f}MB")
+        self.loop.create_task(self.join_worker(worker))
+
+    def remove_worker(self, worker: WorkerProcess):
+        """移出进程表，其接口统计计入已退出进程的累计值"""
+        self.workers.pop(worker.worker_id, None)
+        if worker.endpoint_stats:
+            self.retired_endpoint_stats = endpoint_pool.merge_stats(
+                [self.retired_endpoint_stats, endpoint_pool.retired_stats(worker.endpoint_stats)]
+            )
+
+    def endpoint_stats(self) -> Optional[List[Dict[str, Any]]]:
+        reports = [worker.endpoint_stats for worker in self.workers.values() if worker.endpoint_stats]
+        if not reports:
+            return self.retired_endpoint_stats or None
+        return endpoint_pool.merge_stats([self.retired_endpoint_stats] + reports)
+
+    def maybe_recycle(self, worker: WorkerProcess):
+        if worker.retiring or worker.replacement is not None:
+            return
+        rss_growth_mb = (worker.rss - worker.baseline_rss) / MB
+        if worker.tasks_done < self.max_tasks and rss_growth_mb < self.max_rss_growth_mb:
+            return
+        logger.info(f"Recycling translate worker {worker.worker_id}: {worker.tasks_done} tasks, RSS growth {rss_growth_mb:.0f}MB")
+        worker.replacement = self.spawn_worker(replaces=worker.worker_id).worker_id
+
+    def read_outbox(self):
+        """后台线程：把工作进程的消息转交给事件循环，日志记录直接交给本进程的日志队列"""
+        while not self.stopping:
+            try:
+                message = self.outbox.get(timeout=WORKER_POLL_INTERVAL)
+            except queue.Empty:
+                message = None
+            except (EOFError, OSError):
+                return
+            if message is not None and message[0] == "log":
+                record = message[1]
+                logging.getLogger(record.name).handle(record)
+                continue
+            try:
+                if message is None:
+                    self.loop.call_soon_threadsafe(self.check_workers)
+                else:
+                    self.loop.call_soon_threadsafe(self.handle_message, message)
+            except RuntimeError:
+                # 事件循环已关闭
+                return
+
+    def handle_message(self, message):
+        kind = message[0]
+        if kind == "event":
+            _, job_id, event = message
+            stream = self.job_streams.get(job_id)
+            if stream:
+                stream.put_nowait(event)
+        elif kind == "endpoints":
+            _, worker_id, stats = message
+            worker = self.workers.get(worker_id)
+            if worker:
+                worker.endpoint_stats = stats
+        elif kind == "ready":
+            _, worker_id, pid, rss = message
+            worker = self.workers.get(worker_id)
+            if not worker:
+                return
+            worker.pid = pid
+            worker.ready = True
+            worker.baseline_rss = worker.rss = rss
+            self.startup_failures = 0
+            logger.info(f"Translate worker {worker_id} ready (RSS {rss / MB:.0f}MB)")
+            old_worker = self.workers.get(worker.replaces) if worker.replaces is not None else None
+            if old_worker:
+                self.retire_worker(old_worker)
+            self.worker_available.set()
+        elif kind == "done":
+            _, worker_id, job_id, rss = message
+            self.finish_job(job_id)
+            worker = self.workers.get(worker_id)
+            if not worker:
+                return
+            worker.job_id = None
+            worker.tasks_done += 1
+            worker.rss = rss
+            if worker.retiring:
+                self.retire_worker(worker)
+            else:
+                self.maybe_recycle(worker)
+            self.worker_available.set()
+
+    def finish_job(self, job_id: int):
+        stream = self.job_streams.get(job_id)
+        if stream:
+            stream.put_nowait(None)
+
+    def check_workers(self):
+        """处理意外退出的工作进程：其任务以错误结束，并补充新进程"""
+        for worker in list(self.workers.values()):
+            if worker.process.is_alive():
+                continue
+            self.remove_worker(worker)
+            logger.error(f"Translate worker {worker.worker_id} exited unexpectedly (exit code {worker.process.exitcode})")
+            if worker.job_id is not None:
+                stream = self.job_streams.get(worker.job_id)
+                if stream:
+                    stream.put_nowait({"type": "error", "error": f"翻译工作进程意外退出（退出码 {worker.process.exitcode}）"})
+                self.finish_job(worker.job_id)
+            self.worker_available.set()
+            if self.stopping:
+                continue
+            if not worker.ready:
+                self.startup_failures += 1
+                if self.startup_failures >= WORKER_MAX_STARTUP_FAILURES:
+                    self.failure = f"翻译工作进程连续{self.startup_failures}次启动失败，请检查日志"
+                    logger.error(self.failure)
+                    continue
+            old_worker = self.workers.get(worker.replaces) if worker.replaces is not None else None
+            if old_worker:
+                # 替代进程在预热中退出，旧进程继续服务，之后再尝试回收
+                old_worker.replacement = None
+                continue
+            replacement = self.workers.get(worker.replacement) if worker.replacement is not None else None
+            if replacement:
+                replacement.replaces = None
+            else:
+                self.spawn_worker()
+
+    async def acquire_worker(self) -> WorkerProcess:
+        while True:
+            for worker in self.workers.values():
+                if worker.ready and not worker.retiring and worker.job_id is None:
+                    return worker
+            if self.failure and not self.workers:
+                raise RuntimeError(self.failure)
+            self.worker_available.clear()
+            await self.worker_available.wait()
+
+    async def run(
+        self,
+        job: Dict[str, Any],
+        on_start: Optional[Callable[[int], None]] = None,
+        on_end: Optional[Callable[[int], None]] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """在空闲的工作进程中执行任务，产出与run_job相同的事件"""
+        worker = await self.acquire_worker()
+        job_id = next(self.job_ids)
+        stream: asyncio.Queue = asyncio.Queue()
+        self.job_streams[job_id] = stream
+        worker.job_id = job_id
+        if on_start:
+            on_start(worker.pid)
+        worker.inbox.put(("job", job_id, job))
+        finished = False
+        try:
+            while True:
+                event = await stream.get()
+                if event is None:
+                    finished = True
+                    return
+                if event["type"] in ("finish", "error"):
+                    finished = True
+                if event["type"] == "finish" and "incremental_stats" in event:
+                    job["kwargs"]["incremental_stats"].update(event.pop("incremental_stats"))
+                yield event
+        finally:
+            if not finished:
+                # 调用方取消或提前结束，通知工作进程取消该任务
+                worker.inbox.put(("cancel", job_id))
+            self.job_streams.pop(job_id, None)
+            if on_end:
+                on_end(worker.pid)
+
+    def baselines(self) -> Dict[int, int]:
+        """各就绪工作进程的pid到预热后基线RSS（字节），供内存统计扣除"""
+        return {worker.pid: worker.baseline_rss for worker in self.workers.values() if worker.ready}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": self.size,
+            "max_tasks": self.max_tasks,
+            "max_rss_growth_mb": self.max_rss_growth_mb,
+            "recycled": self.recycled,
+            "failure": self.failure,
+            "workers": [worker.to_dict() for worker in self.workers.values()],
+        }
@@ -0,0 +1,191 @@
+"""
+任务完成回调（webhook）
+
+提交任务时指定callback_url，任务结束（完成、失败或取消）时向该地址POST一次JSON通知，
+上游无需轮询/status。通知先写入SQLite发件箱再发送，服务重启后继续投递未送达的通知：
+- 发送失败（连接错误、超时、非2xx响应）按指数退避重试，达到最大次数后标记为dead，保留在发件箱中
+- 至少投递一次：同一通知可能重复送达，接收方按X-Webhook-Id去重
+- 配置WEBHOOK_SECRET时，X-Webhook-Signature为 "sha256=" + HMAC-SHA256(secret, "{timestamp}.{body}")，
+  X-Webhook-Timestamp为签名时的Unix时间戳，接收方可据此拒绝过期的重放请求
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import random
+import sqlite3
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (
+    id TEXT PRIMARY KEY,
+    task_id TEXT NOT NULL,
+    url TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL
+)
+"""
+# 每轮最多同时投递的通知数
+BATCH_SIZE = 32
+
+
+def sign(secret: str, timestamp: str, body: bytes) -> str:
+    digest = hmac.new(secret.encode(), timestamp.encode() + b"." + body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+class WebhookOutbox:
+    def __init__(self, settings: Dict[str, Any], user_agent: str = "BabelDOC-Translation-API"):
+        self.user_agent = user_agent
+        self.secret = settings["secret"]
+        self.timeout = settings["timeout"]
+        self.max_attempts = settings["max_attempts"]
+        self.backoff_base = settings["backoff_base"]
+        self.backoff_max = settings["backoff_max"]
+        path = Path(settings["outbox_path"])
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(SCHEMA)
+        self.wakeup = asyncio.Event()
+        self.client: Optional[httpx.AsyncClient] = None
+        self.runner: Optional[asyncio.Task] = None
+        self.delivered = 0
+        self.attempts = 0
+        self.failed_attempts = 0
+        self.dead = 0
+        self.latency_total = 0.0
+        self.last_error: Optional[str] = None
+
+    def enqueue(self, task_id: str, url: str, payload: Dict[str, Any]) -> str:
+        """写入发件箱，随后由投递循环发送"""
+        delivery_id = str(uuid.uuid4())
+        payload = {"id": delivery_id, **payload}
+        self.db.execute(
+            "INSERT INTO deliveries (id, task_id, url, payload, status, next_attempt_at, created_at) VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+            (delivery_id, task_id, url, json.dumps(payload, ensure_ascii=False), time.time(), time.time()),
+        )
+        self.wakeup.set()
+        return delivery_id
+
+    def ensure_running(self):
+        """在当前事件循环中启动投递循环（没有启动钩子的服务在写入通知时调用）"""
+        if self.runner is None or self.runner.done():
+            self.runner = asyncio.create_task(self.run())
+
+    async def run(self):
+        """投递循环：发送到期的通知，空闲时等待新通知或下一次重试时间"""
+        self.client = httpx.AsyncClient(timeout=self.timeout)
+        try:
+            while True:
+                # 先清除再查询，查询之后写入的通知会再次唤醒
+                self.wakeup.clear()
+                try:
+                    due = self.db.execute(
+                        "SELECT id, task_id, url, payload, attempts FROM deliveries WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                        (time.time(), BATCH_SIZE),
+                    ).fetchall()
+                    if due:
+                        await asyncio.gather(*(self.deliver(*row) for row in due))
+                        continue
+                    next_row = self.db.execute("SELECT MIN(next_attempt_at) FROM deliveries WHERE status = 'pending'").fetchone()
+                    delay = max(next_row[0] - time.time(), 0) if next_row[0] else None
+                except Exception as e:
+                    logger.error(f"Webhook outbox error: {e}", exc_info=True)
+                    delay = self.backoff_base
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.client.aclose()
+
+    async def deliver(self, delivery_id: str, task_id: str, url: str, payload: str, attempts: int):
+        body = payload.encode()
+        timestamp = str(int(time.time()))
+        headers = {
+            "Content-Type": "application/json",
+            "User-Agent": self.user_agent,
+            "X-Webhook-Id": delivery_id,
+            "X-Webhook-Timestamp": timestamp,
+            "X-Webhook-Attempt": str(attempts + 1),
+        }
+        if self.secret:
+            headers["X-Webhook-Signature"] = sign(self.secret, timestamp, body)
+        started = time.monotonic()
+        self.attempts += 1
+        try:
+            response = await self.client.post(url, content=body, headers=headers)
+            error = None if response.is_success else f"HTTP {response.status_code}"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:200]
+        if error is None:
+            self.delivered += 1
+            self.latency_total += time.monotonic() - started
+            self.db.execute("DELETE FROM deliveries WHERE id = ?", (delivery_id,))
+            logger.info(f"Delivered webhook {delivery_id} for task {task_id} to {url}")
+            return
+
+        attempts += 1
+        self.failed_attempts += 1
+        self.last_error = error
+        if attempts >= self.max_attempts:
+            self.dead += 1
+            self.db.execute(
+                "UPDATE deliveries SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?",
+                (attempts, error, delivery_id),
+            )
+            logger.error(f"Giving up webhook {delivery_id} for task {task_id} after {attempts} attempts: {error}")
+            return
+        # 指数退避，加入抖动避免接收方恢复时被集中重试
+        delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max) * random.uniform(0.8, 1.2)
+        self.db.execute(
+            "UPDATE deliveries SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+            (attempts, time.time() + delay, error, delivery_id),
+        )
+        logger.warning(f"Webhook {delivery_id} for task {task_id} failed ({error}), retrying in {delay:.1f}s")
+
+    def dead_letters(self, limit: int = 100) -> List[Dict[str, Any]]:
+        rows = self.db.execute(
+            "SELECT id, task_id, url, attempts, last_error, created_at FROM deliveries WHERE status = 'dead' ORDER BY created_at DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+        return [
+            {"id": row[0], "task_id": row[1], "url": row[2], "attempts": row[3], "last_error": row[4], "created_at": row[5]}
+            for row in rows
+        ]
+
+    def retry(self, delivery_id: str) -> bool:
+        """重新投递dead的通知"""
+        updated = self.db.execute(
+            "UPDATE deliveries SET status = 'pending', attempts = 0, next_attempt_at = ? WHERE id = ? AND status = 'dead'",
+            (time.time(), delivery_id),
+        ).rowcount
+        if updated:
+            self.wakeup.set()
+        return bool(updated)
+
+    def stats(self) -> Dict[str, Any]:
+        counts = dict(self.db.execute("SELECT status, COUNT(*) FROM deliveries GROUP BY status").fetchall())
+        return {
+            "pending": counts.get("pending", 0),
+            "dead": counts.get("dead", 0),
+            "delivered": self.delivered,
+            "attempts": self.attempts,
+            "failed_attempts": self.failed_attempts,
+            "gave_up": self.dead,
+            "avg_latency_ms": round(self.latency_total / self.delivered * 1000, 1) if self.delivered else None,
+            "last_error": self.last_error,
+        }
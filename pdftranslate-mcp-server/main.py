@@ -1,21 +1,40 @@
 import asyncio
+import atexit
 import logging
+import time
 import uuid
 import os
 import tempfile
 import shutil
+import threading
+import bisect
 import json
 import base64
+import hashlib
 import aiohttp
 import configparser
 from pathlib import Path
 from typing import Dict, Any, Optional, List, Union
+from collections import OrderedDict, deque
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import FastMCP, Context
+
+try:
+    import fcntl  # 仅类Unix系统可用，用于reflink
+except ImportError:
+    fcntl = None
 from dotenv import load_dotenv
 
+import log_pipeline
+import pdf_analysis
+import pdf_optimizer
+import segment_journal
+import single_flight
+import task_trace
+import webhook_outbox
+
 # 尝试导入腾讯云COS相关模块
 try:
     from qcloud_cos import CosConfig, CosS3Client
@@ -47,8 +66,8 @@ except ImportError as e:
     print("   uv pip install babeldoc")
     print(f"详细错误信息: {e}")
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 日志（与API服务共用log_pipeline）：调用方只做过滤与入队，格式化和写入在后台线程中进行，
+# 文件中每条记录为一行JSON，带有task_id与stage字段，按大小或时间轮转；在启动服务时安装
 logger = logging.getLogger(__name__)
 
 # 加载环境变量
@@ -79,6 +98,15 @@ def load_cos_config():
         if not cos_config["bucket"]:
             cos_config["bucket"] = config.get('common', 'cos_bucket', fallback=None)
     
+    # 自定义访问域名（如本地S3/COS兼容服务 127.0.0.1:9000/bucket），不设置时使用官方域名
+    cos_config["domain"] = os.getenv("COS_DOMAIN")
+    cos_config["scheme"] = os.getenv("COS_SCHEME", "https")
+    # 超过阈值的文件使用分块上传，各分块并行上传并单独重试
+    cos_config["multipart_threshold"] = int(os.getenv("COS_MULTIPART_THRESHOLD_MB", "20")) * 1024 * 1024
+    cos_config["part_size"] = int(os.getenv("COS_PART_SIZE_MB", "8")) * 1024 * 1024
+    cos_config["upload_threads"] = int(os.getenv("COS_UPLOAD_THREADS", "4"))
+    cos_config["part_retries"] = int(os.getenv("COS_PART_RETRIES", "3"))
+    
     return cos_config
 
 # 全局配置
@@ -94,7 +122,80 @@ CONFIG = {
         "qps": int(os.getenv("QPS", "4")),
         "watermark_output_mode": os.getenv("WATERMARK_OUTPUT_MODE", "no_watermark"),
         "no_dual": os.getenv("NO_DUAL", "false").lower() == "true",
-        "no_mono": os.getenv("NO_MONO", "false").lower() == "true"
+        "no_mono": os.getenv("NO_MONO", "false").lower() == "true",
+        # 并发的相同翻译请求只调用一次LLM
+        "dedup": os.getenv("TRANSLATION_DEDUP", "true").lower() == "true",
+        # 单任务token预算（本地模式），0表示不限制
+        "task_token_budget": int(os.getenv("TASK_TOKEN_BUDGET", "0"))
+    },
+    "pdf_optimize": {
+        # 本地模式下上传前重写结果PDF：合并重复的字体与图片、压缩对象流，可选线性化（需要qpdf）
+        "enabled": os.getenv("PDF_OPTIMIZE", "false").lower() == "true",
+        "workers": int(os.getenv("PDF_OPTIMIZE_WORKERS", "2")),
+        "linearize": os.getenv("PDF_OPTIMIZE_LINEARIZE", "false").lower() == "true" and bool(shutil.which("qpdf"))
+    },
+    "webhooks": {
+        # 本地模式下任务结束通知的SQLite发件箱，未送达的通知重启后继续投递（委托模式由API服务器通知）
+        "outbox_path": os.getenv("WEBHOOK_OUTBOX_PATH", "data/webhooks.db"),
+        # 设置后对通知签名（HMAC-SHA256）
+        "secret": os.getenv("WEBHOOK_SECRET", ""),
+        "timeout": float(os.getenv("WEBHOOK_TIMEOUT", "10")),
+        # 最多尝试次数，第n次失败后等待 backoff_base * 2^(n-1) 秒（不超过backoff_max）重试
+        "max_attempts": int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "8")),
+        "backoff_base": float(os.getenv("WEBHOOK_BACKOFF_SECONDS", "5")),
+        "backoff_max": float(os.getenv("WEBHOOK_BACKOFF_MAX_SECONDS", "3600"))
+    },
+    "download": {
+        "chunk_size": int(os.getenv("DOWNLOAD_CHUNK_SIZE_KB", "1024")) * 1024,
+        "connect_timeout": float(os.getenv("DOWNLOAD_CONNECT_TIMEOUT", "10")),
+        "read_timeout": float(os.getenv("DOWNLOAD_READ_TIMEOUT", "60")),
+        "max_retries": int(os.getenv("DOWNLOAD_MAX_RETRIES", "3")),
+        "pool_limit": int(os.getenv("DOWNLOAD_POOL_LIMIT", "100")),
+        "limit_per_host": int(os.getenv("DOWNLOAD_LIMIT_PER_HOST", "8"))
+    },
+    "tasks": {
+        # 已结束任务的保留数量与时长，超出后从注册表中淘汰并删除临时文件
+        "max_tasks": int(os.getenv("TASK_RETENTION_MAX", "10000")),
+        "retention_hours": float(os.getenv("TASK_RETENTION_HOURS", "24"))
+    },
+    "checkpoint": {
+        # 本地模式下任务目录（输入、输出与检查点）保存在dir中，服务重启后未完成的任务从已译段落继续
+        "enabled": os.getenv("TASK_CHECKPOINT", "true").lower() == "true",
+        "dir": os.getenv("TASK_CHECKPOINT_DIR", "data/tasks"),
+        # 已译段落日志刷写到磁盘（fsync）的间隔（秒）
+        "interval": float(os.getenv("TASK_CHECKPOINT_INTERVAL", "5")),
+        # 同一任务最多恢复的次数，反复中断的任务不再恢复
+        "max_resumes": int(os.getenv("TASK_MAX_RESUMES", "3"))
+    },
+    "backend": {
+        # 设置后MCP服务器只作为API服务器的客户端，翻译在API服务器上统一调度与限速
+        "api_url": os.getenv("TRANSLATE_API_URL", "").rstrip("/"),
+        "timeout": float(os.getenv("TRANSLATE_API_TIMEOUT", "60"))
+    },
+    "scheduler": {
+        # 同时运行的翻译任务上限，超出的任务按MCP会话轮转排队
+        "max_concurrent": int(os.getenv("MAX_CONCURRENT_TRANSLATIONS", "2"))
+    },
+    "path_input": {
+        # 允许原地翻译（不复制）的本地目录，多个目录用系统路径分隔符分隔
+        "allowed_roots": [Path(p).resolve() for p in os.getenv("PATH_INPUT_ALLOWED_ROOTS", "").split(os.pathsep) if p],
+        "in_place": os.getenv("PATH_INPUT_IN_PLACE", "false").lower() == "true",
+        # 本地文件的大小上限（MB），0表示不限制；MAX_PDF_SIZE只限制经网络传入的base64与URL输入
+        "max_size_mb": float(os.getenv("PATH_INPUT_MAX_SIZE_MB", "0"))
+    },
+    "tracing": {
+        # 结束的span以OTLP/JSON逐行追加到该文件，留空则只在内存中保留
+        "export_file": os.getenv("TRACE_EXPORT_FILE", "logs/traces.jsonl")
+    },
+    "logging": {
+        "level": os.getenv("LOG_LEVEL", "INFO").upper(),
+        "file": os.getenv("LOG_FILE", "logs/mcp_server.log"),
+        # 日志文件按大小或时间轮转，保留backup_count个旧文件
+        "max_bytes": int(os.getenv("LOG_MAX_MB", "100")) * 1024 * 1024,
+        "rotate_seconds": float(os.getenv("LOG_ROTATE_HOURS", "24")) * 3600,
+        "backup_count": int(os.getenv("LOG_BACKUP_COUNT", "7")),
+        # 同一任务同一阶段的进度日志的采样间隔（秒），0表示不采样
+        "progress_interval": float(os.getenv("LOG_PROGRESS_INTERVAL", "5"))
     },
     "server": {
         "host": os.getenv("MCP_HOST", "0.0.0.0"),
@@ -110,59 +211,383 @@ if not CONFIG["openai"]["api_key"]:
 # 创建MCP服务器
 mcp = FastMCP("PDFTranslate")
 
+class TaskRegistry:
+    """
+    任务注册表：按状态增量计数，维护最近更新顺序和按创建顺序排列的序号索引，
+    列表查询只触及所需的那一页；已结束的任务超出数量或保留时长后被淘汰
+    """
+    FINISHED_STATUSES = ("completed", "failed", "cancelled")
+    
+    def __init__(self, max_tasks: int, retention_seconds: float):
+        self.max_tasks = max_tasks
+        self.retention_seconds = retention_seconds
+        self.tasks: Dict[str, Any] = {}
+        self.status_counts: Dict[str, int] = {}
+        self.recent: "OrderedDict[str, float]" = OrderedDict()  # task_id -> 最后更新时间，最近的在末尾
+        self.finished: "OrderedDict[str, float]" = OrderedDict()  # 已结束的任务，顺序与recent相同，供淘汰扫描
+        self.seqs: List[int] = []                  # 全部任务的创建序号（升序）
+        self.status_seqs: Dict[str, List[int]] = {}  # 状态 -> 该状态任务的创建序号（升序）
+        self.seq_tasks: Dict[int, str] = {}
+        self.next_seq = 0
+    
+    def __contains__(self, task_id: str) -> bool:
+        return task_id in self.tasks
+    
+    def __getitem__(self, task_id: str):
+        return self.tasks[task_id]
+    
+    def __setitem__(self, task_id: str, task):
+        self.add(task)
+    
+    def __len__(self) -> int:
+        return len(self.tasks)
+    
+    def get(self, task_id: str, default=None):
+        return self.tasks.get(task_id, default)
+    
+    def values(self):
+        return self.tasks.values()
+    
+    def add(self, task):
+        task.seq = self.next_seq
+        self.next_seq += 1
+        self.tasks[task.task_id] = task
+        self.seq_tasks[task.seq] = task.task_id
+        self.seqs.append(task.seq)
+        self.on_status_change(task, None, task.status)
+        self.recent[task.task_id] = time.monotonic()
+        task.registry = self
+    
+    def remove(self, task_id: str):
+        task = self.tasks.pop(task_id)
+        task.registry = None
+        self.on_status_change(task, task.status, None)
+        del self.seq_tasks[task.seq]
+        del self.seqs[bisect.bisect_left(self.seqs, task.seq)]
+        self.recent.pop(task_id, None)
+        return task
+    
+    def on_status_change(self, task, old_status: Optional[str], new_status: Optional[str]):
+        if old_status is not None:
+            self.status_counts[old_status] -= 1
+            if not self.status_counts[old_status]:
+                del self.status_counts[old_status]
+            seqs = self.status_seqs[old_status]
+            del seqs[bisect.bisect_left(seqs, task.seq)]
+        if new_status is not None:
+            self.status_counts[new_status] = self.status_counts.get(new_status, 0) + 1
+            bisect.insort(self.status_seqs.setdefault(new_status, []), task.seq)
+        if new_status in self.FINISHED_STATUSES:
+            self.finished[task.task_id] = time.monotonic()
+            self.finished.move_to_end(task.task_id)
+        else:
+            self.finished.pop(task.task_id, None)
+    
+    def on_update(self, task):
+        self.recent[task.task_id] = time.monotonic()
+        self.recent.move_to_end(task.task_id)
+        if task.task_id in self.finished:
+            self.finished[task.task_id] = self.recent[task.task_id]
+            self.finished.move_to_end(task.task_id)
+    
+    def recent_tasks(self, limit: int) -> List[Any]:
+        """最近更新的limit个任务"""
+        result = []
+        for task_id in reversed(self.recent):
+            if len(result) >= limit:
+                break
+            result.append(self.tasks[task_id])
+        return result
+    
+    def page(self, status: Optional[str] = None, cursor: Optional[int] = None, limit: int = 50) -> tuple:
+        """
+        按创建时间倒序分页
+        
+        Returns:
+            tuple: (任务列表, 下一页游标或None)
+        """
+        seqs = self.seqs if status is None else self.status_seqs.get(status, [])
+        end = len(seqs) if cursor is None else bisect.bisect_left(seqs, cursor)
+        start = max(0, end - limit)
+        tasks = [self.tasks[self.seq_tasks[seq]] for seq in reversed(seqs[start:end])]
+        return tasks, (seqs[start] if start > 0 else None)
+    
+    def evict_expired(self) -> List[Any]:
+        """淘汰最久未更新且已结束、超出保留数量或保留时长的任务；未结束的任务不淘汰，也不阻挡其后的任务"""
+        now = time.monotonic()
+        evicted = []
+        while self.finished:
+            task_id, touched_at = next(iter(self.finished.items()))
+            if len(self.tasks) <= self.max_tasks and now - touched_at < self.retention_seconds:
+                break
+            evicted.append(self.remove(task_id))
+        return evicted
+
+class TranslationScheduler:
+    """
+    翻译任务调度器：全局并发上限 + 按会话轮转的公平排队
+    
+    每个MCP会话有独立队列，空出运行槽位时依次从各会话队列取一个任务，
+    单个会话提交大量文档不会饿死其他会话；运行中的asyncio.Task保存在running中，
+    避免被垃圾回收
+    """
+    
+    def __init__(self, max_concurrent: int):
+        self.max_concurrent = max(1, max_concurrent)
+        self.queues: "OrderedDict[str, deque]" = OrderedDict()  # 会话 -> [(task_id, 协程工厂)]，按轮转顺序排列
+        self.queued_sessions: Dict[str, str] = {}  # 排队中的task_id -> 会话
+        self.running: Dict[str, asyncio.Task] = {}
+    
+    def submit(self, session_key: str, task_id: str, job_factory):
+        """提交任务，job_factory为无参的协程函数"""
+        self.queues.setdefault(session_key, deque()).append((task_id, job_factory))
+        self.queued_sessions[task_id] = session_key
+        self.dispatch()
+    
+    def dispatch(self):
+        while len(self.running) < self.max_concurrent and self.queues:
+            session_key, queue = self.queues.popitem(last=False)
+            task_id, job_factory = queue.popleft()
+            if queue:
+                self.queues[session_key] = queue  # 轮转到队尾
+            del self.queued_sessions[task_id]
+            running_task = asyncio.create_task(job_factory())
+            self.running[task_id] = running_task
+            running_task.add_done_callback(lambda _, task_id=task_id: self.on_done(task_id))
+    
+    def cancel(self, task_id: str) -> bool:
+        """取消排队中或运行中的任务"""
+        session_key = self.queued_sessions.pop(task_id, None)
+        if session_key is not None:
+            queue = self.queues[session_key]
+            queue.remove(next(job for job in queue if job[0] == task_id))
+            if not queue:
+                del self.queues[session_key]
+            return True
+        running_task = self.running.get(task_id)
+        if running_task:
+            running_task.cancel()
+            return True
+        return False
+    
+    def on_done(self, task_id: str):
+        self.running.pop(task_id, None)
+        self.dispatch()
+    
+    def queue_position(self, task_id: str) -> Optional[int]:
+        """任务在全局排队顺序中的位置（从1开始），未排队返回None"""
+        session_key = self.queued_sessions.get(task_id)
+        if session_key is None:
+            return None
+        queue = self.queues[session_key]
+        index = next(i for i, (queued_id, _) in enumerate(queue) if queued_id == task_id)
+        # 轮转调度下，前index轮每个会话各出一个任务，第index轮中排在本会话之前的会话再各出一个
+        position = 1
+        ahead = True
+        for key, other_queue in self.queues.items():
+            if key == session_key:
+                ahead = False
+            position += min(len(other_queue), index)
+            if ahead and len(other_queue) > index:
+                position += 1
+        return position
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "running": len(self.running),
+            "queued": len(self.queued_sessions),
+            "queued_sessions": len(self.queues)
+        }
+
+def get_session_key(ctx: Optional[Context]) -> str:
+    """调度用的会话标识：优先使用客户端ID，否则按MCP会话区分"""
+    if ctx is None:
+        return "default"
+    try:
+        return ctx.client_id or f"session-{id(ctx.session)}"
+    except ValueError:
+        # 不在请求上下文中调用
+        return "default"
+
 # 全局任务存储
-translation_tasks: Dict[str, Dict[str, Any]] = {}
+translation_scheduler = TranslationScheduler(CONFIG["scheduler"]["max_concurrent"])
+translation_tasks = TaskRegistry(CONFIG["tasks"]["max_tasks"], CONFIG["tasks"]["retention_hours"] * 3600)
 task_files: Dict[str, Dict[str, Path]] = {}
 
-async def download_file_from_url(url: str, target_path: Path) -> bool:
+# 上传文件大小上限
+MAX_PDF_SIZE = 100 * 1024 * 1024  # 100MB
+
+# 进程内共享的HTTP会话（连接池），首次使用时在当前事件循环中创建
+http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """获取共享的aiohttp会话"""
+    global http_session
+    if http_session is None or http_session.closed:
+        download_config = CONFIG["download"]
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=download_config["pool_limit"],
+                limit_per_host=download_config["limit_per_host"]
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=None,
+                sock_connect=download_config["connect_timeout"],
+                sock_read=download_config["read_timeout"]
+            )
+        )
+    return http_session
+
+# 本地模式下任务结束通知的持久化发件箱（与API服务共用webhook_outbox），启动服务时打开，
+# 导入main.py时不创建数据库文件
+webhooks: Optional[webhook_outbox.WebhookOutbox] = None
+
+async def download_file_from_url(url: str, target_path: Path, max_size: int = MAX_PDF_SIZE) -> Dict[str, Any]:
     """
-    从URL下载文件到本地路径
+    从URL流式下载文件到本地路径，边下载边计算SHA-256。
+    先按Content-Length、再按已接收字节数检查大小上限；连接中断时用Range请求从断点续传
     
     Args:
         url: 文件URL
         target_path: 目标文件路径
+        max_size: 文件大小上限（字节）
         
     Returns:
-        bool: 下载是否成功
+        Dict[str, Any]: 成功时包含file_size与sha256，失败时包含error与message
     """
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    with open(target_path, 'wb') as f:
-                        async for chunk in response.content.iter_chunked(8192):
-                            f.write(chunk)
-                    return True
-                else:
-                    logger.error(f"下载失败，HTTP状态码: {response.status}")
-                    return False
-    except Exception as e:
-        logger.error(f"下载文件时出错: {e}")
-        return False
+    download_config = CONFIG["download"]
+    session = get_http_session()
+    digest = hashlib.sha256()
+    received = 0
+    validator = None  # ETag或Last-Modified，续传时确认文件未变化
+    attempt = 0
+    too_large = {"success": False, "error": "文件过大", "message": f"文件大小超过限制 {max_size/1024/1024}MB"}
+    
+    with open(target_path, 'wb') as f:
+        while True:
+            headers = {}
+            if received:
+                headers["Range"] = f"bytes={received}-"
+                if validator:
+                    headers["If-Range"] = validator
+            try:
+                async with session.get(url, headers=headers) as response:
+                    if received and response.status == 200:
+                        # 服务器不支持续传或文件已变化，从头开始
+                        logger.warning(f"服务器未接受断点续传，重新下载: {url}")
+                        await asyncio.to_thread(f.truncate, 0)
+                        f.seek(0)
+                        digest = hashlib.sha256()
+                        received = 0
+                    elif response.status not in (200, 206):
+                        logger.error(f"下载失败，HTTP状态码: {response.status}")
+                        return {"success": False, "error": "文件下载失败", "message": f"HTTP状态码: {response.status}"}
+                    
+                    expected_size = None
+                    if response.content_length is not None:
+                        expected_size = received + response.content_length
+                        if expected_size > max_size:
+                            return too_large
+                    validator = validator or response.headers.get("ETag") or response.headers.get("Last-Modified")
+                    
+                    async for chunk in response.content.iter_chunked(download_config["chunk_size"]):
+                        received += len(chunk)
+                        if received > max_size:
+                            return too_large
+                        digest.update(chunk)
+                        await asyncio.to_thread(f.write, chunk)
+                    
+                    if expected_size is not None and received < expected_size:
+                        raise aiohttp.ClientPayloadError(f"连接提前断开: {received}/{expected_size}")
+                    return {"success": True, "file_size": received, "sha256": digest.hexdigest()}
+            
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                attempt += 1
+                if attempt > download_config["max_retries"]:
+                    logger.error(f"下载文件时出错: {e}")
+                    return {"success": False, "error": "文件下载失败", "message": f"无法从URL下载文件: {e}"}
+                logger.warning(f"下载中断（已接收 {received} 字节），第 {attempt} 次续传: {e}")
+                await asyncio.sleep(min(2 ** attempt, 10))
+
+# base64流式解码时每次处理的字符数（4的倍数，约解码出3MB）
+BASE64_DECODE_CHUNK_CHARS = 4 * 1024 * 1024
 
-def save_base64_file(base64_content: str, target_path: Path) -> bool:
+def save_base64_file(base64_content: str, target_path: Path, max_size: int = MAX_PDF_SIZE) -> Dict[str, Any]:
     """
-    保存base64编码的文件内容到本地
+    分块解码base64内容并直接写入磁盘，边解码边计算SHA-256。
+    首块解码后即检查PDF文件头，累计大小超过max_size时立即停止，不必解码完整内容
     
     Args:
-        base64_content: base64编码的文件内容
+        base64_content: base64编码的文件内容（可带data URL前缀）
         target_path: 目标文件路径
+        max_size: 解码后文件大小上限（字节）
         
     Returns:
-        bool: 保存是否成功
+        Dict[str, Any]: 成功时包含file_size与sha256，失败时包含error与message
     """
+    # 如果包含data URL前缀，跳过它（只在开头查找，避免复制整个字符串）
+    start = 0
+    if base64_content.startswith('data:'):
+        start = base64_content.find(',', 0, 1024) + 1
+    
+    digest = hashlib.sha256()
+    file_size = 0
+    pending = ""
     try:
-        # 如果包含data URL前缀，去掉它
-        if ',' in base64_content and base64_content.startswith('data:'):
-            base64_content = base64_content.split(',', 1)[1]
-        
-        file_data = base64.b64decode(base64_content)
         with open(target_path, 'wb') as f:
-            f.write(file_data)
-        return True
+            for pos in range(start, len(base64_content), BASE64_DECODE_CHUNK_CHARS):
+                # 去掉换行等空白后按4字符对齐，余下的部分留到下一块
+                chunk = pending + "".join(base64_content[pos:pos + BASE64_DECODE_CHUNK_CHARS].split())
+                aligned = len(chunk) - len(chunk) % 4
+                pending = chunk[aligned:]
+                data = base64.b64decode(chunk[:aligned], validate=True)
+                
+                if file_size == 0 and data and not data.startswith(b'%PDF-'):
+                    return {"success": False, "error": "文件格式验证失败", "message": "文件不是有效的PDF格式"}
+                file_size += len(data)
+                if file_size > max_size:
+                    return {
+                        "success": False,
+                        "error": "文件过大",
+                        "message": f"文件大小超过限制 {max_size/1024/1024}MB"
+                    }
+                digest.update(data)
+                f.write(data)
+            if pending:
+                raise ValueError("base64内容长度不完整")
+        return {"success": True, "file_size": file_size, "sha256": digest.hexdigest()}
     except Exception as e:
         logger.error(f"保存base64文件时出错: {e}")
-        return False
+        return {"success": False, "error": "base64文件解码失败", "message": "请检查base64编码格式是否正确"}
+
+# Linux FICLONE ioctl，在btrfs/xfs等写时复制文件系统上创建共享数据块的副本
+FICLONE = 0x40049409
+
+def is_path_in_allowed_roots(file_path: Path) -> bool:
+    """文件是否位于允许原地翻译的目录下"""
+    resolved = file_path.resolve()
+    return any(resolved.is_relative_to(root) for root in CONFIG["path_input"]["allowed_roots"])
+
+def clone_or_copy_file(source_path: Path, target_path: Path) -> str:
+    """
+    把本地文件放到target_path：同一设备上优先reflink，否则复制。
+    不使用硬链接：硬链接与用户的文件共用inode，用户之后原地修改文件会改变排队中的输入，
+    清理任务时改写或权限变更也会波及用户的文件
+    
+    Returns:
+        str: 实际使用的方式 (reflink/copy)
+    """
+    if fcntl is not None and source_path.stat().st_dev == target_path.parent.stat().st_dev:
+        try:
+            with open(source_path, 'rb') as src, open(target_path, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return "reflink"
+        except OSError:
+            # 文件系统不支持写时复制
+            target_path.unlink(missing_ok=True)
+    shutil.copy2(source_path, target_path)
+    return "copy"
 
 def validate_pdf_file(file_path: Path) -> bool:
     """
@@ -181,9 +606,90 @@ def validate_pdf_file(file_path: Path) -> bool:
     except Exception:
         return False
 
+def analyze_pdf_file(file_path: Path, lang_in: str = None, qps: int = None) -> Dict[str, Any]:
+    """预检PDF文件（与API服务共用pdf_analysis），未指定的源语言与QPS取服务配置"""
+    return pdf_analysis.analyze_pdf_file(
+        file_path, lang_in or CONFIG["translation"]["default_lang_in"], qps or CONFIG["translation"]["qps"]
+    )
+
+# COS客户端按配置复用，配置变化（如update_cos_config）时重建
+cos_client_cache: Dict[str, Any] = {"key": None, "client": None}
+cos_client_lock = threading.Lock()
+
+def get_cos_client(cos_config: Dict[str, Any]):
+    """获取与当前COS配置对应的共享客户端"""
+    key = (cos_config["region"], cos_config["secret_id"], cos_config["secret_key"],
+           cos_config.get("domain"), cos_config.get("scheme"))
+    with cos_client_lock:
+        if cos_client_cache["key"] != key:
+            pool_size = max(10, cos_config.get("upload_threads", 4) * 2)
+            config = CosConfig(
+                Region=cos_config["region"],
+                SecretId=cos_config["secret_id"],
+                SecretKey=cos_config["secret_key"],
+                Domain=cos_config.get("domain"),
+                Scheme=cos_config.get("scheme", "https"),
+                PoolConnections=pool_size,
+                PoolMaxSize=pool_size
+            )
+            cos_client_cache["client"] = CosS3Client(config)
+            cos_client_cache["key"] = key
+        return cos_client_cache["client"]
+
+def upload_part_with_retry(client, bucket: str, key: str, upload_id: str, file_path: Path,
+                           part_number: int, offset: int, size: int, retries: int) -> Dict[str, Any]:
+    """上传单个分块，失败时只重试该分块"""
+    for attempt in range(1, retries + 1):
+        try:
+            with open(file_path, 'rb') as f:
+                f.seek(offset)
+                body = f.read(size)
+            response = client.upload_part(
+                Bucket=bucket,
+                Key=key,
+                Body=body,
+                PartNumber=part_number,
+                UploadId=upload_id
+            )
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+        except Exception as e:
+            if attempt == retries:
+                raise
+            logger.warning(f"分块 {part_number} 上传失败，第 {attempt} 次重试: {e}")
+            time.sleep(min(2 ** attempt, 10))
+
+def multipart_upload_to_cos(client, cos_config: Dict[str, Any], file_path: Path, key: str) -> Dict[str, Any]:
+    """分块并行上传，任一分块最终失败时取消本次上传"""
+    bucket = cos_config["bucket"]
+    part_size = cos_config["part_size"]
+    file_size = file_path.stat().st_size
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+    try:
+        with ThreadPoolExecutor(max_workers=cos_config["upload_threads"]) as executor:
+            futures = [
+                executor.submit(
+                    upload_part_with_retry, client, bucket, key, upload_id, file_path,
+                    index + 1, offset, min(part_size, file_size - offset), cos_config["part_retries"]
+                )
+                for index, offset in enumerate(range(0, file_size, part_size))
+            ]
+            parts = [future.result() for future in futures]
+        return client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Part": parts}
+        )
+    except Exception:
+        try:
+            client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        except Exception as e:
+            logger.warning(f"取消分块上传失败: {e}")
+        raise
+
 def upload_file_to_cos(file_path: Path, file_name: str = None) -> Dict[str, Any]:
     """
-    上传文件到腾讯云COS
+    上传文件到腾讯云COS（阻塞调用，异步代码中请通过asyncio.to_thread执行）
     
     Args:
         file_path: 本地文件路径
@@ -215,44 +721,48 @@ def upload_file_to_cos(file_path: Path, file_name: str = None) -> Dict[str, Any]
         }
     
     try:
-        # 创建COS客户端
-        config = CosConfig(
-            Region=cos_config["region"],
-            SecretId=cos_config["secret_id"],
-            SecretKey=cos_config["secret_key"]
-        )
-        client = CosS3Client(config)
+        started = time.perf_counter()
+        client = get_cos_client(cos_config)
         
         # 如果没有指定文件名，使用原文件名
         if not file_name:
             file_name = file_path.name
         
         # 添加时间戳避免文件名冲突
-        import datetime
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         name_parts = file_name.rsplit('.', 1)
         if len(name_parts) == 2:
             file_name = f"{name_parts[0]}_{timestamp}.{name_parts[1]}"
         else:
             file_name = f"{file_name}_{timestamp}"
         
-        # 上传文件
-        with open(file_path, 'rb') as f:
-            response = client.put_object(
-                Bucket=cos_config["bucket"],
-                Body=f,
-                Key=file_name,
-                EnableMD5=False
-            )
+        # 上传文件：大文件分块并行上传
+        file_size = file_path.stat().st_size
+        multipart = file_size > cos_config["multipart_threshold"]
+        if multipart:
+            response = multipart_upload_to_cos(client, cos_config, file_path, file_name)
+        else:
+            with open(file_path, 'rb') as f:
+                response = client.put_object(
+                    Bucket=cos_config["bucket"],
+                    Body=f,
+                    Key=file_name,
+                    EnableMD5=False
+                )
         
         if response and response.get('ETag'):
             # 构造文件URL
-            url = f"https://{cos_config['bucket']}.cos.{cos_config['region']}.myqcloud.com/{file_name}"
+            if cos_config.get("domain"):
+                url = f"{cos_config['scheme']}://{cos_config['domain']}/{file_name}"
+            else:
+                url = f"https://{cos_config['bucket']}.cos.{cos_config['region']}.myqcloud.com/{file_name}"
             return {
                 "success": True,
                 "url": url,
                 "file_name": file_name,
                 "etag": response['ETag'],
+                "multipart": multipart,
+                "upload_seconds": round(time.perf_counter() - started, 3),
                 "message": "文件上传成功"
             }
         else:
@@ -270,17 +780,69 @@ def upload_file_to_cos(file_path: Path, file_name: str = None) -> Dict[str, Any]
             "message": "请检查COS配置和网络连接"
         }
 
+# 任务级链路追踪（与API服务共用task_trace）：每个翻译任务一条trace，
+# 委托模式下通过traceparent头与API服务器的trace串联
+trace_exporter = task_trace.SpanExporter(CONFIG["tracing"]["export_file"], "pdftranslate-mcp")
+
+def translator_usage(translator, started: float) -> Dict[str, Any]:
+    """本地模式任务的LLM用量，取自babeldoc翻译器自带的计数"""
+    requests = translator.translate_call_count
+    cache_hits = translator.translate_cache_call_count
+    shared_calls = getattr(translator, "dedup_saved_count", 0)
+    total_tokens = translator.token_count.value
+    elapsed = time.monotonic() - started
+    return {
+        "requests": requests,
+        "cache_hits": cache_hits,
+        "shared_calls": shared_calls,
+        "llm_calls": max(requests - cache_hits - shared_calls, 0),
+        "prompt_tokens": translator.prompt_token_count.value,
+        "completion_tokens": translator.completion_token_count.value,
+        "total_tokens": total_tokens,
+        "elapsed_seconds": round(elapsed, 3),
+        "tokens_per_second": round(total_tokens / elapsed, 1) if elapsed else None,
+    }
+
 class TranslationTask:
     def __init__(self, task_id: str):
         self.task_id = task_id
-        self.status = "pending"  # pending, processing, completed, failed
+        self.registry = None  # 加入TaskRegistry后由注册表设置
+        self.seq = None
+        self.temp_dir = None  # 任务的临时目录，淘汰时删除
+        self.status = "pending"  # pending, processing, completed, failed, cancelled
         self.progress = 0.0
         self.message = "任务已创建，等待处理..."
         self.result_files = {}
         self.cos_urls = {}  # 添加COS URL存储
+        self.upload_seconds = {}  # 各版本上传COS耗时（秒）
+        self.trace: Optional[task_trace.TaskTrace] = None
+        self.usage = None  # LLM调用与token用量
+        self.optimization = {}  # 各结果文件优化前后的大小
+        self.callback_url = None  # 本地模式下任务结束时通知的地址，通知后清空
         self.created_at = datetime.now().isoformat()
         self.updated_at = datetime.now().isoformat()
     
+    @property
+    def status(self) -> str:
+        return self._status
+    
+    @status.setter
+    def status(self, value: str):
+        old_status = getattr(self, "_status", None)
+        self._status = value
+        if self.registry and old_status != value:
+            self.registry.on_status_change(self, old_status, value)
+    
+    @property
+    def updated_at(self) -> str:
+        return self._updated_at
+    
+    @updated_at.setter
+    def updated_at(self, value: str):
+        self._updated_at = value
+        if self.registry:
+            self.registry.on_update(self)
+    
     def to_dict(self):
         return {
             "task_id": self.task_id,
@@ -289,10 +851,92 @@ class TranslationTask:
             "message": self.message,
             "result_files": self.result_files,
             "cos_urls": self.cos_urls,  # 包含COS URL信息
+            "upload_seconds": self.upload_seconds,
+            "usage": self.usage,
+            "optimization": self.optimization,
             "created_at": self.created_at,
             "updated_at": self.updated_at
         }
 
+def notify_task_finished(task: TranslationTask):
+    """本地模式任务结束时把通知写入webhook发件箱（只通知一次）"""
+    if not task.callback_url or task.status not in ("completed", "failed", "cancelled"):
+        return
+    url, task.callback_url = task.callback_url, None
+    if webhooks is None:
+        logger.warning(f"发件箱未打开，任务结束通知未写入: {task.task_id}")
+        return
+    payload = {
+        "event": f"task.{task.status}",
+        "task_id": task.task_id,
+        "status": task.status,
+        "message": task.message,
+        "cos_urls": task.cos_urls,
+        "usage": task.usage,
+        "finished_at": round(time.time(), 3)
+    }
+    try:
+        webhooks.enqueue(task.task_id, url, payload)
+        webhooks.ensure_running()
+    except Exception as e:
+        logger.error(f"写入任务结束通知失败: {task.task_id}, {e}", exc_info=True)
+
+async def upload_result_file(task: TranslationTask, file_type: str, file_path: Path) -> Dict[str, Any]:
+    """在线程中上传单个结果文件，并在任务的trace中记录cos_upload span"""
+    with task.trace.span("cos_upload", file_type=file_type, file_size=file_path.stat().st_size) as span:
+        upload_result = await asyncio.to_thread(upload_file_to_cos, file_path, f"{file_type}_{file_path.name}")
+        span.set_attribute("multipart", upload_result.get("multipart"))
+        span.end(None if upload_result.get("success") else upload_result.get("error"))
+    return upload_result
+
+# 结果PDF优化（与API服务共用pdf_optimizer），未开启PDF_OPTIMIZE时为None。main.py是启动脚本，
+# 子进程会重新导入它并执行服务初始化，因此在线程池中执行
+output_optimizer = pdf_optimizer.PdfOptimizer(
+    CONFIG["pdf_optimize"],
+    ThreadPoolExecutor(max_workers=CONFIG["pdf_optimize"]["workers"], thread_name_prefix="pdf-optimize")
+) if CONFIG["pdf_optimize"]["enabled"] and BABELDOC_AVAILABLE else None
+
+async def optimize_result_files(task: TranslationTask, result_files: Dict[str, str]):
+    """上传前并行优化结果PDF，记录优化前后的大小；出错的文件保持原样"""
+    task.message = "正在优化输出PDF..."
+    task.updated_at = datetime.now().isoformat()
+    with task.trace.span("pdf_optimize", files=len(result_files)) as optimize_span:
+        task.optimization.update(await output_optimizer.optimize(result_files))
+        optimize_span.set_attribute("original_bytes", sum(r.get("original_bytes", 0) for r in task.optimization.values()))
+        optimize_span.set_attribute("output_bytes", sum(r.get("output_bytes", 0) for r in task.optimization.values()))
+    logger.info(f"任务 {task.task_id} 结果PDF已优化: {task.optimization}")
+
+async def publish_result_files(task: TranslationTask, result_files: Dict[str, str]):
+    """登记结果文件并并行上传到COS"""
+    # 各版本并行上传到COS，上传在线程中进行，不阻塞事件循环
+    task.message = "正在上传翻译结果到云存储..."
+    task.updated_at = datetime.now().isoformat()
+    file_types = list(result_files.keys())
+    upload_results = await asyncio.gather(*(
+        upload_result_file(task, file_type, Path(result_files[file_type]))
+        for file_type in file_types
+    ))
+    
+    cos_urls = {}
+    for file_type, upload_result in zip(file_types, upload_results):
+        if upload_result.get("success"):
+            cos_urls[file_type] = upload_result["url"]
+            task.upload_seconds[file_type] = upload_result["upload_seconds"]
+            logger.info(f"{file_type}版本已上传到COS（{upload_result['upload_seconds']}秒）: {upload_result['url']}")
+        else:
+            logger.warning(f"{file_type}版本上传COS失败: {upload_result.get('error')}")
+    
+    task.result_files = result_files
+    task.cos_urls = cos_urls  # 添加COS URL信息
+    task_files[task.task_id] = {k: Path(v) for k, v in result_files.items()}
+    
+    # 更新最终状态
+    if cos_urls:
+        task.message = f"翻译完成，文件已上传到云存储。可用版本: {', '.join(cos_urls.keys())}"
+    else:
+        task.message = "翻译完成，但文件上传到云存储失败，可通过其他方式获取文件"
+    task.updated_at = datetime.now().isoformat()
+
 async def translate_document_async(
     task_id: str,
     pdf_file: Path,
@@ -302,34 +946,42 @@ async def translate_document_async(
     no_dual: bool,
     no_mono: bool,
     watermark_output_mode: str,
-    output_dir: Path
+    output_dir: Path,
+    ocr_workaround: bool = False,
+    working_dir: Optional[Path] = None
 ):
-    """异步翻译文档"""
+    """异步翻译文档；指定working_dir时中间文件与已译段落日志保存在其中，重新执行时从日志继续"""
     if not BABELDOC_AVAILABLE:
         translation_tasks[task_id].status = "failed"
         translation_tasks[task_id].message = "BabelDOC库未安装，无法进行翻译"
         return
     
+    journal = None
     try:
         task = translation_tasks[task_id]
         task.status = "processing"
         task.message = "正在初始化翻译器..."
         task.updated_at = datetime.now().isoformat()
         
-        # 初始化翻译器
-        translator = OpenAITranslator(
-            lang_in=lang_in,
-            lang_out=lang_out,
-            model=CONFIG["openai"]["model"],
-            base_url=CONFIG["openai"]["base_url"],
-            api_key=CONFIG["openai"]["api_key"],
-            ignore_cache=False,
-        )
-        
-        set_translate_rate_limiter(qps)
-        
-        # 加载文档布局模型
-        doc_layout_model = DocLayoutModel.load_onnx()
+        with task.trace.span("model_load"):
+            # 初始化翻译器
+            translator_class = OpenAITranslator
+            if CONFIG["translation"]["dedup"]:
+                # 本地模式下多个任务在同一进程中并发翻译，相同的进行中请求只调用一次LLM
+                translator_class = single_flight.with_single_flight(OpenAITranslator)
+            translator = translator_class(
+                lang_in=lang_in,
+                lang_out=lang_out,
+                model=CONFIG["openai"]["model"],
+                base_url=CONFIG["openai"]["base_url"],
+                api_key=CONFIG["openai"]["api_key"],
+                ignore_cache=False,
+            )
+            
+            set_translate_rate_limiter(qps)
+            
+            # 加载文档布局模型
+            doc_layout_model = DocLayoutModel.load_onnx()
         
         # 配置水印模式
         watermark_mode = WatermarkOutputMode.NoWatermark
@@ -368,9 +1020,9 @@ async def translate_document_async(
             table_model=None,
             show_char_box=False,
             skip_scanned_detection=False,
-            ocr_workaround=False,
+            ocr_workaround=ocr_workaround,
             custom_system_prompt=None,
-            working_dir=None,
+            working_dir=str(working_dir) if working_dir else None,
             add_formula_placehold_hint=False,
             glossaries=[],
             pool_max_workers=None,
@@ -383,67 +1035,64 @@ async def translate_document_async(
         
         task.message = "正在翻译文档..."
         
-        # 执行翻译
+        if working_dir:
+            journal = segment_journal.attach(translator, working_dir / "segments.jsonl", CONFIG["checkpoint"]["interval"])
+        
+        # 执行翻译，各阶段按进度事件记录为pipeline下的子span
+        pipeline_span = task.trace.start_span("pipeline", lang_out=lang_out, ocr_workaround=ocr_workaround)
+        started = time.monotonic()
+        token_budget = CONFIG["translation"]["task_token_budget"]
         async for event in babeldoc.format.pdf.high_level.async_translate(config_obj):
+            task.trace.observe(pipeline_span, event)
+            task.usage = translator_usage(translator, started)
+            if token_budget and task.usage["total_tokens"] > token_budget and task.status == "processing":
+                # 与取消相同，由调度器取消运行中的任务：下一次等待事件时babeldoc收到取消并停止翻译
+                task.status = "failed"
+                task.message = f"token用量 {task.usage['total_tokens']} 超过任务预算 {token_budget}，任务已终止"
+                task.updated_at = datetime.now().isoformat()
+                logger.warning(f"任务 {task_id} token用量超出预算: {task.usage['total_tokens']} > {token_budget}")
+                pipeline_span.end(task.message)
+                translation_scheduler.cancel(task_id)
+                continue
             if event["type"] == "progress_update":
                 task.progress = event.get("overall_progress", 0.0)
                 task.message = f"{event.get('stage', '处理中')} ({event.get('stage_current', 0)}/{event.get('stage_total', 100)})"
                 task.updated_at = datetime.now().isoformat()
+                # 进度日志按阶段采样，参数在写入时才格式化
+                logger.info(
+                    "翻译进度 %s: %s %s/%s (%.1f%%)", task_id, event.get("stage"), event.get("stage_current"),
+                    event.get("stage_total"), task.progress, extra={"stage": event.get("stage"), "progress": task.progress}
+                )
             elif event["type"] == "error":
                 task.status = "failed"
                 task.message = f"翻译失败: {event.get('error', '未知错误')}"
                 task.updated_at = datetime.now().isoformat()
                 logger.error(f"Translation failed for task {task_id}: {event.get('error')}")
+                pipeline_span.end(str(event.get("error", "未知错误")))
                 return
             elif event["type"] == "finish":
+                pipeline_span.end()
                 result = event["translate_result"]
                 task.status = "completed"
                 task.progress = 100.0
                 task.message = "翻译完成"
                 task.updated_at = datetime.now().isoformat()
                 
-                # 收集结果文件并上传到COS
+                # 收集结果文件
                 result_files = {}
-                cos_urls = {}
-                
                 if result.dual_pdf_path and Path(result.dual_pdf_path).exists():
-                    dual_path = Path(result.dual_pdf_path)
-                    result_files["dual"] = str(dual_path)
-                    
-                    # 上传双语版本到COS
-                    task.message = "正在上传双语版本到云存储..."
-                    task.updated_at = datetime.now().isoformat()
-                    upload_result = upload_file_to_cos(dual_path, f"dual_{dual_path.name}")
-                    if upload_result.get("success"):
-                        cos_urls["dual"] = upload_result["url"]
-                        logger.info(f"双语版本已上传到COS: {upload_result['url']}")
-                    else:
-                        logger.warning(f"双语版本上传COS失败: {upload_result.get('error')}")
-                
+                    result_files["dual"] = str(result.dual_pdf_path)
                 if result.mono_pdf_path and Path(result.mono_pdf_path).exists():
-                    mono_path = Path(result.mono_pdf_path)
-                    result_files["mono"] = str(mono_path)
-                    
-                    # 上传单语版本到COS
-                    task.message = "正在上传单语版本到云存储..."
-                    task.updated_at = datetime.now().isoformat()
-                    upload_result = upload_file_to_cos(mono_path, f"mono_{mono_path.name}")
-                    if upload_result.get("success"):
-                        cos_urls["mono"] = upload_result["url"]
-                        logger.info(f"单语版本已上传到COS: {upload_result['url']}")
-                    else:
-                        logger.warning(f"单语版本上传COS失败: {upload_result.get('error')}")
-                
-                task.result_files = result_files
-                task.cos_urls = cos_urls  # 添加COS URL信息
-                task_files[task_id] = {k: Path(v) for k, v in result_files.items()}
-                
-                # 更新最终状态
-                if cos_urls:
-                    task.message = f"翻译完成，文件已上传到云存储。可用版本: {', '.join(cos_urls.keys())}"
-                else:
-                    task.message = "翻译完成，但文件上传到云存储失败，可通过其他方式获取文件"
+                    result_files["mono"] = str(result.mono_pdf_path)
                 
+                if output_optimizer and result_files:
+                    await optimize_result_files(task, result_files)
+                await publish_result_files(task, result_files)
+                logger.info(
+                    f"任务 {task_id} LLM用量: {task.usage['llm_calls']} 次调用, {task.usage['total_tokens']} tokens, "
+                    f"命中缓存 {task.usage['cache_hits']} 次, 共用进行中调用 {task.usage['shared_calls']} 次",
+                    extra={"llm_usage": task.usage}
+                )
                 logger.info(f"Translation completed for task {task_id}")
                 break
                 
@@ -453,6 +1102,278 @@ async def translate_document_async(
         task.message = f"翻译过程出错: {str(e)}"
         task.updated_at = datetime.now().isoformat()
         logger.error(f"Translation error for task {task_id}: {e}", exc_info=True)
+    finally:
+        if journal:
+            segment_journal.detach(translator, journal)
+
+# 委托API服务器翻译时跟踪远端任务的协程，保存引用避免运行中被垃圾回收
+backend_watchers: Dict[str, asyncio.Task] = {}
+BACKEND_TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+
+def backend_url(path: str) -> str:
+    return f"{CONFIG['backend']['api_url']}{path}"
+
+async def backend_request(method: str, path: str, **kwargs) -> Dict[str, Any]:
+    """调用API服务器，返回JSON结果，失败时返回错误信息"""
+    try:
+        async with get_http_session().request(
+            method, backend_url(path),
+            timeout=aiohttp.ClientTimeout(total=CONFIG["backend"]["timeout"]),
+            **kwargs
+        ) as response:
+            data = await response.json(content_type=None)
+            if response.status >= 400:
+                return {
+                    "error": "翻译服务返回错误",
+                    "message": data.get("detail", f"HTTP {response.status}") if isinstance(data, dict) else f"HTTP {response.status}",
+                    "status": "failed"
+                }
+            return data
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        return {
+            "error": "无法连接翻译服务",
+            "message": f"{CONFIG['backend']['api_url']}: {str(e)}",
+            "status": "failed"
+        }
+
+async def submit_backend_translation(pdf_path: Path, fields: Dict[str, Any], traceparent: str = None) -> Dict[str, Any]:
+    """把PDF提交到API服务器的/translate，traceparent使API服务器的trace接在本地trace之下"""
+    form = aiohttp.FormData()
+    for key, value in fields.items():
+        if value is not None:
+            form.add_field(key, str(value).lower() if isinstance(value, bool) else str(value))
+    headers = {"traceparent": traceparent} if traceparent else None
+    with open(pdf_path, "rb") as f:
+        form.add_field("file", f, filename=pdf_path.name, content_type="application/pdf")
+        return await backend_request("POST", "/translate", data=form, headers=headers)
+
+async def download_backend_file(task_id: str, file_type: str, output_dir: Path) -> Path:
+    """从API服务器下载结果文件到output_dir"""
+    async with get_http_session().get(backend_url(f"/download/{task_id}/{file_type}")) as response:
+        response.raise_for_status()
+        disposition = response.content_disposition
+        filename = Path((disposition and disposition.filename) or f"{file_type}.pdf").name
+        target_path = output_dir / filename
+        with open(target_path, "wb") as f:
+            async for chunk in response.content.iter_chunked(CONFIG["download"]["chunk_size"]):
+                await asyncio.to_thread(f.write, chunk)
+    return target_path
+
+async def follow_backend_task(task_id: str, output_dir: Path):
+    """订阅API服务器的SSE进度流同步任务状态，完成后下载结果文件"""
+    task = translation_tasks[task_id]
+    log_pipeline.current_task_id.set(task_id)
+    remote_status = {}
+    retries = 0
+    remote_span = task.trace.start_span("backend_translate", backend=CONFIG["backend"]["api_url"])
+    try:
+        while remote_status.get("status") not in BACKEND_TERMINAL_STATUSES:
+            try:
+                async with get_http_session().get(backend_url(f"/tasks/{task_id}/events")) as response:
+                    response.raise_for_status()
+                    async for line in response.content:
+                        line = line.decode("utf-8").strip()
+                        if not line.startswith("data:"):
+                            continue
+                        remote_status = json.loads(line[5:])
+                        retries = 0
+                        if remote_status["status"] != "completed":
+                            task.status = remote_status["status"]
+                        task.progress = remote_status.get("progress", task.progress)
+                        task.message = remote_status.get("message", task.message)
+                        task.usage = remote_status.get("usage", task.usage)
+                        task.optimization = remote_status.get("optimization") or task.optimization
+                        task.updated_at = datetime.now().isoformat()
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                retries += 1
+                if retries > CONFIG["download"]["max_retries"]:
+                    raise
+                logger.warning(f"翻译服务进度流中断，第{retries}次重连: {task_id}, {e}")
+                await asyncio.sleep(retries)
+        
+        if remote_status["status"] != "completed":
+            remote_span.end(remote_status.get("message") or remote_status["status"])
+            logger.info(f"远端翻译任务结束: {task_id}, 状态: {remote_status['status']}")
+            return
+        remote_span.end()
+        
+        task.message = "正在从翻译服务下载结果..."
+        task.updated_at = datetime.now().isoformat()
+        result_files = {}
+        for file_type in remote_status.get("result_files", {}):
+            with task.trace.span("download", file_type=file_type):
+                result_files[file_type] = str(await download_backend_file(task_id, file_type, output_dir))
+        
+        task.status = "completed"
+        task.progress = 100.0
+        await publish_result_files(task, result_files)
+        logger.info(f"Translation completed for task {task_id} (via {CONFIG['backend']['api_url']})")
+    
+    except Exception as e:
+        task.status = "failed"
+        task.message = f"同步翻译服务任务出错: {str(e)}"
+        task.updated_at = datetime.now().isoformat()
+        logger.error(f"同步翻译服务任务出错: {task_id}, {e}", exc_info=True)
+    finally:
+        task.trace.end(task.status, task.message)
+
+def start_backend_watcher(task_id: str, output_dir: Path):
+    watcher = asyncio.create_task(follow_backend_task(task_id, output_dir))
+    backend_watchers[task_id] = watcher
+    watcher.add_done_callback(lambda _: backend_watchers.pop(task_id, None))
+
+# 本地模式未完成任务的描述文件，保存在任务目录中，任务结束时删除
+TASK_MANIFEST_FILE = "task.json"
+
+def write_task_manifest(task: TranslationTask, manifest: Dict[str, Any]):
+    manifest_path = task.temp_dir / TASK_MANIFEST_FILE
+    temp_path = manifest_path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+    temp_path.replace(manifest_path)
+
+def finish_task_checkpoint(task: TranslationTask):
+    """任务结束后不再恢复：删除描述文件与中间文件，保留输入与结果"""
+    if task.temp_dir:
+        (task.temp_dir / TASK_MANIFEST_FILE).unlink(missing_ok=True)
+        shutil.rmtree(task.temp_dir / "working", ignore_errors=True)
+
+def submit_local_translation(task: TranslationTask, session_key: str, params: Dict[str, Any]):
+    """提交本地翻译任务到调度器，有空闲槽位时立即开始，否则按会话轮转排队；params为translate_document_async的参数"""
+    queue_span = task.trace.start_span("queue_wait")
+    
+    async def run_translation():
+        queue_span.end()
+        log_pipeline.current_task_id.set(task.task_id)
+        try:
+            await translate_document_async(task.task_id, **params)
+        finally:
+            task.trace.end(task.status, task.message)
+            # 服务停止时中断的任务仍为processing，保留检查点供重启后继续
+            if task.status in TaskRegistry.FINISHED_STATUSES:
+                finish_task_checkpoint(task)
+            notify_task_finished(task)
+    
+    translation_scheduler.submit(session_key, task.task_id, run_translation)
+
+def resume_interrupted_tasks():
+    """服务启动时重新提交上次未完成的本地翻译任务，已翻译的段落从检查点取得"""
+    checkpoint_dir = Path(CONFIG["checkpoint"]["dir"])
+    if not checkpoint_dir.exists():
+        return
+    for task_dir in sorted(checkpoint_dir.iterdir()):
+        manifest_path = task_dir / TASK_MANIFEST_FILE
+        try:
+            if not manifest_path.exists():
+                # 上次运行中已结束的任务，任务注册表不保留，重启后无法再访问
+                shutil.rmtree(task_dir, ignore_errors=True)
+                continue
+            manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+            params = dict(manifest["params"])
+            for key in ("pdf_file", "output_dir", "working_dir"):
+                params[key] = Path(params[key])
+            if not params["pdf_file"].exists():
+                raise FileNotFoundError(f"输入文件已不存在: {params['pdf_file']}")
+        except Exception as e:
+            logger.error(f"无法恢复任务目录 {task_dir}: {e}")
+            shutil.rmtree(task_dir, ignore_errors=True)
+            continue
+        
+        task = TranslationTask(manifest["task_id"])
+        task.temp_dir = task_dir
+        task.trace = task_trace.TaskTrace(task.task_id, "translate_pdf", trace_exporter, resumed=True)
+        task.callback_url = manifest.get("callback_url")
+        translation_tasks[task.task_id] = task
+        resumes = manifest.get("resumes", 0) + 1
+        if resumes > CONFIG["checkpoint"]["max_resumes"]:
+            task.status = "failed"
+            task.message = f"任务已中断 {resumes} 次，不再从检查点恢复"
+            task.trace.end(task.status, task.message)
+            finish_task_checkpoint(task)
+            logger.error(f"任务 {task.task_id} 已中断 {resumes} 次，不再恢复")
+            notify_task_finished(task)
+            continue
+        write_task_manifest(task, {**manifest, "resumes": resumes})
+        task.message = "服务已重启，任务将从检查点继续..."
+        submit_local_translation(task, manifest["session_key"], params)
+        logger.info(f"从检查点恢复翻译任务: {task.task_id}（第{resumes}次恢复）")
+
+async def prepare_input_file(file_input: str, input_type: str, pdf_path: Path) -> dict:
+    """
+    根据输入类型把文件落到pdf_path，并做格式与大小校验
+    
+    Args:
+        file_input: 文件输入内容（base64内容、URL或本地路径）
+        input_type: 输入类型 ("base64", "url", "path")
+        pdf_path: 目标文件路径
+        
+    Returns:
+        dict: 失败时返回错误信息(含error)，成功时返回实际使用的pdf_path、file_size、
+            sha256（base64与url输入时计算）与ingest_method
+    """
+    sha256 = None
+    ingest_method = input_type
+    if input_type == "base64":
+        logger.info(f"正在处理base64文件: {pdf_path.name}")
+        # 解码与写盘放到线程中，避免阻塞其他MCP会话
+        saved = await asyncio.to_thread(save_base64_file, file_input, pdf_path)
+        if not saved["success"]:
+            return {
+                "error": saved["error"],
+                "message": saved["message"],
+                "status": "failed"
+            }
+        sha256 = saved["sha256"]
+    
+    elif input_type == "url":
+        logger.info(f"正在从URL下载文件: {file_input}")
+        downloaded = await download_file_from_url(file_input, pdf_path)
+        if not downloaded["success"]:
+            return {
+                "error": downloaded["error"],
+                "message": downloaded["message"],
+                "status": "failed"
+            }
+        sha256 = downloaded["sha256"]
+    
+    elif input_type == "path":
+        logger.info(f"正在处理本地文件: {file_input}")
+        source_path = Path(file_input)
+        if not source_path.exists():
+            return {
+                "error": f"文件不存在: {file_input}",
+                "message": "请检查文件路径是否正确",
+                "status": "failed"
+            }
+        max_size_mb = CONFIG["path_input"]["max_size_mb"]
+        source_size = source_path.stat().st_size
+        if max_size_mb and source_size > max_size_mb * 1024 * 1024:
+            return {
+                "error": "文件过大",
+                "message": f"文件大小 {source_size/1024/1024:.1f}MB 超过本地文件限制 {max_size_mb}MB",
+                "status": "failed"
+            }
+        if CONFIG["path_input"]["in_place"] and is_path_in_allowed_roots(source_path):
+            # 允许目录下的文件直接原地翻译
+            pdf_path = source_path
+            ingest_method = "in_place"
+        else:
+            # 同一文件系统上用reflink代替复制
+            ingest_method = await asyncio.to_thread(clone_or_copy_file, source_path, pdf_path)
+        logger.info(f"本地文件接入方式: {ingest_method}")
+    
+    # 验证是否为有效的PDF文件
+    if not validate_pdf_file(pdf_path):
+        return {
+            "error": "文件格式验证失败",
+            "message": "文件不是有效的PDF格式",
+            "status": "failed"
+        }
+    
+    # base64与URL输入在接收过程中已按MAX_PDF_SIZE限制大小，本地文件按PATH_INPUT_MAX_SIZE_MB限制
+    file_size = pdf_path.stat().st_size
+    
+    return {"pdf_path": pdf_path, "file_size": file_size, "sha256": sha256, "ingest_method": ingest_method}
 
 @mcp.tool()
 async def translate_pdf(
@@ -464,7 +1385,9 @@ async def translate_pdf(
     qps: int = None,
     no_dual: bool = False,
     no_mono: bool = False,
-    watermark_output_mode: str = None
+    watermark_output_mode: str = None,
+    callback_url: str = None,
+    ctx: Context = None
 ) -> dict:
     """
     翻译PDF文档 - 支持多种文件输入方式
@@ -482,12 +1405,23 @@ async def translate_pdf(
         no_dual: 是否禁用双语对照版本 (默认: False)
         no_mono: 是否禁用单语翻译版本 (默认: False)
         watermark_output_mode: 水印模式 (no_watermark/watermarked/both，默认: no_watermark)
+        callback_url: 任务结束（完成、失败或取消）时POST通知的http(s)地址 (可选)，无需轮询任务状态
     
     Returns:
         dict: {"task_id": str, "message": str, "status": str} 或错误信息
     """
+    if callback_url and not callback_url.startswith(("http://", "https://")):
+        return {
+            "error": "回调地址无效",
+            "message": "callback_url必须是http或https地址",
+            "status": "failed"
+        }
+    
+    # 委托API服务器时，本地无需BabelDOC与API密钥
+    delegated = bool(CONFIG["backend"]["api_url"])
+    
     # 检查BabelDOC是否可用
-    if not BABELDOC_AVAILABLE:
+    if not delegated and not BABELDOC_AVAILABLE:
         return {
             "error": "BabelDOC库未安装，无法进行翻译",
             "message": "请先安装BabelDOC库",
@@ -499,7 +1433,7 @@ async def translate_pdf(
         }
     
     # 检查API密钥
-    if not CONFIG["openai"]["api_key"]:
+    if not delegated and not CONFIG["openai"]["api_key"]:
         return {
             "error": "未配置OpenAI API密钥",
             "message": "请在.env文件中设置OPENAI_API_KEY",
@@ -514,9 +1448,14 @@ async def translate_pdf(
             "status": "failed"
         }
     
+    # 任务的trace从接收输入开始，任务创建后在get_translation_trace中查看
+    trace = task_trace.TaskTrace(None, "translate_pdf", trace_exporter, input_type=input_type, file_name=filename)
     try:
-        # 创建临时目录和文件
-        temp_dir = Path(tempfile.mkdtemp())
+        # 创建临时目录和文件；本地模式开启检查点时放在持久目录中，服务重启后可以继续翻译
+        checkpointed = CONFIG["checkpoint"]["enabled"] and not delegated
+        if checkpointed:
+            Path(CONFIG["checkpoint"]["dir"]).mkdir(parents=True, exist_ok=True)
+        temp_dir = Path(tempfile.mkdtemp(dir=CONFIG["checkpoint"]["dir"] if checkpointed else None))
         
         # 确保文件名以.pdf结尾
         if not filename.lower().endswith('.pdf'):
@@ -524,85 +1463,123 @@ async def translate_pdf(
         
         pdf_path = temp_dir / filename
         
-        # 根据输入类型处理文件
-        if input_type == "base64":
-            logger.info(f"正在处理base64文件: {filename}")
-            if not save_base64_file(file_input, pdf_path):
-                return {
-                    "error": "base64文件解码失败",
-                    "message": "请检查base64编码格式是否正确",
-                    "status": "failed"
-                }
-        
-        elif input_type == "url":
-            logger.info(f"正在从URL下载文件: {file_input}")
-            if not await download_file_from_url(file_input, pdf_path):
-                return {
-                    "error": "文件下载失败",
-                    "message": f"无法从URL下载文件: {file_input}",
-                    "status": "failed"
-                }
-        
-        elif input_type == "path":
-            logger.info(f"正在处理本地文件: {file_input}")
-            source_path = Path(file_input)
-            if not source_path.exists():
-                return {
-                    "error": f"文件不存在: {file_input}",
-                    "message": "请检查文件路径是否正确",
-                    "status": "failed"
-                }
-            # 复制文件到临时目录
-            shutil.copy2(source_path, pdf_path)
-        
-        # 验证是否为有效的PDF文件
-        if not validate_pdf_file(pdf_path):
-            return {
-                "error": "文件格式验证失败",
-                "message": "文件不是有效的PDF格式",
-                "status": "failed"
-            }
-        
-        # 检查文件大小（限制为100MB）
-        file_size = pdf_path.stat().st_size
-        max_size = 100 * 1024 * 1024  # 100MB
-        if file_size > max_size:
-            return {
-                "error": "文件过大",
-                "message": f"文件大小 {file_size/1024/1024:.1f}MB 超过限制 {max_size/1024/1024}MB",
-                "status": "failed"
-            }
+        with trace.span("ingest") as ingest_span:
+            input_file = await prepare_input_file(file_input, input_type, pdf_path)
+            ingest_span.set_attribute("ingest_method", input_file.get("ingest_method"))
+            ingest_span.set_attribute("file_size", input_file.get("file_size"))
+            if "error" in input_file:
+                ingest_span.end(input_file["error"])
+        if "error" in input_file:
+            # 删除已写入或链接到临时目录的文件
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            trace.end("failed", input_file["message"])
+            return input_file
+        pdf_path = input_file["pdf_path"]
+        file_size = input_file["file_size"]
         
         # 使用默认值
         lang_in = lang_in or CONFIG["translation"]["default_lang_in"]
         lang_out = lang_out or CONFIG["translation"]["default_lang_out"]
         qps = qps or CONFIG["translation"]["qps"]
         watermark_output_mode = watermark_output_mode or CONFIG["translation"]["watermark_output_mode"]
+        trace.root.set_attribute("lang_in", lang_in)
+        trace.root.set_attribute("lang_out", lang_out)
+        
+        if delegated:
+            # 预检、排队与限速都由API服务器完成，使用其任务ID
+            with trace.span("backend_submit") as submit_span:
+                submitted = await submit_backend_translation(pdf_path, {
+                    "lang_in": lang_in,
+                    "lang_out": lang_out,
+                    "qps": qps,
+                    "no_dual": no_dual,
+                    "no_mono": no_mono,
+                    "watermark_output_mode": watermark_output_mode,
+                    "callback_url": callback_url
+                }, trace.traceparent(submit_span))
+            if "error" in submitted:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                trace.end("failed", submitted["message"])
+                return submitted
+            task_id = submitted["task_id"]
+            analysis = submitted.get("analysis")
+        else:
+            # 预检：加密、损坏或无页面的文件直接拒绝，扫描件自动开启ocr_workaround
+            with trace.span("analyze"):
+                analysis = await asyncio.to_thread(analyze_pdf_file, pdf_path, lang_in, qps)
+            if not analysis["valid"]:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                trace.end("failed", analysis["error"])
+                return {
+                    "error": "文件预检未通过",
+                    "message": analysis["error"],
+                    "analysis": analysis,
+                    "status": "failed"
+                }
+            task_id = str(uuid.uuid4())
+        
+        # 淘汰过期任务，释放其临时文件
+        await evict_expired_tasks()
         
         # 创建任务
-        task_id = str(uuid.uuid4())
         task = TranslationTask(task_id)
+        task.temp_dir = temp_dir
+        task.trace = trace
+        trace.root.set_attribute("task_id", task_id)
+        trace.root.set_attribute("page_count", (analysis or {}).get("page_count"))
         translation_tasks[task_id] = task
         
         # 创建输出目录
         output_dir = temp_dir / "output"
         output_dir.mkdir(exist_ok=True)
         
-        # 启动异步翻译任务
-        asyncio.create_task(translate_document_async(
-            task_id, pdf_path, lang_in, lang_out, qps, 
-            no_dual, no_mono, watermark_output_mode, output_dir
-        ))
+        queue_position = None
+        if delegated:
+            start_backend_watcher(task_id, output_dir)
+        else:
+            task.callback_url = callback_url
+            # 继续投递重启前未送达的通知
+            if webhooks:
+                webhooks.ensure_running()
+            params = {
+                "pdf_file": pdf_path,
+                "lang_in": lang_in,
+                "lang_out": lang_out,
+                "qps": qps,
+                "no_dual": no_dual,
+                "no_mono": no_mono,
+                "watermark_output_mode": watermark_output_mode,
+                "output_dir": output_dir,
+                "ocr_workaround": analysis["needs_ocr_workaround"],
+                "working_dir": temp_dir / "working" if checkpointed else None
+            }
+            session_key = get_session_key(ctx)
+            if checkpointed:
+                write_task_manifest(task, {
+                    "task_id": task_id,
+                    "session_key": session_key,
+                    "params": {key: str(value) if isinstance(value, Path) else value for key, value in params.items()},
+                    "callback_url": callback_url,
+                    "resumes": 0
+                })
+            submit_local_translation(task, session_key, params)
+            queue_position = translation_scheduler.queue_position(task_id)
+            if queue_position:
+                task.message = "任务排队中，等待空闲的翻译槽位..."
         
-        logger.info(f"翻译任务已创建: {task_id}, 文件: {filename}")
+        logger.info(f"翻译任务已创建: {task_id}, 文件: {filename}, 排队位置: {queue_position}")
         
         return {
             "task_id": task_id,
             "message": f"翻译任务已创建，正在从{lang_in}翻译到{lang_out}",
             "status": "pending",
+            "queue_position": queue_position,
             "file_name": filename,
             "file_size_mb": round(file_size / 1024 / 1024, 2),
+            "file_sha256": input_file["sha256"],
             "input_type": input_type,
+            "ingest_method": input_file["ingest_method"],
+            "analysis": analysis,
             "settings": {
                 "source_language": lang_in,
                 "target_language": lang_out,
@@ -614,6 +1591,7 @@ async def translate_pdf(
         }
         
     except Exception as e:
+        trace.end("failed", str(e))
         logger.error(f"创建翻译任务时出错: {e}")
         return {
             "error": f"创建翻译任务失败: {str(e)}",
@@ -621,6 +1599,77 @@ async def translate_pdf(
             "status": "failed"
         }
 
+@mcp.tool()
+async def analyze_pdf(
+    file_input: str,
+    input_type: str = "base64",
+    filename: str = "document.pdf",
+    lang_in: str = None,
+    qps: int = None
+) -> dict:
+    """
+    预检PDF文档 - 毫秒级返回页数、加密状态、文本/图片比例及成本与耗时估算，不进行翻译
+    
+    Args:
+        file_input: 文件输入内容（与translate_pdf相同）
+        input_type: 输入类型 ("base64", "url", "path")
+        filename: 文件名称
+        lang_in: 源语言代码，用于估算token数 (默认: en)
+        qps: 每秒查询数限制，用于估算耗时 (默认: 4)
+    
+    Returns:
+        dict: 预检结果，valid为False时error说明原因
+    """
+    if not BABELDOC_AVAILABLE:
+        return {
+            "error": "BabelDOC库未安装，无法解析PDF",
+            "message": "请先安装BabelDOC库",
+            "status": "failed"
+        }
+    
+    if input_type not in ["base64", "url", "path"]:
+        return {
+            "error": "不支持的输入类型",
+            "message": f"支持的输入类型: base64, url, path。当前: {input_type}",
+            "status": "failed"
+        }
+    
+    # 本地文件直接原地读取，无需复制
+    if input_type == "path":
+        source_path = Path(file_input)
+        if not source_path.exists():
+            return {
+                "error": f"文件不存在: {file_input}",
+                "message": "请检查文件路径是否正确",
+                "status": "failed"
+            }
+        return await asyncio.to_thread(analyze_pdf_file, source_path, lang_in, qps)
+    
+    temp_dir = Path(tempfile.mkdtemp())
+    try:
+        if not filename.lower().endswith('.pdf'):
+            filename += '.pdf'
+        pdf_path = temp_dir / filename
+        input_file = await prepare_input_file(file_input, input_type, pdf_path)
+        if "error" in input_file:
+            return input_file
+        return await asyncio.to_thread(analyze_pdf_file, pdf_path, lang_in, qps)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+async def evict_expired_tasks():
+    """从注册表中淘汰过期任务，并删除其结果缓存与临时目录"""
+    evicted = translation_tasks.evict_expired()
+    for task in evicted:
+        task_files.pop(task.task_id, None)
+        if task.temp_dir:
+            prefix = str(task.temp_dir)
+            for key in [key for key in result_file_hashes if key.startswith(prefix)]:
+                result_file_hashes.pop(key, None)
+            await asyncio.to_thread(shutil.rmtree, task.temp_dir, True)
+    if evicted:
+        logger.info(f"已淘汰 {len(evicted)} 个过期任务")
+
 @mcp.tool()
 def get_translation_status(task_id: str) -> dict:
     """
@@ -640,19 +1689,20 @@ def get_translation_status(task_id: str) -> dict:
         }
     
     task = translation_tasks[task_id]
-    return task.to_dict()
+    result = task.to_dict()
+    result["queue_position"] = translation_scheduler.queue_position(task_id)
+    return result
 
 @mcp.tool()
-def get_translation_result_base64(task_id: str, file_type: str = "dual") -> dict:
+async def cancel_translation(task_id: str) -> dict:
     """
-    获取翻译结果文件的base64编码内容
+    取消排队中或进行中的翻译任务
     
     Args:
         task_id: 翻译任务ID
-        file_type: 文件类型 (dual/mono)
     
     Returns:
-        dict: 包含base64编码内容的文件信息
+        dict: 取消结果
     """
     if task_id not in translation_tasks:
         return {
@@ -662,8 +1712,78 @@ def get_translation_result_base64(task_id: str, file_type: str = "dual") -> dict
         }
     
     task = translation_tasks[task_id]
-    if task.status != "completed":
+    if task.status not in ("pending", "processing"):
         return {
+            "error": "任务已结束",
+            "message": f"任务当前状态为{task.status}，无法取消",
+            "status": task.status
+        }
+    
+    if CONFIG["backend"]["api_url"]:
+        result = await backend_request("POST", f"/tasks/{task_id}/cancel")
+        if "error" in result:
+            return result
+    else:
+        translation_scheduler.cancel(task_id)
+    
+    task.status = "cancelled"
+    task.message = "任务已取消"
+    task.updated_at = datetime.now().isoformat()
+    # 排队中被取消的任务不会再运行，在此结束其trace、删除检查点并通知
+    task.trace.end("cancelled", task.message)
+    finish_task_checkpoint(task)
+    notify_task_finished(task)
+    logger.info(f"翻译任务已取消: {task_id}")
+    
+    return {"task_id": task_id, "message": "任务已取消", "status": "cancelled"}
+
+@mcp.tool()
+async def get_translation_trace(task_id: str) -> dict:
+    """
+    查询翻译任务的链路追踪时间线：接收输入、预检、排队、模型加载、翻译各阶段与上传的耗时
+    
+    Args:
+        task_id: 翻译任务ID
+    
+    Returns:
+        dict: 本地trace；委托模式下backend为API服务器上同一trace的各段span
+    """
+    if task_id not in translation_tasks:
+        return {
+            "error": "任务不存在",
+            "message": f"找不到任务ID: {task_id}",
+            "status": "not_found"
+        }
+    
+    result = {"task_id": task_id, "trace": translation_tasks[task_id].trace.to_dict()}
+    if CONFIG["backend"]["api_url"]:
+        backend_trace = await backend_request("GET", f"/tasks/{task_id}/trace")
+        result["backend"] = backend_trace if "error" in backend_trace else backend_trace["traces"]
+    return result
+
+# 分块获取结果文件的参数
+RESULT_CHUNK_SIZE = 1024 * 1024             # 默认每块1MB
+RESULT_MAX_CHUNK_SIZE = 4 * 1024 * 1024     # 单块上限4MB（base64后约5.3MB）
+RESULT_INLINE_MAX_SIZE = 10 * 1024 * 1024   # 超过该大小的文件不再整体返回base64
+result_file_hashes: Dict[str, tuple] = {}   # 文件路径 -> (mtime, size, sha256)
+
+def get_result_file(task_id: str, file_type: str) -> tuple:
+    """
+    查找已完成任务的结果文件
+    
+    Returns:
+        tuple: (文件路径, None) 或 (None, 错误信息dict)
+    """
+    if task_id not in translation_tasks:
+        return None, {
+            "error": "任务不存在",
+            "message": f"找不到任务ID: {task_id}",
+            "status": "not_found"
+        }
+    
+    task = translation_tasks[task_id]
+    if task.status != "completed":
+        return None, {
             "error": "翻译尚未完成",
             "message": f"当前任务状态: {task.status}，请等待翻译完成",
             "current_status": task.status,
@@ -672,7 +1792,7 @@ def get_translation_result_base64(task_id: str, file_type: str = "dual") -> dict
     
     if task_id not in task_files or file_type not in task_files[task_id]:
         available_types = list(task_files.get(task_id, {}).keys())
-        return {
+        return None, {
             "error": f"文件类型 '{file_type}' 不存在",
             "message": f"可用的文件类型: {available_types}",
             "available_types": available_types
@@ -680,12 +1800,60 @@ def get_translation_result_base64(task_id: str, file_type: str = "dual") -> dict
     
     file_path = task_files[task_id][file_type]
     if not file_path.exists():
-        return {
+        return None, {
             "error": "文件不存在",
             "message": f"翻译结果文件已被删除或移动: {file_path}",
             "status": "file_missing"
         }
     
+    return file_path, None
+
+def get_file_sha256(file_path: Path) -> str:
+    """按块计算文件SHA-256，文件未变化时复用缓存结果"""
+    stat = file_path.stat()
+    cached = result_file_hashes.get(str(file_path))
+    if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+        return cached[2]
+    
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(RESULT_CHUNK_SIZE), b""):
+            digest.update(block)
+    sha256 = digest.hexdigest()
+    result_file_hashes[str(file_path)] = (stat.st_mtime, stat.st_size, sha256)
+    return sha256
+
+def read_file_chunk(file_path: Path, offset: int, length: int) -> bytes:
+    """读取文件中 [offset, offset+length) 范围的数据"""
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+@mcp.tool()
+def get_translation_result_base64(task_id: str, file_type: str = "dual") -> dict:
+    """
+    获取翻译结果文件的base64编码内容（仅适用于小文件，大文件请使用get_translation_result_chunk）
+    
+    Args:
+        task_id: 翻译任务ID
+        file_type: 文件类型 (dual/mono)
+    
+    Returns:
+        dict: 包含base64编码内容的文件信息
+    """
+    file_path, error = get_result_file(task_id, file_type)
+    if error:
+        return error
+    
+    file_size = file_path.stat().st_size
+    if file_size > RESULT_INLINE_MAX_SIZE:
+        return {
+            "error": "文件过大",
+            "message": f"文件大小 {round(file_size / 1024 / 1024, 2)}MB 超过整体返回上限 {RESULT_INLINE_MAX_SIZE // 1024 // 1024}MB，请使用get_translation_result_chunk分块获取",
+            "file_size": file_size,
+            "status": "too_large"
+        }
+    
     try:
         # 读取文件并转换为base64
         with open(file_path, 'rb') as f:
@@ -712,6 +1880,69 @@ def get_translation_result_base64(task_id: str, file_type: str = "dual") -> dict
             "status": "read_error"
         }
 
+@mcp.tool()
+async def get_translation_result_chunk(
+    task_id: str,
+    file_type: str = "dual",
+    offset: int = 0,
+    length: int = RESULT_CHUNK_SIZE
+) -> dict:
+    """
+    分块获取翻译结果文件，内存占用与文件大小无关，可从任意offset续传
+    
+    Args:
+        task_id: 翻译任务ID
+        file_type: 文件类型 (dual/mono)
+        offset: 起始字节偏移
+        length: 本块字节数（最大4MB）
+    
+    Returns:
+        dict: 本块的base64内容、文件总大小、整个文件的SHA-256及下一块的offset
+    """
+    file_path, error = get_result_file(task_id, file_type)
+    if error:
+        return error
+    
+    file_size = file_path.stat().st_size
+    if offset < 0 or offset > file_size:
+        return {
+            "error": "offset超出范围",
+            "message": f"offset应在 0 到 {file_size} 之间",
+            "file_size": file_size,
+            "status": "invalid_range"
+        }
+    length = max(1, min(length, RESULT_MAX_CHUNK_SIZE))
+    
+    try:
+        # 文件读取与哈希计算放到线程中，避免阻塞其他会话
+        sha256 = await asyncio.to_thread(get_file_sha256, file_path)
+        chunk = await asyncio.to_thread(read_file_chunk, file_path, offset, length)
+        next_offset = offset + len(chunk)
+        
+        return {
+            "success": True,
+            "file_name": file_path.name,
+            "file_type": file_type,
+            "file_size": file_size,
+            "sha256": sha256,
+            "offset": offset,
+            "length": len(chunk),
+            "next_offset": next_offset,
+            "eof": next_offset >= file_size,
+            "chunk_sha256": hashlib.sha256(chunk).hexdigest(),
+            "chunk_base64": base64.b64encode(chunk).decode('utf-8'),
+            "resource_uri": f"result://{task_id}/{file_type}/{offset // RESULT_CHUNK_SIZE}",
+            "message": f"已读取 {next_offset}/{file_size} 字节"
+        }
+        
+    except Exception as e:
+        logger.error(f"分块读取文件时出错: {e}")
+        return {
+            "error": f"读取文件失败: {str(e)}",
+            "message": "无法读取翻译结果文件",
+            "status": "read_error"
+        }
+
 @mcp.tool()
 def get_translation_result_cos_url(task_id: str, file_type: str = "dual") -> dict:
     """
@@ -775,37 +2006,9 @@ def download_translation_result(task_id: str, file_type: str = "dual") -> dict:
     Returns:
         dict: 文件信息
     """
-    if task_id not in translation_tasks:
-        return {
-            "error": "任务不存在",
-            "message": f"找不到任务ID: {task_id}",
-            "status": "not_found"
-        }
-    
-    task = translation_tasks[task_id]
-    if task.status != "completed":
-        return {
-            "error": "翻译尚未完成",
-            "message": f"当前任务状态: {task.status}，请等待翻译完成",
-            "current_status": task.status,
-            "progress": task.progress
-        }
-    
-    if task_id not in task_files or file_type not in task_files[task_id]:
-        available_types = list(task_files.get(task_id, {}).keys())
-        return {
-            "error": f"文件类型 '{file_type}' 不存在",
-            "message": f"可用的文件类型: {available_types}",
-            "available_types": available_types
-        }
-    
-    file_path = task_files[task_id][file_type]
-    if not file_path.exists():
-        return {
-            "error": "文件不存在",
-            "message": f"翻译结果文件已被删除或移动: {file_path}",
-            "status": "file_missing"
-        }
+    file_path, error = get_result_file(task_id, file_type)
+    if error:
+        return error
     
     return {
         "success": True,
@@ -850,7 +2053,12 @@ def check_system_status() -> dict:
             "cos_bucket": cos_config.get("bucket", "未配置")
         },
         "active_tasks": len(translation_tasks),
-        "ready": BABELDOC_AVAILABLE and bool(CONFIG["openai"]["api_key"]),
+        "scheduler": translation_scheduler.stats(),
+        "translation_dedup": single_flight.flights.stats() if CONFIG["translation"]["dedup"] else None,
+        "pdf_optimize": output_optimizer.stats() if output_optimizer else None,
+        "webhooks": webhooks.stats() if webhooks else None,
+        "translate_api_url": CONFIG["backend"]["api_url"] or None,
+        "ready": bool(CONFIG["backend"]["api_url"]) or (BABELDOC_AVAILABLE and bool(CONFIG["openai"]["api_key"])),
         "cos_upload_ready": COS_AVAILABLE and cos_configured
     }
     
@@ -912,16 +2120,25 @@ def check_system_status() -> dict:
     return status
 
 @mcp.tool()
-def list_all_tasks() -> dict:
+def list_all_tasks(status: str = None, cursor: int = None, limit: int = 50) -> dict:
     """
-    列出所有翻译任务
+    分页列出翻译任务（按创建时间倒序）
+    
+    Args:
+        status: 只列出该状态的任务（pending, processing, completed, failed, cancelled），默认全部
+        cursor: 分页游标，传入上一页返回的next_cursor
+        limit: 每页任务数，最大500
     
     Returns:
-        dict: 所有任务状态
+        dict: 任务总数、按状态计数、本页任务及下一页游标
     """
+    limit = max(1, min(limit, 500))
+    tasks, next_cursor = translation_tasks.page(status, cursor, limit)
     return {
         "total_tasks": len(translation_tasks),
-        "tasks": [task.to_dict() for task in translation_tasks.values()]
+        "status_counts": dict(translation_tasks.status_counts),
+        "tasks": [task.to_dict() for task in tasks],
+        "next_cursor": next_cursor
     }
 
 @mcp.tool()
@@ -1056,29 +2273,30 @@ def get_all_tasks() -> str:
     }
     
     # 按状态分组
-    status_counts = {}
-    for task in translation_tasks.values():
-        status = task.status
-        if status not in status_counts:
-            status_counts[status] = 0
-        status_counts[status] += 1
-    
-    tasks_info["tasks_by_status"] = status_counts
+    tasks_info["tasks_by_status"] = dict(translation_tasks.status_counts)
     
     # 最近的任务
-    recent_tasks = sorted(
-        translation_tasks.values(),
-        key=lambda x: x.updated_at,
-        reverse=True
-    )[:10]
+    recent_tasks = translation_tasks.recent_tasks(10)
     
     tasks_info["recent_tasks"] = [task.to_dict() for task in recent_tasks]
     
     return json.dumps(tasks_info, indent=2, ensure_ascii=False)
 
+@mcp.resource("result://{task_id}/{file_type}/{chunk_index}", mime_type="application/octet-stream")
+async def get_result_chunk_resource(task_id: str, file_type: str, chunk_index: int) -> bytes:
+    """按1MB分块读取翻译结果文件，第chunk_index块（从0开始）"""
+    file_path, error = get_result_file(task_id, file_type)
+    if error:
+        raise ValueError(error["message"])
+    return await asyncio.to_thread(read_file_chunk, file_path, chunk_index * RESULT_CHUNK_SIZE, RESULT_CHUNK_SIZE)
+
 if __name__ == "__main__":
-    # 初始化BabelDOC（如果可用）
-    if BABELDOC_AVAILABLE:
+    # 启动服务时才安装队列日志并创建日志文件，导入main.py时不写文件；退出时写完队列中剩余的日志
+    log_listener = log_pipeline.setup(CONFIG["logging"]["file"], CONFIG["logging"])
+    atexit.register(log_listener.stop)
+    
+    # 初始化BabelDOC（如果可用）；委托API服务器翻译时不在本进程加载
+    if BABELDOC_AVAILABLE and not CONFIG["backend"]["api_url"]:
         try:
             babeldoc.format.pdf.high_level.init()
             logger.info("BabelDOC initialized successfully")
@@ -1095,6 +2313,18 @@ if __name__ == "__main__":
     logger.info(f"OpenAI Model: {CONFIG['openai']['model']}")
     logger.info(f"Default Translation: {CONFIG['translation']['default_lang_in']} -> {CONFIG['translation']['default_lang_out']}")
     logger.info(f"BabelDOC Available: {BABELDOC_AVAILABLE}")
+    if CONFIG["backend"]["api_url"]:
+        logger.info(f"Translation delegated to: {CONFIG['backend']['api_url']}")
+    
+    # 打开webhook发件箱，此时才创建数据库文件
+    webhooks = webhook_outbox.WebhookOutbox(CONFIG["webhooks"], user_agent="PDFTranslate-MCP")
+    
+    async def serve():
+        # 本地模式下先重新提交上次未完成的任务；MCP服务器没有启动钩子，在启动SSE服务前执行
+        if CONFIG["checkpoint"]["enabled"] and BABELDOC_AVAILABLE and not CONFIG["backend"]["api_url"]:
+            resume_interrupted_tasks()
+            webhooks.ensure_running()
+        await mcp.run_sse_async()
     
     # 启动MCP服务器 (SSE模式)
-    mcp.run(transport="sse")
\ No newline at end of file
+    asyncio.run(serve())
\ No newline at end of file
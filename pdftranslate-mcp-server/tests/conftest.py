@@ -0,0 +1,10 @@
+# main.py在导入时读取环境变量并初始化trace等，测试中把运行时文件放到临时目录
+import os
+import tempfile
+
+TEST_DATA_DIR = tempfile.mkdtemp(prefix="pdftranslate-mcp-tests-")
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ["LOG_FILE"] = ""
+os.environ["TRACE_EXPORT_FILE"] = ""
+os.environ["WEBHOOK_OUTBOX_PATH"] = os.path.join(TEST_DATA_DIR, "webhooks.db")
+os.environ["TASK_CHECKPOINT_DIR"] = os.path.join(TEST_DATA_DIR, "tasks")
@@ -0,0 +1,214 @@
+"""
+COS上传测试：本地起一个兼容COS XML接口的最小服务（简单上传与分块上传），
+客户端通过Domain访问它，不需要真实的存储桶
+"""
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.etree import ElementTree
+
+import pytest
+
+import main
+
+pytest.importorskip("qcloud_cos", reason="cos-python-sdk-v5未安装")
+from qcloud_cos.cos_exception import CosServiceError
+
+
+class FakeCos:
+    """对象与未完成的分块上传都保存在内存中；fail_parts记录每个分块还需要失败的次数"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+        self.fail_parts = {}
+        self.part_requests = {}
+        self.next_upload = 0
+
+
+class FakeCosHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, status, code):
+        body = f"<Error><Code>{code}</Code><Message>{code}</Message></Error>".encode()
+        self.reply(status, body, {"Content-Type": "application/xml"})
+
+    def parse(self):
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        return unquote(url.path.lstrip("/")), query, self.rfile.read(length)
+
+    def do_PUT(self):
+        cos = self.server.cos
+        key, query, body = self.parse()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if "uploadId" not in query:
+            with cos.lock:
+                cos.objects[key] = body
+            return self.reply(200, headers={"ETag": etag})
+        part_number = int(query["partNumber"])
+        with cos.lock:
+            if query["uploadId"] not in cos.uploads:
+                return self.error(404, "NoSuchUpload")
+            cos.part_requests[(key, part_number)] = cos.part_requests.get((key, part_number), 0) + 1
+            if cos.fail_parts.get(part_number, 0) > 0:
+                cos.fail_parts[part_number] -= 1
+                return self.error(400, "RequestTimeout")
+            cos.uploads[query["uploadId"]]["parts"][part_number] = body
+        self.reply(200, headers={"ETag": etag})
+
+    def do_POST(self):
+        cos = self.server.cos
+        key, query, body = self.parse()
+        if "uploads" in query:
+            with cos.lock:
+                cos.next_upload += 1
+                upload_id = f"upload-{cos.next_upload}"
+                cos.uploads[upload_id] = {"key": key, "parts": {}}
+            result = (
+                "<InitiateMultipartUploadResult><Bucket>test</Bucket>"
+                f"<Key>{key}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"
+            )
+            return self.reply(200, result.encode(), {"Content-Type": "application/xml"})
+        with cos.lock:
+            upload = cos.uploads.pop(query["uploadId"], None)
+            if upload is None:
+                return self.error(404, "NoSuchUpload")
+            numbers = [int(part.findtext("PartNumber")) for part in ElementTree.fromstring(body).iter("Part")]
+            cos.objects[key] = b"".join(upload["parts"][number] for number in numbers)
+            etag = f'"{hashlib.md5(cos.objects[key]).hexdigest()}-{len(numbers)}"'
+        result = (
+            "<CompleteMultipartUploadResult><Bucket>test</Bucket>"
+            f"<Key>{key}</Key><ETag>{etag}</ETag></CompleteMultipartUploadResult>"
+        )
+        self.reply(200, result.encode(), {"Content-Type": "application/xml"})
+
+    def do_DELETE(self):
+        cos = self.server.cos
+        key, query, _ = self.parse()
+        with cos.lock:
+            cos.uploads.pop(query.get("uploadId"), None)
+            cos.aborted.append(key)
+        self.reply(204)
+
+
+@pytest.fixture
+def fake_cos(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeCosHandler)
+    server.cos = FakeCos()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setitem(main.CONFIG, "cos", {
+        "region": "ap-test",
+        "secret_id": "test-id",
+        "secret_key": "test-key",
+        "bucket": "test-1250000000",
+        "domain": f"127.0.0.1:{server.server_port}",
+        "scheme": "http",
+        "multipart_threshold": 64 * 1024,
+        "part_size": 16 * 1024,
+        "upload_threads": 4,
+        "part_retries": 3,
+    })
+    monkeypatch.setattr(main, "cos_client_cache", {"key": None, "client": None})
+    # 分块重试的退避不需要真的等待
+    monkeypatch.setattr(main.time, "sleep", lambda seconds: None)
+    yield server.cos
+    server.shutdown()
+    server.server_close()
+
+
+def write_file(path, size, seed):
+    data = hashlib.sha256(seed.encode()).digest() * (size // 32 + 1)
+    path.write_bytes(data[:size])
+    return data[:size]
+
+
+def test_get_cos_client_reuses_client(fake_cos, monkeypatch):
+    """相同配置复用同一个客户端，配置变化时重建"""
+    cos_config = main.CONFIG["cos"]
+    client = main.get_cos_client(cos_config)
+    assert main.get_cos_client(dict(cos_config)) is client
+
+    monkeypatch.setitem(cos_config, "secret_key", "rotated-key")
+    rebuilt = main.get_cos_client(cos_config)
+    assert rebuilt is not client
+    assert main.get_cos_client(cos_config) is rebuilt
+
+
+def test_small_file_uses_put_object(fake_cos, tmp_path):
+    """不超过分块阈值的文件整体上传"""
+    data = write_file(tmp_path / "small.pdf", 10 * 1024, "small")
+    result = main.upload_file_to_cos(tmp_path / "small.pdf", "small.pdf")
+    assert result["success"], result
+    assert not result["multipart"]
+    assert fake_cos.objects[result["file_name"]] == data
+    assert result["url"] == f"http://{main.CONFIG['cos']['domain']}/{result['file_name']}"
+
+
+def test_multipart_upload_retries_failed_part(fake_cos, tmp_path):
+    """失败的分块单独重试，其他分块不重传"""
+    data = write_file(tmp_path / "large.pdf", 100 * 1024, "large")
+    fake_cos.fail_parts = {3: 2}
+    result = main.upload_file_to_cos(tmp_path / "large.pdf", "large.pdf")
+    assert result["success"], result
+    assert result["multipart"]
+    key = result["file_name"]
+    assert fake_cos.objects[key] == data
+    assert fake_cos.part_requests[(key, 3)] == 3
+    assert all(count == 1 for (_, number), count in fake_cos.part_requests.items() if number != 3)
+    assert not fake_cos.uploads
+
+
+def test_multipart_upload_aborts_after_retries(fake_cos, tmp_path):
+    """分块重试用尽后取消分块上传，不留下未完成的上传"""
+    write_file(tmp_path / "large.pdf", 100 * 1024, "large")
+    fake_cos.fail_parts = {2: main.CONFIG["cos"]["part_retries"]}
+    client = main.get_cos_client(main.CONFIG["cos"])
+    with pytest.raises(CosServiceError):
+        main.multipart_upload_to_cos(client, main.CONFIG["cos"], tmp_path / "large.pdf", "large.pdf")
+    assert fake_cos.part_requests[("large.pdf", 2)] == main.CONFIG["cos"]["part_retries"]
+    assert fake_cos.aborted == ["large.pdf"]
+    assert not fake_cos.uploads
+    assert "large.pdf" not in fake_cos.objects
+
+
+def test_concurrent_dual_and_mono_uploads(fake_cos, tmp_path, monkeypatch):
+    """双语与单语结果同时分块上传，共用一个客户端，内容互不串扰"""
+    created = []
+    original_client = main.CosS3Client
+
+    def counting_client(config):
+        created.append(config)
+        return original_client(config)
+
+    monkeypatch.setattr(main, "CosS3Client", counting_client)
+    files = {
+        "paper.dual.pdf": write_file(tmp_path / "paper.dual.pdf", 150 * 1024, "dual"),
+        "paper.mono.pdf": write_file(tmp_path / "paper.mono.pdf", 90 * 1024, "mono"),
+    }
+    fake_cos.fail_parts = {1: 1}
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(lambda name: main.upload_file_to_cos(tmp_path / name, name), files))
+
+    assert len(created) == 1
+    for name, result in zip(files, results, strict=True):
+        assert result["success"], result
+        assert result["multipart"]
+        assert result["file_name"].startswith(name.rsplit(".", 1)[0])
+        assert fake_cos.objects[result["file_name"]] == files[name]
+    assert not fake_cos.uploads
@@ -0,0 +1,121 @@
+"""任务注册表分页与调度器排队位置的测试"""
+import asyncio
+
+import main
+
+
+def make_registry(count, max_tasks=100, retention_seconds=3600):
+    registry = main.TaskRegistry(max_tasks, retention_seconds)
+    for index in range(count):
+        registry.add(main.TranslationTask(f"task-{index}"))
+    return registry
+
+
+def collect_pages(registry, status=None, limit=3):
+    pages = []
+    cursor = None
+    while True:
+        tasks, cursor = registry.page(status, cursor, limit)
+        pages.append([task.task_id for task in tasks])
+        if cursor is None:
+            return pages
+
+
+def test_page_walks_newest_first():
+    """按创建时间倒序分页，游标指向下一页的起点，最后一页游标为None"""
+    registry = make_registry(8)
+    assert collect_pages(registry) == [
+        ["task-7", "task-6", "task-5"],
+        ["task-4", "task-3", "task-2"],
+        ["task-1", "task-0"],
+    ]
+    tasks, cursor = registry.page(limit=8)
+    assert len(tasks) == 8 and cursor is None
+    assert registry.page(limit=3, cursor=0) == ([], None)
+
+
+def test_page_filters_by_status():
+    """按状态分页只包含该状态的任务，状态变化后索引随之更新"""
+    registry = make_registry(6)
+    for index in (0, 2, 3, 5):
+        registry[f"task-{index}"].status = "completed"
+    assert collect_pages(registry, "completed", limit=3) == [["task-5", "task-3", "task-2"], ["task-0"]]
+    assert collect_pages(registry, "pending", limit=3) == [["task-4", "task-1"]]
+    assert registry.status_counts == {"completed": 4, "pending": 2}
+
+    registry["task-3"].status = "failed"
+    assert collect_pages(registry, "completed", limit=3) == [["task-5", "task-2", "task-0"]]
+    assert registry.page("failed") == ([registry["task-3"]], None)
+    assert registry.page("cancelled") == ([], None)
+
+
+def test_page_is_stable_across_removal():
+    """翻页期间淘汰任务不会跳过或重复其余任务"""
+    registry = make_registry(7)
+    first, cursor = registry.page(limit=3)
+    assert [task.task_id for task in first] == ["task-6", "task-5", "task-4"]
+    registry.remove("task-3")
+    registry.remove("task-5")
+    second, cursor = registry.page(cursor=cursor, limit=3)
+    assert [task.task_id for task in second] == ["task-2", "task-1", "task-0"]
+    assert cursor is None
+    assert len(registry) == 5
+
+
+def test_evict_expired_keeps_unfinished_tasks():
+    """超出数量时淘汰最久未更新的已结束任务，未结束的任务保留"""
+    registry = make_registry(5, max_tasks=3)
+    for index in (1, 2, 4):
+        registry[f"task-{index}"].status = "completed"
+    evicted = registry.evict_expired()
+    assert [task.task_id for task in evicted] == ["task-1", "task-2"]
+    assert [task.task_id for task in registry.page()[0]] == ["task-4", "task-3", "task-0"]
+
+
+async def run_scheduler(submissions, cancelled=()):
+    """在占满唯一运行槽位时提交任务，记录各任务的排队位置与实际开始顺序"""
+    scheduler = main.TranslationScheduler(1)
+    gate = asyncio.Event()
+    started = []
+
+    def job(task_id):
+        async def run():
+            started.append(task_id)
+            if task_id == "blocker":
+                await gate.wait()
+        return run
+
+    scheduler.submit("blocker-session", "blocker", job("blocker"))
+    await asyncio.sleep(0)
+    for session_key, task_id in submissions:
+        scheduler.submit(session_key, task_id, job(task_id))
+    for task_id in cancelled:
+        assert scheduler.cancel(task_id)
+    positions = {task_id: scheduler.queue_position(task_id) for _, task_id in submissions}
+    assert scheduler.queue_position("blocker") is None
+    gate.set()
+    while len(scheduler.running) or scheduler.queues:
+        await asyncio.sleep(0)
+    return positions, started[1:]
+
+
+def test_queue_position_matches_dispatch_order():
+    """排队位置与轮转调度实际开始执行的顺序一致"""
+    submissions = [
+        ("alice", "a1"), ("alice", "a2"), ("alice", "a3"), ("alice", "a4"),
+        ("bob", "b1"),
+        ("carol", "c1"), ("carol", "c2"),
+        ("bob", "b2"),
+    ]
+    positions, started = asyncio.run(run_scheduler(submissions))
+    assert started == ["a1", "b1", "c1", "a2", "b2", "c2", "a3", "a4"]
+    assert [positions[task_id] for task_id in started] == list(range(1, len(started) + 1))
+
+
+def test_queue_position_after_cancel():
+    """取消排队中的任务后，其后任务的位置前移，被取消的任务不再有位置"""
+    submissions = [("alice", "a1"), ("alice", "a2"), ("bob", "b1"), ("bob", "b2")]
+    positions, started = asyncio.run(run_scheduler(submissions, cancelled=("a1",)))
+    assert positions["a1"] is None
+    assert started == ["a2", "b1", "b2"]
+    assert [positions[task_id] for task_id in started] == [1, 2, 3]